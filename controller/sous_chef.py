@@ -3,16 +3,61 @@ import modules.pump as pump
 import modules.cup_dispenser as cup_dispenser
 import modules.stirrer as stirrer
 import modules.stove_controller as stove_controller
+import modules.drivers.motion_worker as motion_worker
+import modules.drivers.servo_driver as servo_driver
+import modules.drivers.bus_stats as bus_stats
 import ConfigParser
-import RPi.GPIO as GPIO
+import modules.drivers.gpio as GPIO
 import time
 
+def counts_bus_ops(operation):
+  """ Counts the GPIO and I2C operations of a SousChef operation. The delta is
+      kept in last_bus_ops and printed if report_bus_ops is set. """
+  def counted_operation(self, *args):
+    before = bus_stats.get_counters()
+    start = time.time()
+    previous_caller = bus_stats.set_caller(operation.__name__)
+    try:
+      return operation(self, *args)
+    finally:
+      bus_stats.set_caller(previous_caller)
+      secs = time.time() - start
+      delta = bus_stats.get_delta(before)
+      self.last_bus_ops = (operation.__name__, secs, delta)
+      if self.report_bus_ops:
+        print self.format_bus_ops()
+  counted_operation.__name__ = operation.__name__
+  counted_operation.__doc__ = operation.__doc__
+  return counted_operation
+
 class SousChef:
   def __init__(self, utensil_index, conf_file="./config/sous-chef.conf"):
     self.utensil_index = utensil_index
     config = ConfigParser.RawConfigParser()
     config.read(conf_file)
+    self.report_bus_ops = False
+    self.last_bus_ops = None
+    if config.has_section("BusStats"):
+      if config.has_option("BusStats", "modules.bus_stats.report"):
+        self.report_bus_ops = config.getboolean("BusStats", "modules.bus_stats.report")
+      if config.has_option("BusStats", "modules.bus_stats.trace_size"):
+        bus_stats.enable_trace(config.getint("BusStats", "modules.bus_stats.trace_size"))
+    if config.has_option("GPIO", "modules.gpio.backend"):
+      GPIO.set_backend(GPIO.create_backend(config.get("GPIO", "modules.gpio.backend")))
     GPIO.setmode(GPIO.BCM)
+    # Started first so that the worker process is forked before any thread.
+    self.motion_worker = None
+    waveform_executor_class = None
+    if config.has_section("MotionWorker") and config.getboolean("MotionWorker", "modules.motion_worker.enabled"):
+      cpu = None
+      if config.has_option("MotionWorker", "modules.motion_worker.cpu"):
+        cpu = config.getint("MotionWorker", "modules.motion_worker.cpu")
+      priority = None
+      if config.has_option("MotionWorker", "modules.motion_worker.priority"):
+        priority = config.getint("MotionWorker", "modules.motion_worker.priority")
+      self.motion_worker = motion_worker.MotionWorker(cpu=cpu, priority=priority)
+      self.motion_worker.start()
+      waveform_executor_class = self.motion_worker.get_executor
     self.servo_driver_enable_pin = config.getint("CupDispenser", "modules.servo.enable_bcm_pin")
 
     self.water_pump = pump.Pump(config.getint("WaterPump", "modules.water_pump.relay.bcm_pin"),
@@ -25,11 +70,23 @@ class SousChef:
 
     #GPIO.setup(self.servo_driver_enable_pin, GPIO.OUT)
     #GPIO.output(self.servo_driver_enable_pin, GPIO.LOW)
+    if config.has_section("ServoRouting"):
+      prefix = "modules.servo.channel."
+      for (option, value) in config.items("ServoRouting"):
+        if option.startswith(prefix):
+          (busnum, address, driver_channel) = servo_driver.parse_channel_route(value)
+          servo_driver.set_channel_route(int(option[len(prefix):]), busnum, address, driver_channel)
     self.lid = lid.Lid(config.getint("Lid", "modules.lid.servo.channel"))
     self.cup_dispenser = cup_dispenser.CupDispenser(config.getint("CupDispenser", "modules.dispenser.small_cup1.channel"),
                                                     config.getint("CupDispenser", "modules.dispenser.small_cup2.channel"),
                                                     config.getint("CupDispenser", "modules.dispenser.large_cup1.channel"),
                                                     config.getint("CupDispenser", "modules.dispenser.large_cup2.channel"))
+    position_file = None
+    position_max_age_secs = None
+    if config.has_option("Stirrer", "modules.stirrer.position_file"):
+      position_file = config.get("Stirrer", "modules.stirrer.position_file")
+    if config.has_option("Stirrer", "modules.stirrer.position_max_age_sec"):
+      position_max_age_secs = config.getint("Stirrer", "modules.stirrer.position_max_age_sec")
     self.stirrer = stirrer.Stirrer(config.getint("Stirrer", "modules.stirrer.x_rail.dir_pin"),
                                    config.getint("Stirrer", "modules.stirrer.x_rail.step_pin"),
                                    config.getint("Stirrer", "modules.stirrer.x_rail.enable_pin"),
@@ -38,7 +95,13 @@ class SousChef:
                                    config.getint("Stirrer", "modules.stirrer.y_rail.enable_pin"),
                                    config.getint("Stirrer", "modules.stirrer.z_rail.dir_pin"),
                                    config.getint("Stirrer", "modules.stirrer.z_rail.step_pin"),
-                                   config.getint("Stirrer", "modules.stirrer.z_rail.enable_pin"),)
+                                   config.getint("Stirrer", "modules.stirrer.z_rail.enable_pin"),
+                                   waveform_executor_class=waveform_executor_class,
+                                   position_file=position_file,
+                                   position_max_age_secs=position_max_age_secs)
+    if (config.has_option("Stirrer", "modules.stirrer.warm_stroke_plans") and
+        config.getboolean("Stirrer", "modules.stirrer.warm_stroke_plans")):
+      self.stirrer.warm_stroke_plans(self.utensil_index)
 
     self.stove_controller = stove_controller.StoveController(config.getint("StoveController", "modules.stove_controller.servo.channel"),
                                                              config.getint("StoveController", "modules.stove_controller.switch.bcm_pin"),
@@ -76,9 +139,11 @@ class SousChef:
     self.ensure_or_position_platform_over_utensil()
     self.stove_controller.hold_freeze()
 
+  @counts_bus_ops
   def open_lid(self):
     self.lid.open()
 
+  @counts_bus_ops
   def close_lid(self):
     if not self.lid.is_open():
       return
@@ -86,28 +151,55 @@ class SousChef:
     self.stirrer.position_platform_at_lid()
     self.lid.close()
 
+  @counts_bus_ops
   def add_water_in_cups(self, num_cups):
     self.ensure_or_position_platform_at_base()
     self.water_pump.dispense_cup(num_cups)
 
+  @counts_bus_ops
   def add_oil_in_tbsp(self, num_tbsp):
     self.ensure_or_position_platform_at_base()
     self.oil_pump.dispense_tbsp(num_tbsp)
 
+  def check_stir(self, stir_type, num_secs, stir_height_index, stir_radius_index=None):
+    """ Raises ValueError if the stir cannot be run in the utensil. Nothing
+        moves. Takes the arguments of a stir step of a recipe. """
+    self.stirrer.check_stir(self.utensil_index, stir_type, num_secs, stir_height_index, stir_radius_index)
+
+  @counts_bus_ops
   def stir_linear(self, num_secs, stir_height_index):
+    self.check_stir("linear", num_secs, stir_height_index)
     self.prepare_to_stir()
     self.ensure_or_position_platform_over_utensil()
     self.stirrer.stir_linear(self.utensil_index, num_secs, stir_height_index)
 
+  @counts_bus_ops
   def stir_circular(self, num_secs, stir_height_index, stir_radius_index):
+    self.check_stir("circular", num_secs, stir_height_index, stir_radius_index)
     self.prepare_to_stir()
     self.ensure_or_position_platform_over_utensil()
     self.stirrer.stir_circular(self.utensil_index, num_secs, stir_height_index, stir_radius_index)
+
+  @counts_bus_ops
+  def stir_spiral(self, num_secs, stir_height_index):
+    self.check_stir("spiral", num_secs, stir_height_index)
+    self.prepare_to_stir()
+    self.ensure_or_position_platform_over_utensil()
+    self.stirrer.stir_spiral(self.utensil_index, num_secs, stir_height_index)
+
+  @counts_bus_ops
+  def stir_zigzag(self, num_secs, stir_height_index):
+    self.check_stir("zigzag", num_secs, stir_height_index)
+    self.prepare_to_stir()
+    self.ensure_or_position_platform_over_utensil()
+    self.stirrer.stir_zigzag(self.utensil_index, num_secs, stir_height_index)
     
+  @counts_bus_ops
   def set_temperature_in_celcius(self, temperature):
     self.ensure_or_position_platform_at_base()
     self.stove_controller.set_temperature_C(temperature)
 
+  @counts_bus_ops
   def set_knobpos(self, pos):
     self.stove_controller.set_knobpos(pos)
     if pos == 0:
@@ -115,11 +207,25 @@ class SousChef:
     else:
       self.stove_controller.on()
 
+  @counts_bus_ops
   def add_cup(self, cup_num):
     self.prepare_to_move()
     self.stirrer.position_platform_for_cup(cup_num)
     self.cup_dispenser.pour_cup(cup_num)
 
+  def format_bus_ops(self):
+    """ The GPIO and I2C operations of the last operation, with the secs
+        spent on the buses against the secs it took. """
+    if self.last_bus_ops is None:
+      return "No operation run yet"
+    (name, secs, delta) = self.last_bus_ops
+    (num_ops, num_bytes, bus_secs) = bus_stats.get_totals(delta)
+    lines = ["%s: %d bus operations, %d bytes, %.3f of %.3f secs on the buses" %
+             (name, num_ops, num_bytes, bus_secs, secs)]
+    if len(delta) > 0:
+      lines.append(bus_stats.format_counters(delta))
+    return "\n".join(lines)
+
   def shutdown(self):
     self.stove_controller.shutdown()
     self.lid.shutdown()
@@ -127,6 +233,8 @@ class SousChef:
     self.oil_pump.shutdown()
     self.cup_dispenser.shutdown()
     self.stirrer.shutdown()
+    if self.motion_worker is not None:
+      self.motion_worker.stop()
 
 if (__name__ == "__main__"):
   sous_chef = SousChef(0, conf_file="./config/sous-chef.conf")
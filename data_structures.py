@@ -14,15 +14,33 @@ class Step:
                "delay",
                "done",
                "knobpos"])
-  
+  # First argument of a stir step.
+  stir_types = set(["circular",
+                    "linear",
+                    "spiral",
+                    "zigzag"])
+  # Radius indices of a circular stir: 1 (innermost) to 5 (the rim of the
+  # utensil), or -1 to sweep through all of them.
+  stir_radius_indices = set([-1, 1, 2, 3, 4, 5])
+
   def __init__(self, name='', args='', json_dict=None):
     if json_dict == None:
-      if name not in Step.steps:
-        raise ValueError("Unrecognised step:" + step)
+      Step.check_step(name, args)
       self.name = name
       self.step_args = args
     else:
+      Step.check_step(json_dict["name"], json_dict["step_args"])
       self.__dict__ = json_dict
+
+  @staticmethod
+  def check_step(name, args):
+    if name not in Step.steps:
+      raise ValueError("Unrecognised step:" + str(name))
+    if name == "stir":
+      if args[0] not in Step.stir_types:
+        raise ValueError("Unrecognised stir type:" + str(args[0]))
+      if args[0] == "circular" and len(args) > 3 and args[3] not in Step.stir_radius_indices:
+        raise ValueError("Invalid stir radius index:" + str(args[3]) + ". Has to be 1-5, or -1 for all")
  
 class Recipe:
   def __init__(self, utensil_size=0, name='', json_string=None):
@@ -1,5 +1,6 @@
 from drivers.servo_driver import Servo
-import time
+import drivers.servo_driver as servo_driver
+from drivers import clock
 
 class CupDispenser:
   cup_positions = [(175, 65), # Hold, Dispense positions
@@ -21,13 +22,15 @@ class CupDispenser:
 
   def tip_servo(self, servo, hold_pos, dispense_pos):
     self.all_on_hold=False
-    servo.move_to(hold_pos)
-    servo.move_to(dispense_pos)
-    time.sleep(1)
-    servo.move_to(hold_pos)
-    servo.move_to(dispense_pos)
-    time.sleep(1)
-    servo.move_to(hold_pos)
+    # Each move takes as long as the servo's move_to would, without the bus
+    # latency of a write per degree.
+    servo_driver.move_together([(servo, hold_pos)])
+    servo_driver.move_together([(servo, dispense_pos)])
+    clock.sleep(1)
+    servo_driver.move_together([(servo, hold_pos)])
+    servo_driver.move_together([(servo, dispense_pos)])
+    clock.sleep(1)
+    servo_driver.move_together([(servo, hold_pos)])
     self.all_on_hold=True
 
   def are_all_on_hold(self):
@@ -57,10 +60,10 @@ class CupDispenser:
       raise ValueError("We should never get here")
 
   def reset(self):
-    self.small_cup1_servo.move_to(CupDispenser.cup_positions[0][0])
-    self.small_cup2_servo.move_to(CupDispenser.cup_positions[1][0])
-    self.large_cup1_servo.move_to(CupDispenser.cup_positions[2][0])
-    self.large_cup2_servo.move_to(CupDispenser.cup_positions[3][0])
+    servo_driver.move_together([(self.small_cup1_servo, CupDispenser.cup_positions[0][0]),
+                                (self.small_cup2_servo, CupDispenser.cup_positions[1][0]),
+                                (self.large_cup1_servo, CupDispenser.cup_positions[2][0]),
+                                (self.large_cup2_servo, CupDispenser.cup_positions[3][0])])
 
   def shutdown(self):
     self.reset()
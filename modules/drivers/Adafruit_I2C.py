@@ -1,6 +1,8 @@
 #!/usr/bin/python
 import re
 import smbus
+import time
+import bus_stats
 
 # ===========================================================================
 # Adafruit_I2C Class
@@ -40,8 +42,15 @@ class Adafruit_I2C(object):
     # Alternatively, you can hard-code the bus version below:
     # self.bus = smbus.SMBus(0); # Force I2C0 (early 256MB Pi's)
     # self.bus = smbus.SMBus(1); # Force I2C1 (512MB Pi's)
-    self.bus = smbus.SMBus(busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber())
+    self.busnum = busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber()
+    self.bus = smbus.SMBus(self.busnum)
     self.debug = debug
+    # Name of the device in bus_stats.
+    self.device_name = "i2c%d:0x%02X" % (self.busnum, address)
+
+  def record(self, operation, reg, num_bytes, start):
+    "Counts an operation that started at start in bus_stats"
+    bus_stats.record(self.device_name, operation, 1, num_bytes, time.time() - start, reg)
 
   def reverseByteOrder(self, data):
     "Reverses the byte order of an int (16-bit) or long (32-bit) value"
@@ -59,15 +68,19 @@ class Adafruit_I2C(object):
 
   def write8(self, reg, value):
     "Writes an 8-bit value to the specified register/address"
+    start = time.time()
     try:
       self.bus.write_byte_data(self.address, reg, value)
       if self.debug:
         print "I2C: Wrote 0x%02X to register 0x%02X" % (value, reg)
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("write8", reg, 1, start)
 
   def write16(self, reg, value):
     "Writes a 16-bit value to the specified register/address pair"
+    start = time.time()
     try:
       self.bus.write_word_data(self.address, reg, value)
       if self.debug:
@@ -75,18 +88,24 @@ class Adafruit_I2C(object):
          (value, reg, reg+1))
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("write16", reg, 2, start)
 
   def writeRaw8(self, value):
     "Writes an 8-bit value on the bus"
+    start = time.time()
     try:
       self.bus.write_byte(self.address, value)
       if self.debug:
         print "I2C: Wrote 0x%02X" % value
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("writeRaw8", None, 1, start)
 
   def writeList(self, reg, list):
     "Writes an array of bytes using I2C format"
+    start = time.time()
     try:
       if self.debug:
         print "I2C: Writing list to register 0x%02X:" % reg
@@ -94,9 +113,12 @@ class Adafruit_I2C(object):
       self.bus.write_i2c_block_data(self.address, reg, list)
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("writeList", reg, len(list), start)
 
   def readList(self, reg, length):
     "Read a list of bytes from the I2C device"
+    start = time.time()
     try:
       results = self.bus.read_i2c_block_data(self.address, reg, length)
       if self.debug:
@@ -106,9 +128,12 @@ class Adafruit_I2C(object):
       return results
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("readList", reg, length, start)
 
   def readU8(self, reg):
     "Read an unsigned byte from the I2C device"
+    start = time.time()
     try:
       result = self.bus.read_byte_data(self.address, reg)
       if self.debug:
@@ -117,9 +142,12 @@ class Adafruit_I2C(object):
       return result
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("readU8", reg, 1, start)
 
   def readS8(self, reg):
     "Reads a signed byte from the I2C device"
+    start = time.time()
     try:
       result = self.bus.read_byte_data(self.address, reg)
       if result > 127: result -= 256
@@ -129,9 +157,12 @@ class Adafruit_I2C(object):
       return result
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("readS8", reg, 1, start)
 
   def readU16(self, reg, little_endian=True):
     "Reads an unsigned 16-bit value from the I2C device"
+    start = time.time()
     try:
       result = self.bus.read_word_data(self.address,reg)
       # Swap bytes if using big endian because read_word_data assumes little 
@@ -143,6 +174,8 @@ class Adafruit_I2C(object):
       return result
     except IOError, err:
       return self.errMsg()
+    finally:
+      self.record("readU16", reg, 2, start)
 
   def readS16(self, reg, little_endian=True):
     "Reads a signed 16-bit value from the I2C device"
@@ -2,7 +2,11 @@
 
 import time
 import math
+import threading
+import weakref
 from Adafruit_I2C import Adafruit_I2C
+import bus_stats
+from i2c_bus import I2CBus, get_bus
 
 # ============================================================================
 # Adafruit PCA9685 16-Channel PWM Servo Driver
@@ -27,35 +31,137 @@ class PWM :
 
   # Bits
   __RESTART            = 0x80
+  __AI                 = 0x20
   __SLEEP              = 0x10
   __ALLCALL            = 0x01
   __INVRT              = 0x10
   __OUTDRV             = 0x04
 
+  # Longest block write supported by SMBus, i.e. 8 channels.
+  __MAX_BLOCK_BYTES    = 32
+
   general_call_i2c = Adafruit_I2C(0x00)
+  # Drivers whose register shadow a software reset invalidates.
+  instances = weakref.WeakSet()
 
   @classmethod
   def softwareReset(cls):
     "Sends a software reset (SWRST) command to all the servo drivers on the bus"
     cls.general_call_i2c.writeRaw8(0x06)        # SWRST
+    for pwm in list(cls.instances):
+      pwm.clearShadow()
 
-  def __init__(self, address=0x40, debug=False):
-    self.i2c = Adafruit_I2C(address)
+  def __init__(self, address=0x40, debug=False, busnum=-1):
+    self.i2c = Adafruit_I2C(address, busnum)
     self.i2c.debug = debug
+    self.i2c.device_name = "pca9685@" + self.i2c.device_name
+    # Reads and writes the shadow saved the bus are counted under this name.
+    self.shadow_device_name = self.i2c.device_name + "/shadow"
     self.address = address
     self.debug = debug
+    # Every transaction goes through the scheduler of the bus.
+    self.bus = get_bus(busnum)
+    # Write-through copy of the registers of the chip. Writes of bytes the
+    # chip already holds are skipped and reads of known registers are served
+    # from here; nothing else writes to the chip. The driver is shared by the
+    # threads that drive its channels and a failed write is forgotten from
+    # the bus thread, so the shadow is only touched under shadow_lock.
+    self.shadow = {}
+    self.shadow_lock = threading.Lock()
+    self.shadow_hits = 0
+    self.shadow_misses = 0
+    self.writes = 0
+    self.suppressed_writes = 0
+    PWM.instances.add(self)
     if (self.debug):
       print "Reseting PCA9685 MODE1 (without SLEEP) and MODE2"
     self.setAllPWM(0, 0)
-    self.i2c.write8(self.__MODE2, self.__OUTDRV)
-    self.i2c.write8(self.__MODE1, self.__ALLCALL)
+    self.wait(self.writeRegisters(self.__MODE2, [self.__OUTDRV]))
+    # Auto-increment lets the four registers of a channel (and consecutive
+    # channels) be written with a single block write.
+    self.wait(self.writeRegisters(self.__MODE1, [self.__ALLCALL | self.__AI]))
     time.sleep(0.005)                                       # wait for oscillator
     
-    mode1 = self.i2c.readU8(self.__MODE1)
+    mode1 = self.readRegister(self.__MODE1)
     mode1 = mode1 & ~self.__SLEEP                 # wake up (reset sleep)
-    self.i2c.write8(self.__MODE1, mode1)
+    self.wait(self.writeRegisters(self.__MODE1, [mode1]))
     time.sleep(0.005)                             # wait for oscillator
 
+  def clearShadow(self):
+    "Forgets every register value, e.g. after the chip was reset"
+    self.shadow_lock.acquire()
+    self.shadow.clear()
+    self.shadow_lock.release()
+
+  def getShadowStats(self):
+    "Returns the counters of the register shadow"
+    return {"hits": self.shadow_hits,
+            "misses": self.shadow_misses,
+            "writes": self.writes,
+            "suppressed_writes": self.suppressed_writes}
+
+  def readRegister(self, reg, priority=I2CBus.MOTION):
+    "Reads a register, from the shadow if its value is known"
+    self.shadow_lock.acquire()
+    try:
+      if reg in self.shadow:
+        self.shadow_hits += 1
+        bus_stats.record(self.shadow_device_name, "read", register=reg)
+        return self.shadow[reg]
+      self.shadow_misses += 1
+    finally:
+      self.shadow_lock.release()
+    value = self.bus.call(lambda: self.i2c.readU8(reg), priority)
+    if value != -1:
+      self.shadow_lock.acquire()
+      self.shadow[reg] = value
+      self.shadow_lock.release()
+    return value
+
+  def forgetRegisters(self, reg, count):
+    self.shadow_lock.acquire()
+    for i in range(0, count):
+      self.shadow.pop(reg + i, None)
+    self.shadow_lock.release()
+
+  def writeRegisters(self, reg, data, priority=I2CBus.MOTION, coalesce=False):
+    "Queues a write of data to consecutive registers from reg, skipping the bytes the chip already holds. Returns a BusFuture, or None if nothing had to be written"
+    # The compare, the submit and the update are one step, else a racing
+    # writer could skip bytes that are queued but not in the shadow yet.
+    self.shadow_lock.acquire()
+    try:
+      first = 0
+      while first < len(data) and self.shadow.get(reg + first) == data[first]:
+        first += 1
+      if first == len(data):
+        self.suppressed_writes += 1
+        bus_stats.record(self.shadow_device_name, "write", register=reg)
+        return None
+      last = len(data) - 1
+      while self.shadow.get(reg + last) == data[last]:
+        last -= 1
+      self.writes += 1
+      future = self.bus.submit_write(self.i2c, reg + first, list(data[first:last + 1]), priority, coalesce)
+      for i in range(first, last + 1):
+        self.shadow[reg + i] = data[i]
+      # RESTART clears itself once written.
+      if reg <= self.__MODE1 <= reg + last:
+        self.shadow[self.__MODE1] &= ~self.__RESTART
+    finally:
+      self.shadow_lock.release()
+    def forget_on_failure(future):
+      if future.value == -1:
+        self.forgetRegisters(reg + first, last - first + 1) # Unknown after a failed write.
+    # Outside the lock: a write that is already done runs this right away.
+    future.add_done_callback(forget_on_failure)
+    return future
+
+  @staticmethod
+  def wait(future):
+    "Waits for a write returned by writeRegisters"
+    if future is not None:
+      return future.result()
+
   def setPWMFreq(self, freq):
     "Sets the PWM frequency"
     prescaleval = 25000000.0    # 25MHz
@@ -69,24 +175,70 @@ class PWM :
     if (self.debug):
       print "Final pre-scale: %d" % prescale
 
-    oldmode = self.i2c.readU8(self.__MODE1);
+    self.shadow_lock.acquire()
+    curr_prescale = self.shadow.get(self.__PRESCALE)
+    self.shadow_lock.release()
+    if curr_prescale == int(math.floor(prescale)):
+      return                                      # Already running at freq.
+    oldmode = self.readRegister(self.__MODE1);
     newmode = (oldmode & 0x7F) | 0x10             # sleep
-    self.i2c.write8(self.__MODE1, newmode)        # go to sleep
-    self.i2c.write8(self.__PRESCALE, int(math.floor(prescale)))
-    self.i2c.write8(self.__MODE1, oldmode)
+    self.wait(self.writeRegisters(self.__MODE1, [newmode]))  # go to sleep
+    self.wait(self.writeRegisters(self.__PRESCALE, [int(math.floor(prescale))]))
+    self.wait(self.writeRegisters(self.__MODE1, [oldmode]))
     time.sleep(0.005)
-    self.i2c.write8(self.__MODE1, oldmode | 0x80)
+    self.wait(self.writeRegisters(self.__MODE1, [oldmode | 0x80]))
 
-  def setPWM(self, channel, on, off):
+  @staticmethod
+  def getPWMBytes(on, off):
+    "Returns the ON_L, ON_H, OFF_L and OFF_H register values of a channel"
+    return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+
+  def setPWM(self, channel, on, off, priority=I2CBus.MOTION):
     "Sets a single PWM channel"
-    self.i2c.write8(self.__LED0_ON_L+4*channel, on & 0xFF)
-    self.i2c.write8(self.__LED0_ON_H+4*channel, on >> 8)
-    self.i2c.write8(self.__LED0_OFF_L+4*channel, off & 0xFF)
-    self.i2c.write8(self.__LED0_OFF_H+4*channel, off >> 8)
+    self.wait(self.writeRegisters(self.__LED0_ON_L+4*channel, self.getPWMBytes(on, off), priority, True))
+
+  def setPWMMulti(self, channel_bytes, priority=I2CBus.MOTION, wait=True):
+    "Sets several PWM channels from a dict of channel to getPWMBytes, one block write per run of consecutive channels. Without wait, returns the BusFutures of the writes, which are merged with queued writes of the same channels"
+    futures = []
+    channels = sorted(channel_bytes.keys())
+    max_channels = self.__MAX_BLOCK_BYTES / 4
+    start = 0
+    while start < len(channels):
+      end = start + 1
+      while (end < len(channels) and end - start < max_channels and
+             channels[end] == channels[end - 1] + 1):
+        end += 1
+      data = []
+      for channel in channels[start:end]:
+        data.extend(channel_bytes[channel])
+      future = self.writeRegisters(self.__LED0_ON_L+4*channels[start], data, priority, True)
+      if future is not None:
+        futures.append(future)
+      start = end
+    if wait:
+      for future in futures:
+        future.result()
+    return futures
 
   def setAllPWM(self, on, off):
     "Sets a all PWM channels"
-    self.i2c.write8(self.__ALL_LED_ON_L, on & 0xFF)
-    self.i2c.write8(self.__ALL_LED_ON_H, on >> 8)
-    self.i2c.write8(self.__ALL_LED_OFF_L, off & 0xFF)
-    self.i2c.write8(self.__ALL_LED_OFF_H, off >> 8)
+    data = self.getPWMBytes(on, off)
+    # One write per register: this also runs before MODE1 turns on
+    # auto-increment (and after a software reset clears it), when a block
+    # write would put all four bytes into ALL_LED_ON_L.
+    futures = []
+    for i in range(0, 4):
+      self.writes += 1
+      futures.append(self.bus.submit_write(self.i2c, self.__ALL_LED_ON_L + i, [data[i]], I2CBus.ACTUATION))
+    for future in futures:
+      future.result()
+    # The broadcast changes every channel without anything confirming what
+    # they hold now, so their registers are unknown until written per
+    # channel; a suppressed write must never hide a wrong value on the chip.
+    # Not locked across the wait, the bus thread takes the lock to forget
+    # failed writes.
+    self.shadow_lock.acquire()
+    for channel in range(0, 16):
+      for i in range(0, 4):
+        self.shadow.pop(self.__LED0_ON_L+4*channel+i, None)
+    self.shadow_lock.release()
@@ -1,2 +1,2 @@
-__all__ = ['stepper','servo_driver', 'servo_gpio', 'modules/drivers/Adafruit_PWM_Servo_Driver.py']
+__all__ = ['clock', 'stepper', 'motion_profile', 'step_waveform', 'motion_worker', 'gpio', 'i2c_bus', 'bus_stats', 'servo_driver', 'servo_gpio', 'modules/drivers/Adafruit_PWM_Servo_Driver.py']
 
@@ -0,0 +1,139 @@
+import collections
+import sys
+import threading
+import time
+
+# Counts the operations on the GPIO pins and I2C devices: the number of
+# operations, the bytes moved and the secs spent in them, per device and per
+# caller. The caller is whatever the thread doing the operation was tagged
+# with (see set_caller), else the name of the thread; transactions run by an
+# I2CBus are counted for the thread that queued them.
+#
+# Optionally every operation is also kept, timestamped, in a ring buffer that
+# can be dumped after a run:
+#   bus_stats.enable_trace(10000)
+#   ...
+#   bus_stats.dump_trace()
+#
+# Per operation deltas:
+#   before = bus_stats.get_counters()
+#   ...
+#   print bus_stats.format_counters(bus_stats.get_delta(before))
+
+# (device, caller) -> [operations, bytes, secs]
+counters = {}
+counters_lock = threading.Lock()
+# Entries are (time, device, caller, operation, register, bytes, secs).
+trace = None
+callers = threading.local()
+
+def set_caller(caller):
+  """ Tags the operations of the current thread with caller (None for the
+      name of the thread). Returns the previous tag. """
+  previous = getattr(callers, 'caller', None)
+  callers.caller = caller
+  return previous
+
+def get_caller():
+  caller = getattr(callers, 'caller', None)
+  if caller is None:
+    return threading.current_thread().name
+  return caller
+
+def record(device, operation, num_ops=1, num_bytes=0, secs=0.0, register=None, caller=None):
+  """ Counts num_ops operations on device. """
+  if caller is None:
+    caller = get_caller()
+  key = (device, caller)
+  counters_lock.acquire()
+  counter = counters.get(key)
+  if counter is None:
+    counter = [0, 0, 0.0]
+    counters[key] = counter
+  counter[0] += num_ops
+  counter[1] += num_bytes
+  counter[2] += secs
+  counters_lock.release()
+  if trace is not None:
+    trace.append((time.time(), device, caller, operation, register, num_bytes, secs))
+
+def get_counters():
+  """ Returns a copy of the counters: (device, caller) -> (operations, bytes,
+      secs). """
+  counters_lock.acquire()
+  try:
+    return dict([(key, tuple(counter)) for (key, counter) in counters.items()])
+  finally:
+    counters_lock.release()
+
+def get_delta(before, after=None):
+  """ Counters that changed from before to after (by default now). """
+  if after is None:
+    after = get_counters()
+  delta = {}
+  for (key, (num_ops, num_bytes, secs)) in after.items():
+    (ops_before, bytes_before, secs_before) = before.get(key, (0, 0, 0.0))
+    if num_ops != ops_before:
+      delta[key] = (num_ops - ops_before, num_bytes - bytes_before, secs - secs_before)
+  return delta
+
+def get_totals(counters_by_key):
+  """ Returns (operations, bytes, secs) over all devices and callers. """
+  totals = [0, 0, 0.0]
+  for counter in counters_by_key.values():
+    for i in range(0, 3):
+      totals[i] += counter[i]
+  return tuple(totals)
+
+def format_counters(counters_by_key):
+  lines = []
+  for ((device, caller), (num_ops, num_bytes, secs)) in sorted(counters_by_key.items()):
+    lines.append("%-24s %-20s %8d ops %8d bytes %9.3f msecs" % (device, caller, num_ops, num_bytes, 1000 * secs))
+  return "\n".join(lines)
+
+def reset():
+  counters_lock.acquire()
+  counters.clear()
+  counters_lock.release()
+  if trace is not None:
+    trace.clear()
+
+def enable_trace(size=10000):
+  """ Keeps the last size operations. """
+  global trace
+  trace = collections.deque(maxlen=size)
+
+def disable_trace():
+  global trace
+  trace = None
+
+def get_trace():
+  if trace is None:
+    return []
+  return list(trace)
+
+def dump_trace(out=None):
+  """ Writes the traced operations, oldest first, one per line. """
+  if out is None:
+    out = sys.stdout
+  entries = get_trace()
+  if len(entries) == 0:
+    return
+  start = entries[0][0]
+  for (t, device, caller, operation, register, num_bytes, secs) in entries:
+    out.write("%10.6f %-24s %-20s %-12s %4s %4d bytes %8.1f usecs\n" %
+              (t - start, device, caller, operation, "" if register is None else "0x%02X" % register,
+               num_bytes, 1e6 * secs))
+
+if (__name__ == "__main__"):
+  num_ops = 100000
+  start = time.time()
+  for i in xrange(num_ops):
+    record("gpio:8", "set_mask", secs=1e-6)
+  print "record: " + str((time.time() - start) * 1e6 / num_ops) + " usecs per operation"
+  enable_trace(1000)
+  start = time.time()
+  for i in xrange(num_ops):
+    record("gpio:8", "set_mask", secs=1e-6)
+  print "record with trace: " + str((time.time() - start) * 1e6 / num_ops) + " usecs per operation"
+  print format_counters(get_counters())
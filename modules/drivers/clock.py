@@ -0,0 +1,132 @@
+import ctypes
+import ctypes.util
+import threading
+import time
+
+# The clock every timed loop runs on: step deadlines, servo ticks, the PID
+# and filter sampling, stir sessions and the delays recorded in recipes.
+#   MonotonicClock - CLOCK_MONOTONIC: sub-microsecond resolution, and it does
+#                    not jump when the wall clock is set (default).
+#   VirtualClock   - Time that only moves when slept through or advanced, so
+#                    that the loops can be run faster than real time.
+# Usage: from drivers import clock (or import clock within drivers), then
+#   deadline = clock.now() + interval
+#   clock.sleep_until(deadline)
+# and clock.set_clock(clock.VirtualClock()) before starting anything to test.
+
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class MonotonicClock:
+  def __init__(self):
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    self.clock_gettime = librt.clock_gettime
+    self.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+  def now(self):
+    t = timespec()
+    if self.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, "clock_gettime failed")
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+  def sleep(self, secs):
+    if secs > 0:
+      time.sleep(secs)
+
+  def sleep_until(self, deadline, spin_threshold=0.0):
+    """ Waits until now() reaches deadline. Sleeps for all but the last
+        spin_threshold secs and busy waits for the rest, since a sleep can
+        overshoot by more than the time that is left. """
+    remaining = deadline - self.now()
+    if remaining > spin_threshold:
+      time.sleep(remaining - spin_threshold)
+    while self.now() < deadline:
+      pass
+
+
+class VirtualClock:
+  """ A clock for tests. With auto_advance a sleep moves the time to its end
+      and returns right away, so a single timed loop runs as fast as it can.
+      Otherwise sleepers block until advance (or set_time) moves the time past
+      the end of their sleep, which keeps several threads in step. """
+
+  def __init__(self, start=0.0, auto_advance=True):
+    self.time = float(start)
+    self.auto_advance = auto_advance
+    self.lock = threading.Lock()
+    self.time_changed = threading.Condition(self.lock)
+
+  def now(self):
+    return self.time
+
+  def set_time(self, new_time):
+    self.lock.acquire()
+    if new_time > self.time:
+      self.time = new_time
+      self.time_changed.notify_all()
+    self.lock.release()
+
+  def advance(self, secs):
+    self.set_time(self.time + secs)
+
+  def sleep(self, secs):
+    self.sleep_until(self.time + secs)
+
+  def run(self, secs, step):
+    """ Advances the time by secs, step secs at a time, giving the threads
+        woken by each step a moment of real time to run up to their next
+        sleep. """
+    end = self.time + secs
+    while self.time < end:
+      self.set_time(min(end, self.time + step))
+      time.sleep(0.001)
+
+  def sleep_until(self, deadline, spin_threshold=0.0):
+    if self.auto_advance:
+      self.set_time(deadline)
+      return
+    self.lock.acquire()
+    while self.time < deadline:
+      self.time_changed.wait()
+    self.lock.release()
+
+
+clock = MonotonicClock()
+
+def set_clock(new_clock):
+  """ Selects the clock of the whole process. Call before anything timed
+      starts. """
+  global clock
+  clock = new_clock
+
+def get_clock():
+  return clock
+
+def now():
+  """ Monotonic time in secs. Only differences between values mean anything. """
+  return clock.now()
+
+def sleep(secs):
+  clock.sleep(secs)
+
+def sleep_until(deadline, spin_threshold=0.0):
+  """ Waits until now() reaches deadline. """
+  clock.sleep_until(deadline, spin_threshold)
+
+if (__name__ == "__main__"):
+  num_calls = 100000
+  start = time.time()
+  for i in xrange(num_calls):
+    now()
+  print "now: " + str((time.time() - start) * 1e6 / num_calls) + " usecs per call"
+  errors = []
+  for i in range(0, 100):
+    deadline = now() + 0.002
+    sleep_until(deadline, 0.0005)
+    errors.append(now() - deadline)
+  print "sleep_until: mean overshoot " + str(1e6 * sum(errors) / len(errors)) + " usecs, max " + \
+        str(1e6 * max(errors)) + " usecs"
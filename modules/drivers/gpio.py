@@ -0,0 +1,246 @@
+import bus_stats
+import ctypes
+import mmap
+import os
+import threading
+import time
+
+# Drop in replacement for the parts of RPi.GPIO used by the steppers, pumps
+# and the stove switch, backed by one of:
+#   RPiGPIOBackend  - RPi.GPIO itself, one call per pin (default).
+#   MmapGPIOBackend - The GPIO registers of the SoC mapped from /dev/gpiomem.
+#                     Any number of pins of bank 0 (BCM 0-31) are raised or
+#                     lowered with a single 32 bit store.
+#   FileGPIOBackend - The same register layout in a plain file, so that it
+#                     can be used (and inspected) on any Linux box.
+# Usage: import gpio as GPIO (or from drivers import gpio as GPIO).
+
+# Same values as RPi.GPIO.
+BCM = 11
+OUT = 0
+IN = 1
+HIGH = 1
+LOW = 0
+
+# Register offsets (in bytes) of the BCM2835 GPIO block.
+GPFSEL0 = 0x00
+GPSET0 = 0x1C
+GPCLR0 = 0x28
+GPLEV0 = 0x34
+GPIO_BLOCK_SIZE = 4096
+
+def get_pins(pins):
+  if isinstance(pins, (list, tuple)):
+    return pins
+  return [pins]
+
+def pins_to_mask(pins):
+  mask = 0
+  for pin in get_pins(pins):
+    if pin < 0 or pin > 31:
+      raise ValueError("Only BCM pins 0-31 are supported:" + str(pin))
+    mask |= 1 << pin
+  return mask
+
+
+class RPiGPIOBackend:
+  def __init__(self):
+    import RPi.GPIO
+    self.GPIO = RPi.GPIO
+    self.pins_for_mask = {}
+
+  def setmode(self, mode):
+    self.GPIO.setmode(self.GPIO.BCM)
+
+  def setup(self, pin, mode):
+    if mode == OUT:
+      self.GPIO.setup(pin, self.GPIO.OUT)
+    else:
+      self.GPIO.setup(pin, self.GPIO.IN)
+
+  def output(self, pins, value):
+    self.GPIO.output(pins, self.GPIO.HIGH if value else self.GPIO.LOW)
+
+  def input(self, pin):
+    return self.GPIO.input(pin)
+
+  def get_pins(self, mask):
+    pins = self.pins_for_mask.get(mask)
+    if pins is None:
+      pins = mask_to_pin_list(mask)
+      self.pins_for_mask[mask] = pins
+    return pins
+
+  def set_mask(self, mask):
+    if mask:
+      self.GPIO.output(self.get_pins(mask), self.GPIO.HIGH)
+
+  def clear_mask(self, mask):
+    if mask:
+      self.GPIO.output(self.get_pins(mask), self.GPIO.LOW)
+
+
+class MmapGPIOBackend:
+  """ Drives the pins through the GPIO registers. Only the pins of bank 0
+      are supported, which covers every pin of the Pi header. """
+
+  def __init__(self, path='/dev/gpiomem'):
+    self.path = path
+    fd = os.open(path, os.O_RDWR | os.O_SYNC)
+    try:
+      self.mem = mmap.mmap(fd, GPIO_BLOCK_SIZE, mmap.MAP_SHARED,
+                           mmap.PROT_READ | mmap.PROT_WRITE)
+    finally:
+      os.close(fd)
+    # Each assignment to .value is a single 32 bit store.
+    self.gpset0 = ctypes.c_uint32.from_buffer(self.mem, GPSET0)
+    self.gpclr0 = ctypes.c_uint32.from_buffer(self.mem, GPCLR0)
+    self.gplev0 = ctypes.c_uint32.from_buffer(self.mem, GPLEV0)
+    # Function select is read-modify-write.
+    self.lock = threading.Lock()
+
+  def setmode(self, mode):
+    if mode != BCM:
+      raise ValueError("Only BCM pin numbering is supported")
+
+  def setup(self, pin, mode):
+    pins_to_mask(pin) # Validates pin.
+    fsel = ctypes.c_uint32.from_buffer(self.mem, GPFSEL0 + 4 * (pin // 10))
+    shift = (pin % 10) * 3
+    self.lock.acquire()
+    value = fsel.value & ~(7 << shift)
+    if mode == OUT:
+      value |= 1 << shift
+    fsel.value = value
+    self.lock.release()
+
+  def output(self, pins, value):
+    if value:
+      self.set_mask(pins_to_mask(pins))
+    else:
+      self.clear_mask(pins_to_mask(pins))
+
+  def input(self, pin):
+    return (self.gplev0.value >> pin) & 1
+
+  def set_mask(self, mask):
+    if mask:
+      self.gpset0.value = mask
+
+  def clear_mask(self, mask):
+    if mask:
+      self.gpclr0.value = mask
+
+
+class FileGPIOBackend(MmapGPIOBackend):
+  """ MmapGPIOBackend over a regular file. The file has the layout of the
+      GPIO block; since a file does not react to a write of the set and clear
+      registers, the level register is updated here as the SoC would. """
+
+  def __init__(self, path):
+    if not os.path.exists(path) or os.path.getsize(path) < GPIO_BLOCK_SIZE:
+      f = open(path, 'wb')
+      f.write('\0' * GPIO_BLOCK_SIZE)
+      f.close()
+    MmapGPIOBackend.__init__(self, path)
+
+  def set_mask(self, mask):
+    if mask:
+      self.gpset0.value = mask
+      self.gplev0.value |= mask
+
+  def clear_mask(self, mask):
+    if mask:
+      self.gpclr0.value = mask
+      self.gplev0.value &= ~mask
+
+  def get_function(self, pin):
+    fsel = ctypes.c_uint32.from_buffer(self.mem, GPFSEL0 + 4 * (pin // 10))
+    if (fsel.value >> ((pin % 10) * 3)) & 7 == 1:
+      return OUT
+    return IN
+
+
+def mask_to_pin_list(mask):
+  pins = []
+  pin = 0
+  while mask:
+    if mask & 1:
+      pins.append(pin)
+    mask >>= 1
+    pin += 1
+  return pins
+
+backend = None
+backend_lock = threading.Lock()
+
+def set_backend(new_backend):
+  """ Selects the backend used by the whole process. Call before any pin is
+      set up. """
+  global backend
+  backend = new_backend
+
+def get_backend():
+  global backend
+  if backend is None:
+    backend_lock.acquire()
+    if backend is None:
+      backend = RPiGPIOBackend()
+    backend_lock.release()
+  return backend
+
+def create_backend(name):
+  """ Backend from its name in the config: rpi, mmap or file:<path>. """
+  if name == 'rpi':
+    return RPiGPIOBackend()
+  elif name == 'mmap':
+    return MmapGPIOBackend()
+  elif name.startswith('file:'):
+    return FileGPIOBackend(name[len('file:'):])
+  raise ValueError("Unknown GPIO backend:" + str(name))
+
+# RPi.GPIO style functions.
+def setmode(mode):
+  get_backend().setmode(mode)
+
+def setup(pin, mode):
+  get_backend().setup(pin, mode)
+
+def output(pins, value):
+  start = time.time()
+  get_backend().output(pins, value)
+  bus_stats.record("gpio:" + str(pins), "output", secs=time.time() - start)
+
+def input(pin):
+  return get_backend().input(pin)
+
+def set_mask(mask):
+  """ Raises every pin of mask at once. """
+  get_backend().set_mask(mask)
+
+def clear_mask(mask):
+  """ Lowers every pin of mask at once. """
+  get_backend().clear_mask(mask)
+
+if (__name__ == "__main__"):
+  import tempfile
+  import time
+  path = os.path.join(tempfile.gettempdir(), 'gpiomem')
+  file_backend = FileGPIOBackend(path)
+  step_mask = pins_to_mask([8, 25, 10])
+  for pin in [8, 25, 10]:
+    file_backend.setup(pin, OUT)
+  num_edges = 100000
+  start = time.time()
+  for i in xrange(num_edges // 2):
+    file_backend.set_mask(step_mask)
+    file_backend.clear_mask(step_mask)
+  print "Mask writes: " + str((time.time() - start) * 1e6 / num_edges) + " usecs per edge (3 pins)"
+  start = time.time()
+  for i in xrange(num_edges // 2):
+    for pin in [8, 25, 10]:
+      file_backend.output(pin, HIGH)
+    for pin in [8, 25, 10]:
+      file_backend.output(pin, LOW)
+  print "Per pin writes: " + str((time.time() - start) * 1e6 / num_edges) + " usecs per edge (3 pins)"
+  os.remove(path)
@@ -0,0 +1,327 @@
+import bus_stats
+import heapq
+import threading
+import time
+
+# Owns an I2C bus: every transaction on the bus (servo driver writes, reads
+# of the temperature sensor) runs on the bus thread in order of priority, so
+# that threads no longer race for the bus and a safety read never waits
+# behind a queue of servo updates.
+#
+# Usage:
+#   bus = i2c_bus.get_bus(busnum)
+#   value = bus.call(lambda: sensor.read(), I2CBus.SAFETY)      # Blocking
+#   future = bus.submit_write(i2c, reg, data, I2CBus.MOTION)    # Future
+#   future.result()
+
+class BusFuture:
+  """ Result of a transaction queued on an I2CBus. """
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def set_result(self, value, error=None):
+    self.lock.acquire()
+    self.value = value
+    self.error = error
+    self.event.set()
+    callbacks = self.callbacks
+    self.callbacks = []
+    self.lock.release()
+    for callback in callbacks:
+      callback(self)
+
+  def add_done_callback(self, callback):
+    """ Calls callback(future) once the transaction is done (right away if
+        it already is), on the bus thread. """
+    self.lock.acquire()
+    if not self.event.is_set():
+      self.callbacks.append(callback)
+      self.lock.release()
+      return
+    self.lock.release()
+    callback(self)
+
+  def done(self):
+    return self.event.is_set()
+
+  def result(self, timeout=None):
+    """ Waits for the transaction and returns its result, raising whatever it
+        raised. """
+    if not self.event.wait(timeout):
+      raise IOError("I2C transaction did not complete in " + str(timeout) + " secs")
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+
+class BusRequest:
+  def __init__(self, priority, func, coalesce_key):
+    self.priority = priority
+    self.func = func
+    self.coalesce_key = coalesce_key
+    self.futures = []
+    self.submit_time = time.time()
+    self.started = False
+    # Its transactions are counted in bus_stats for the thread that queued it.
+    self.caller = bus_stats.get_caller()
+    # Register -> value of a coalesced write.
+    self.registers = {}
+
+
+class I2CBus(threading.Thread):
+  # Priorities. Lower values go first.
+  SAFETY = 0      # e.g. reading the temperature of the stove.
+  ACTUATION = 1   # e.g. turning the stove knob.
+  MOTION = 2      # Servo moves.
+  COSMETIC = 3    # Moves nothing waits for.
+  num_priorities = 4
+
+  # Longest block write supported by SMBus.
+  max_block_bytes = 32
+
+  def __init__(self, busnum):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.busnum = busnum
+    self.lock = threading.Lock()
+    self.has_work = threading.Condition(self.lock)
+    self.queue = []
+    self.seq = 0
+    self.pending_writes = {}
+    self.stopped = False
+    # Per priority: transactions, secs waited in the queue, max secs waited
+    # and secs spent on the bus.
+    self.num_transactions = [0] * I2CBus.num_priorities
+    self.total_wait_secs = [0.0] * I2CBus.num_priorities
+    self.max_wait_secs = [0.0] * I2CBus.num_priorities
+    self.bus_secs = [0.0] * I2CBus.num_priorities
+    self.coalesced_writes = 0
+
+  def push(self, request):
+    # Caller holds self.lock.
+    self.seq += 1
+    heapq.heappush(self.queue, (request.priority, self.seq, request))
+    self.has_work.notify()
+
+  def submit(self, func, priority=MOTION):
+    """ Queues func (called with exclusive use of the bus) and returns a
+        BusFuture of its result. """
+    future = BusFuture()
+    request = BusRequest(priority, func, None)
+    request.futures.append(future)
+    self.lock.acquire()
+    self.push(request)
+    self.lock.release()
+    return future
+
+  def call(self, func, priority=MOTION, timeout=None):
+    """ Runs func on the bus and returns its result. """
+    if threading.current_thread() is self:
+      return func() # Already on the bus; a nested call would deadlock.
+    return self.submit(func, priority).result(timeout)
+
+  def submit_write(self, i2c, reg, data, priority=MOTION, coalesce=False):
+    """ Queues a write of data to consecutive registers of the Adafruit_I2C
+        device i2c from reg. The future's result is -1 if the write failed.
+        With coalesce, the write is merged with a queued (not yet started)
+        coalescing write to the same device: a register written by both ends
+        up with the later value and is written once. Only use it for
+        registers that can be written in any order. """
+    future = BusFuture()
+    self.lock.acquire()
+    try:
+      key = (i2c.address, id(i2c))
+      request = self.pending_writes.get(key) if coalesce else None
+      if request is not None and not request.started:
+        self.coalesced_writes += 1
+        request.futures.append(future)
+        if priority < request.priority:
+          request.priority = priority
+          self.push(request) # The older entry is skipped once started.
+      else:
+        request = BusRequest(priority, None, key if coalesce else None)
+        request.func = lambda: self.write_registers(i2c, request.registers)
+        request.futures.append(future)
+        if coalesce:
+          self.pending_writes[key] = request
+        self.push(request)
+      for i in range(0, len(data)):
+        request.registers[reg + i] = data[i]
+    finally:
+      self.lock.release()
+    return future
+
+  def write_registers(self, i2c, registers):
+    """ Writes registers (register -> value) with a write per run of
+        consecutive registers. Returns -1 if any write failed. """
+    result = None
+    regs = sorted(registers.keys())
+    start = 0
+    while start < len(regs):
+      end = start + 1
+      while (end < len(regs) and end - start < I2CBus.max_block_bytes and
+             regs[end] == regs[end - 1] + 1):
+        end += 1
+      if end - start == 1:
+        write_result = i2c.write8(regs[start], registers[regs[start]])
+      else:
+        write_result = i2c.writeList(regs[start], [registers[reg] for reg in regs[start:end]])
+      if write_result == -1:
+        result = -1
+      start = end
+    return result
+
+  def run(self):
+    while True:
+      self.lock.acquire()
+      while len(self.queue) == 0 and not self.stopped:
+        self.has_work.wait()
+      if len(self.queue) == 0:
+        self.lock.release()
+        return # Stopping condition. Exits thread
+      (priority, seq, request) = heapq.heappop(self.queue)
+      if request.started:
+        self.lock.release()
+        continue # Queued again at a higher priority and already run.
+      request.started = True
+      if request.coalesce_key is not None and self.pending_writes.get(request.coalesce_key) is request:
+        del self.pending_writes[request.coalesce_key]
+      self.lock.release()
+      start = time.time()
+      value = None
+      error = None
+      previous_caller = bus_stats.set_caller(request.caller)
+      try:
+        value = request.func()
+      except Exception, e:
+        error = e
+      bus_stats.set_caller(previous_caller)
+      end = time.time()
+      self.lock.acquire()
+      wait_secs = start - request.submit_time
+      self.num_transactions[request.priority] += 1
+      self.total_wait_secs[request.priority] += wait_secs
+      self.max_wait_secs[request.priority] = max(self.max_wait_secs[request.priority], wait_secs)
+      self.bus_secs[request.priority] += end - start
+      self.lock.release()
+      for future in request.futures:
+        future.set_result(value, error)
+
+  def stop(self):
+    """ Runs what is queued and exits the bus thread. """
+    self.lock.acquire()
+    self.stopped = True
+    self.has_work.notify()
+    self.lock.release()
+
+  def get_stats(self):
+    """ Returns a dict per priority with the number of transactions, the
+        mean and max secs they waited in the queue and the secs spent on
+        the bus. """
+    self.lock.acquire()
+    try:
+      stats = {}
+      for priority in range(0, I2CBus.num_priorities):
+        count = self.num_transactions[priority]
+        stats[priority] = {"transactions": count,
+                           "mean_wait_secs": self.total_wait_secs[priority] / count if count else 0.0,
+                           "max_wait_secs": self.max_wait_secs[priority],
+                           "bus_secs": self.bus_secs[priority]}
+      return stats
+    finally:
+      self.lock.release()
+
+
+# One I2CBus per bus, shared by every device on it.
+buses = {}
+buses_lock = threading.Lock()
+
+def get_busnum(busnum):
+  """ Bus number of busnum, -1 being the default bus of the Pi. """
+  if busnum < 0:
+    from Adafruit_I2C import Adafruit_I2C
+    return Adafruit_I2C.getPiI2CBusNumber()
+  return busnum
+
+def get_bus(busnum=-1):
+  """ Returns the (started) I2CBus of bus busnum, -1 being the default bus
+      of the Pi. Each bus has its own thread, so transactions on different
+      buses overlap. """
+  busnum = get_busnum(busnum)
+  buses_lock.acquire()
+  try:
+    if busnum not in buses:
+      bus = I2CBus(busnum)
+      bus.start()
+      buses[busnum] = bus
+    return buses[busnum]
+  finally:
+    buses_lock.release()
+
+def run_throughput_benchmark(num_buses, updates_per_bus, transaction_secs):
+  """ Servo updates per second with num_buses buses, each with a driver
+      whose transactions take transaction_secs and a thread sending it
+      updates. Returns (updates per sec, secs). """
+  class SlowDevice:
+    address = 0x40
+    def write8(self, reg, value):
+      time.sleep(transaction_secs)
+    def writeList(self, reg, data):
+      time.sleep(transaction_secs)
+  buses = [I2CBus(busnum) for busnum in range(0, num_buses)]
+  for bus in buses:
+    bus.start()
+  def send_updates(bus):
+    device = SlowDevice()
+    for i in range(0, updates_per_bus):
+      bus.submit_write(device, 0x06 + 4 * (i % 16), [0, 0, i & 0xFF, 1]).result()
+  threads = [threading.Thread(target=send_updates, args=(bus,)) for bus in buses]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  secs = time.time() - start
+  for bus in buses:
+    bus.stop()
+    bus.join()
+  return (num_buses * updates_per_bus / secs, secs)
+
+if (__name__ == "__main__"):
+  # A slow device: each transaction takes 1 msec.
+  class SlowDevice:
+    address = 0x40
+    def write8(self, reg, value):
+      time.sleep(0.001)
+    def writeList(self, reg, data):
+      time.sleep(0.001)
+  bus = I2CBus(0)
+  bus.start()
+  device = SlowDevice()
+  futures = []
+  for i in range(0, 200):
+    futures.append(bus.submit_write(device, 0x08, [i & 0xFF, 0], I2CBus.COSMETIC, coalesce=True))
+    if i % 20 == 0:
+      futures.append(bus.submit(lambda: time.sleep(0.001), I2CBus.SAFETY))
+  for future in futures:
+    future.result()
+  bus.stop()
+  bus.join()
+  stats = bus.get_stats()
+  print "Coalesced " + str(bus.coalesced_writes) + " of 200 writes"
+  for priority in (I2CBus.SAFETY, I2CBus.COSMETIC):
+    print ("Priority %d: %d transactions, mean wait %.2f msecs, max wait %.2f msecs" %
+           (priority, stats[priority]["transactions"], 1000 * stats[priority]["mean_wait_secs"],
+            1000 * stats[priority]["max_wait_secs"]))
+  # Aggregate servo update rate with 1, 2 and 4 buses. A 4 byte block write
+  # at 100 kHz takes about 0.6 msecs.
+  (single_bus_rate, secs) = run_throughput_benchmark(1, 500, 0.0006)
+  for num_buses in (1, 2, 4):
+    (rate, secs) = run_throughput_benchmark(num_buses, 500, 0.0006)
+    print ("%d bus(es): %6.0f servo updates/sec (%.1fx)" %
+           (num_buses, rate, rate / single_bus_rate))
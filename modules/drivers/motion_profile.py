@@ -0,0 +1,255 @@
+from array import array
+from collections import OrderedDict
+import math
+import threading
+
+# Velocities are expressed in units/s, accelerations in units/s^2 and jerks in
+# units/s^3 where a unit is steps_per_unit steps. For a bare StepperMotor a
+# unit is one rotation.
+
+# Supported velocity profiles.
+TRAPEZOIDAL = 'trapezoidal'
+SCURVE = 's-curve'
+
+def trapezoidal_step_delays(num_steps, max_velocity, acceleration, initial_velocity,
+                            steps_per_unit, final_velocity=None):
+  """ Computes the delay (in secs) between the start of each step and the
+      start of the next one for a move of num_steps steps. The move starts at
+      initial_velocity, ramps up at acceleration until it reaches max_velocity
+      and ramps back down to final_velocity (initial_velocity by default) in
+      time to end the move at that speed.
+  """
+  delays = array('d')
+  if num_steps <= 0:
+    return delays
+  if final_velocity is None:
+    final_velocity = initial_velocity
+  max_velocity = float(max_velocity)
+  initial_velocity = min(float(initial_velocity), max_velocity)
+  final_velocity = min(float(final_velocity), max_velocity)
+  v0_squared = initial_velocity * initial_velocity
+  vf_squared = final_velocity * final_velocity
+  two_a_per_step = 2.0 * acceleration / steps_per_unit
+  last_step = num_steps - 1
+  for i in xrange(num_steps):
+    velocity = min(math.sqrt(v0_squared + two_a_per_step * i),
+                   math.sqrt(vf_squared + two_a_per_step * (last_step - i)),
+                   max_velocity)
+    delays.append(1.0 / (velocity * steps_per_unit))
+  return delays
+
+def get_trapezoidal_move_time(distance, max_velocity, acceleration, initial_velocity):
+  """ Closed form duration of a trapezoidal move of distance that starts and
+      ends at initial_velocity. Close to sum(trapezoidal_step_delays(...))
+      without building the table. """
+  if distance <= 0:
+    return 0.0
+  initial_velocity = min(initial_velocity, max_velocity)
+  ramp_distance = (max_velocity * max_velocity - initial_velocity * initial_velocity) / (2.0 * acceleration)
+  if 2 * ramp_distance <= distance:
+    return 2 * (max_velocity - initial_velocity) / acceleration + (distance - 2 * ramp_distance) / max_velocity
+  peak_velocity = math.sqrt(initial_velocity * initial_velocity + acceleration * distance)
+  return 2 * (peak_velocity - initial_velocity) / acceleration
+
+def get_scurve_ramp_times(v0, v1, acceleration, jerk):
+  """ Returns (jerk time, constant acceleration time, peak acceleration) of a
+      jerk limited ramp from v0 to v1. The acceleration rises linearly for
+      the jerk time, holds and then falls linearly for the jerk time. """
+  dv = v1 - v0
+  if dv <= 0:
+    return (0.0, 0.0, 0.0)
+  if dv >= (acceleration * acceleration) / jerk:
+    jerk_time = acceleration / jerk
+    return (jerk_time, (dv / acceleration) - jerk_time, acceleration)
+  # Too short to reach the acceleration limit.
+  jerk_time = math.sqrt(dv / jerk)
+  return (jerk_time, 0.0, jerk * jerk_time)
+
+def get_scurve_ramp_distance(v0, v1, acceleration, jerk):
+  (jerk_time, accel_time, peak_acceleration) = get_scurve_ramp_times(v0, v1, acceleration, jerk)
+  # The acceleration curve is symmetric so the mean velocity is (v0 + v1)/2.
+  return 0.5 * (v0 + v1) * (2 * jerk_time + accel_time)
+
+def get_scurve_velocity(t, v0, jerk_time, accel_time, peak_acceleration, jerk):
+  if t < jerk_time:
+    return v0 + 0.5 * jerk * t * t
+  v_jerk_end = v0 + 0.5 * peak_acceleration * jerk_time
+  if t < jerk_time + accel_time:
+    return v_jerk_end + peak_acceleration * (t - jerk_time)
+  t_down = min(t - jerk_time - accel_time, jerk_time)
+  v_accel_end = v_jerk_end + peak_acceleration * accel_time
+  return v_accel_end + peak_acceleration * t_down - 0.5 * jerk * t_down * t_down
+
+def get_scurve_ramp_velocities(num_steps, v0, v1, acceleration, jerk, steps_per_unit):
+  """ Returns the velocity at each of the first num_steps steps of a jerk
+      limited ramp from v0 to v1. Steps past the end of the ramp run at v1. """
+  (jerk_time, accel_time, peak_acceleration) = get_scurve_ramp_times(v0, v1, acceleration, jerk)
+  ramp_time = 2 * jerk_time + accel_time
+  # Integrate position at a quarter of the fastest step period.
+  dt = 0.25 / (v1 * steps_per_unit)
+  step_distance = 1.0 / steps_per_unit
+  velocities = array('d')
+  t = 0.0
+  distance = 0.0
+  velocity = v0
+  next_step_distance = 0.0
+  while len(velocities) < num_steps:
+    if distance >= next_step_distance:
+      velocities.append(velocity)
+      next_step_distance += step_distance
+    elif t >= ramp_time:
+      velocities.append(v1)
+    else:
+      t += dt
+      new_velocity = get_scurve_velocity(t, v0, jerk_time, accel_time, peak_acceleration, jerk)
+      distance += 0.5 * (velocity + new_velocity) * dt
+      velocity = new_velocity
+  return velocities
+
+def scurve_step_delays(num_steps, max_velocity, acceleration, initial_velocity,
+                       steps_per_unit, jerk):
+  """ Like trapezoidal_step_delays but the acceleration is ramped in and out
+      at jerk, so the motor never sees a step change in acceleration. Short
+      moves peak at a lower velocity so that the ramp up finishes by the
+      halfway point. """
+  delays = array('d')
+  if num_steps <= 0:
+    return delays
+  max_velocity = float(max_velocity)
+  initial_velocity = min(float(initial_velocity), max_velocity)
+  half_distance = (num_steps // 2) / float(steps_per_unit)
+  peak_velocity = max_velocity
+  if get_scurve_ramp_distance(initial_velocity, peak_velocity, acceleration, jerk) > half_distance:
+    low = initial_velocity
+    high = max_velocity
+    for i in range(0, 30):
+      mid = 0.5 * (low + high)
+      if get_scurve_ramp_distance(initial_velocity, mid, acceleration, jerk) > half_distance:
+        high = mid
+      else:
+        low = mid
+    peak_velocity = low
+  ramp = get_scurve_ramp_velocities((num_steps + 1) // 2, initial_velocity, peak_velocity,
+                                    acceleration, jerk, steps_per_unit)
+  last_step = num_steps - 1
+  for i in xrange(num_steps):
+    velocity = ramp[min(i, last_step - i)]
+    delays.append(1.0 / (velocity * steps_per_unit))
+  return delays
+
+def ramp_down_delays(step_delays, steps_taken):
+  """ Returns the delays needed to come to a stop from the speed reached
+      after the first steps_taken steps of a move timed by step_delays. """
+  ramp = array('d')
+  if steps_taken <= 0:
+    return ramp
+  current_delay = step_delays[steps_taken - 1]
+  # Every step of the ramp up that was slower than the current speed is
+  # replayed in reverse.
+  for delay in step_delays:
+    if delay <= current_delay or len(ramp) >= steps_taken:
+      break
+    ramp.append(delay)
+  ramp.reverse()
+  return ramp
+
+
+class LRUCache:
+  """ A bounded, thread safe map which evicts the least recently used entry
+      once max_entries is exceeded. """
+
+  def __init__(self, max_entries):
+    if max_entries < 1:
+      raise ValueError("LRUCache needs room for at least one entry:" + str(max_entries))
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    """ Returns the value cached for key or None if there is no such entry. """
+    self.lock.acquire()
+    try:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      # Re-insert to mark the entry as the most recently used.
+      self.entries[key] = value
+      self.hits += 1
+      return value
+    finally:
+      self.lock.release()
+
+  def put(self, key, value):
+    self.lock.acquire()
+    try:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    finally:
+      self.lock.release()
+
+  def get_or_compute(self, key, compute):
+    """ Returns the value cached for key, computing and caching it with
+        compute() on a miss. """
+    value = self.get(key)
+    if value is None:
+      value = compute()
+      self.put(key, value)
+    return value
+
+  def clear(self):
+    self.lock.acquire()
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
+    self.lock.release()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get_stats(self):
+    """ Returns (hits, misses, number of entries). """
+    return (self.hits, self.misses, len(self.entries))
+
+
+# Step timing tables shared by every stepper in the process. Moves of the same
+# length at the same speed (e.g. repeated stir strokes) replay the same table.
+step_delay_cache = LRUCache(64)
+
+def compute_step_delays(num_steps, max_velocity, acceleration, initial_velocity,
+                        steps_per_unit, profile, jerk, final_velocity):
+  if profile == TRAPEZOIDAL:
+    return trapezoidal_step_delays(num_steps, max_velocity, acceleration,
+                                   initial_velocity, steps_per_unit, final_velocity)
+  elif profile == SCURVE:
+    if final_velocity is not None and final_velocity != initial_velocity:
+      raise ValueError("S-curve moves have to start and end at the same velocity")
+    return scurve_step_delays(num_steps, max_velocity, acceleration,
+                              initial_velocity, steps_per_unit, jerk)
+  raise ValueError("Unknown motion profile:" + str(profile))
+
+def get_step_delays(num_steps, max_velocity, acceleration, initial_velocity, steps_per_unit,
+                    profile=TRAPEZOIDAL, jerk=None, final_velocity=None):
+  """ Cached step timing table for the given profile. jerk is only used by
+      the S-curve profile. final_velocity defaults to initial_velocity. The
+      returned array is shared and must not be modified by the caller. """
+  key = (num_steps, max_velocity, acceleration, initial_velocity, steps_per_unit, profile,
+         jerk, final_velocity)
+  return step_delay_cache.get_or_compute(key,
+      lambda: compute_step_delays(num_steps, max_velocity, acceleration,
+                                  initial_velocity, steps_per_unit, profile, jerk,
+                                  final_velocity))
+
+if (__name__ == "__main__"):
+  import time
+  start = time.time()
+  for i in range(0, 1000):
+    delays = get_step_delays(400, 2.5, 28.0, 0.6, 200)
+  print "1000 lookups took " + str(time.time() - start) + " secs"
+  print "Move time: " + str(sum(delays)) + " secs, cache stats: " + str(step_delay_cache.get_stats())
+  scurve_delays = get_step_delays(400, 2.5, 28.0, 0.6, 200, profile=SCURVE, jerk=280.0)
+  print "S-curve move time: " + str(sum(scurve_delays)) + " secs"
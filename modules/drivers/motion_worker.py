@@ -0,0 +1,299 @@
+from itertools import izip
+import ctypes
+import ctypes.util
+import motion_profile
+import multiprocessing
+import step_waveform
+import struct
+import threading
+import time
+
+# Runs the step timing in a separate process so that it does not share a GIL
+# with the PID controller, the filter threads, I2C traffic or the REPL.
+#
+# Each RemoteWaveformExecutor owns a channel to the worker. A channel is made
+# of shared memory only: a ring of command slots, a ring of reply slots, a
+# buffer that waveforms are copied into and a status block: the worker
+# publishes the edges done of the chunk playing, tagged with the seq of the
+# chunk, and the main process raises the stop flag. Each slot has one writer.
+
+class SharedRing:
+  """ Single producer, single consumer ring of fixed size slots in shared
+      memory. The semaphores count the free and used slots and also order the
+      writes of a slot before its read on the other side. """
+
+  slot_format = '<qiid' # seq, op, count, value
+  slot_size = struct.calcsize(slot_format)
+
+  def __init__(self, num_slots=16):
+    self.num_slots = num_slots
+    self.buffer = multiprocessing.RawArray(ctypes.c_char, num_slots * SharedRing.slot_size)
+    self.free_slots = multiprocessing.Semaphore(num_slots)
+    self.used_slots = multiprocessing.Semaphore(0)
+    # Each index is only ever used by one side.
+    self.write_index = 0
+    self.read_index = 0
+
+  def put(self, seq, op, count=0, value=0.0):
+    self.free_slots.acquire()
+    struct.pack_into(SharedRing.slot_format, self.buffer, self.write_index * SharedRing.slot_size,
+                     seq, op, count, value)
+    self.write_index = (self.write_index + 1) % self.num_slots
+    self.used_slots.release()
+
+  def get(self, timeout=None):
+    """ Returns (seq, op, count, value) or None on timeout. """
+    if timeout is None:
+      self.used_slots.acquire()
+    elif not self.used_slots.acquire(True, timeout):
+      return None
+    slot = struct.unpack_from(SharedRing.slot_format, self.buffer, self.read_index * SharedRing.slot_size)
+    self.read_index = (self.read_index + 1) % self.num_slots
+    self.free_slots.release()
+    return slot
+
+
+class WorkerChannel:
+  # Commands
+  EXECUTE = 1
+  STOP_WORKER = 2
+  REPLY = 3
+
+  # Slots of the status block
+  EDGES_DONE = 0     # Written by the worker.
+  STOP_REQUESTED = 1 # Written by the main process.
+  EDGES_SEQ = 2      # Written by the worker, after EDGES_DONE.
+
+  def __init__(self, max_edges):
+    self.max_edges = max_edges
+    self.commands = SharedRing()
+    self.replies = SharedRing()
+    self.times = multiprocessing.RawArray(ctypes.c_double, max_edges)
+    self.set_masks = multiprocessing.RawArray(ctypes.c_ulong, max_edges)
+    self.clear_masks = multiprocessing.RawArray(ctypes.c_ulong, max_edges)
+    self.status = multiprocessing.RawArray(ctypes.c_long, 3)
+
+
+class RemoteWaveformExecutor(step_waveform.WaveformExecutor):
+  """ WaveformExecutor that plays waveforms on the motion worker process.
+      Waveforms longer than the channel buffer are sent in chunks. """
+
+  def __init__(self, worker, channel):
+    step_waveform.WaveformExecutor.__init__(self)
+    self.worker = worker
+    self.channel = channel
+    self.seq = 0
+    # Seq of the chunk playing, None between chunks.
+    self.chunk_seq = None
+    self.edges_before_chunk = 0
+    self.lock = threading.Lock()
+
+  def request_stop(self):
+    self.stop_requested = True
+    self.channel.status[WorkerChannel.STOP_REQUESTED] = 1
+
+  def clear_stop(self):
+    self.stop_requested = False
+    self.channel.status[WorkerChannel.STOP_REQUESTED] = 0
+
+  def get_edges_done(self):
+    # edges_before_chunk is read before chunk_seq: execute clears chunk_seq
+    # before adding the chunk to edges_before_chunk, so a chunk is never
+    # counted twice. The count is only used if it is of the chunk playing.
+    edges_before_chunk = self.edges_before_chunk
+    chunk_seq = self.chunk_seq
+    status = self.channel.status
+    if chunk_seq is None or status[WorkerChannel.EDGES_SEQ] != chunk_seq:
+      return edges_before_chunk
+    return edges_before_chunk + status[WorkerChannel.EDGES_DONE]
+
+  def execute(self, waveform):
+    channel = self.channel
+    self.lock.acquire()
+    try:
+      self.edges_done = 0
+      self.edges_before_chunk = 0
+      self.missed_deadlines = 0
+      num_edges = len(waveform)
+      start = 0
+      while start < num_edges and not self.stop_requested:
+        end = min(num_edges, start + channel.max_edges)
+        chunk_start_time = waveform.times[start]
+        if end < num_edges:
+          chunk_duration = waveform.times[end] - chunk_start_time
+        else:
+          chunk_duration = waveform.duration - chunk_start_time
+        for i in xrange(start, end):
+          channel.times[i - start] = waveform.times[i] - chunk_start_time
+        channel.set_masks[0:end - start] = waveform.set_masks[start:end]
+        channel.clear_masks[0:end - start] = waveform.clear_masks[start:end]
+        self.seq += 1
+        self.chunk_seq = self.seq
+        channel.commands.put(self.seq, WorkerChannel.EXECUTE, end - start, chunk_duration)
+        reply = channel.replies.get(0.5)
+        while reply is None:
+          if not self.worker.is_alive():
+            raise IOError("The motion worker process is not running")
+          reply = channel.replies.get(0.5)
+        (seq, op, edges_done, missed) = reply
+        self.chunk_seq = None
+        self.edges_before_chunk += edges_done
+        self.edges_done = self.edges_before_chunk
+        self.missed_deadlines += int(missed)
+        if edges_done < end - start:
+          break
+        start = end
+      self.stop_requested = False
+      channel.status[WorkerChannel.STOP_REQUESTED] = 0
+      return self.edges_done
+    finally:
+      self.lock.release()
+
+
+class MotionWorker:
+  """ Owns the motion worker process. Create it (and call start) before
+      anything else starts threads, then hand get_executor to the modules
+      that move steppers, e.g.
+        Stirrer(..., waveform_executor_class=worker.get_executor)
+  """
+
+  def __init__(self, num_channels=4, max_edges_per_channel=65536, cpu=None, priority=None):
+    """
+        num_channels: Maximum number of executors handed out.
+        max_edges_per_channel: Size of the waveform buffer of a channel.
+        cpu: Optional CPU core the worker is pinned to.
+        priority: Optional SCHED_FIFO priority (1-99) of the worker. Needs
+                  root, like the GPIO access itself.
+    """
+    self.channels = [WorkerChannel(max_edges_per_channel) for i in range(0, num_channels)]
+    self.next_channel = 0
+    self.cpu = cpu
+    self.priority = priority
+    self.process = None
+
+  def start(self):
+    self.process = multiprocessing.Process(target=run_worker,
+                                           args=(self.channels, self.cpu, self.priority))
+    self.process.daemon = True
+    self.process.start()
+
+  def get_executor(self):
+    if self.next_channel >= len(self.channels):
+      raise ValueError("All " + str(len(self.channels)) + " motion worker channels are in use")
+    executor = RemoteWaveformExecutor(self, self.channels[self.next_channel])
+    self.next_channel += 1
+    return executor
+
+  def is_alive(self):
+    return self.process is not None and self.process.is_alive()
+
+  def stop(self):
+    if self.process is None:
+      return
+    for channel in self.channels:
+      channel.commands.put(0, WorkerChannel.STOP_WORKER)
+    self.process.join()
+    self.process = None
+
+
+# Worker process side.
+class sched_param(ctypes.Structure):
+  _fields_ = [('sched_priority', ctypes.c_int)]
+
+SCHED_FIFO = 1
+
+def set_realtime(cpu, priority):
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  if cpu is not None:
+    cpu_set = (ctypes.c_ulong * 16)()
+    cpu_set[cpu // (8 * ctypes.sizeof(ctypes.c_ulong))] = 1 << (cpu % (8 * ctypes.sizeof(ctypes.c_ulong)))
+    if libc.sched_setaffinity(0, ctypes.sizeof(cpu_set), ctypes.byref(cpu_set)) != 0:
+      print "Motion worker: could not pin to CPU " + str(cpu) + ", errno " + str(ctypes.get_errno())
+  if priority is not None:
+    param = sched_param(priority)
+    if libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) != 0:
+      print "Motion worker: could not set SCHED_FIFO priority " + str(priority) + ", errno " + str(ctypes.get_errno())
+
+
+class ChannelThread(threading.Thread):
+  """ Plays the waveforms sent on one channel. """
+
+  def __init__(self, channel, setup_pins):
+    threading.Thread.__init__(self)
+    self.channel = channel
+    self.setup_pins = setup_pins
+    self.executor = step_waveform.PythonWaveformExecutor()
+    # Seq of the chunk the edges done of the executor belong to.
+    self.seq = 0
+
+  def run(self):
+    channel = self.channel
+    while True:
+      (seq, op, count, value) = channel.commands.get()
+      if op == WorkerChannel.STOP_WORKER:
+        return # Stopping condition. Exits thread
+      waveform = step_waveform.Waveform()
+      waveform.times.extend(channel.times[0:count])
+      waveform.set_masks.extend(channel.set_masks[0:count])
+      waveform.clear_masks.extend(channel.clear_masks[0:count])
+      waveform.duration = value
+      self.setup_pins(waveform)
+      # Reset before the seq changes, so the monitor never publishes the
+      # count of the last chunk under the seq of this one.
+      self.executor.edges_done = 0
+      self.seq = seq
+      # Drops a stop the monitor may have forwarded after the last waveform.
+      self.executor.clear_stop()
+      if channel.status[WorkerChannel.STOP_REQUESTED]:
+        edges_done = 0
+      else:
+        edges_done = self.executor.execute(waveform)
+      channel.replies.put(seq, WorkerChannel.REPLY, edges_done, self.executor.get_missed_deadlines())
+
+
+def run_worker(channels, cpu, priority):
+  set_realtime(cpu, priority)
+  import gpio as GPIO
+  GPIO.setmode(GPIO.BCM)
+  pins_set_up = set()
+  lock = threading.Lock()
+
+  def setup_pins(waveform):
+    # Pins set up by the main process after the fork are not known here.
+    lock.acquire()
+    try:
+      mask = 0
+      for (set_mask, clear_mask) in izip(waveform.set_masks, waveform.clear_masks):
+        mask |= set_mask | clear_mask
+      for pin in step_waveform.mask_to_pins(mask):
+        if pin not in pins_set_up:
+          GPIO.setup(pin, GPIO.OUT)
+          pins_set_up.add(pin)
+    finally:
+      lock.release()
+
+  threads = [ChannelThread(channel, setup_pins) for channel in channels]
+  for thread in threads:
+    thread.start()
+  # Publishes the progress of every channel and forwards stop requests.
+  while any([thread.is_alive() for thread in threads]):
+    for thread in threads:
+      status = thread.channel.status
+      seq = thread.seq
+      status[WorkerChannel.EDGES_DONE] = thread.executor.get_edges_done()
+      status[WorkerChannel.EDGES_SEQ] = seq
+      if status[WorkerChannel.STOP_REQUESTED]:
+        thread.executor.request_stop()
+    time.sleep(0.005)
+
+if (__name__ == "__main__"):
+  worker = MotionWorker(num_channels=1, max_edges_per_channel=1000)
+  worker.start()
+  executor = worker.get_executor()
+  delays = motion_profile.get_step_delays(1600, 2.5, 28.0, 0.6, 200)
+  waveform = step_waveform.compile_steps(8, delays, 0.00001)
+  start = time.time()
+  edges_done = executor.execute(waveform)
+  print "Played " + str(edges_done) + " of " + str(len(waveform)) + " edges in " + str(time.time() - start) + \
+        " secs (planned " + str(waveform.duration) + "), missed deadlines: " + str(executor.get_missed_deadlines())
+  worker.stop()
@@ -1,6 +1,9 @@
 from Adafruit_PWM_Servo_Driver import PWM
+from i2c_bus import I2CBus, get_busnum
+import clock
 import RPi.GPIO as GPIO
-import time
+import math
+import threading
 
 # A Servo PWM has the following encoding,
 #  0.6millisecond pulse length is position 0
@@ -22,6 +25,74 @@ def get_pulse_lengths(freq, resolution):
     angle_to_quantile[angle] = int(quantile_required)
   return angle_to_quantile
 
+# Process wide, so that every Servo on a driver shares it (and its tables).
+drivers = {}
+pulse_tables = {}
+registry_lock = threading.Lock()
+# Servo channel -> (busnum, driver address, channel on the driver). Channels
+# without a route are on the driver at Servo.driver_address on the default
+# bus.
+channel_routes = {}
+
+def set_channel_route(channel, busnum, address, driver_channel=None):
+  """ Routes the servo channel (as configured for the lid, cups, etc) to
+      driver_channel (by default the same number) of the driver at address
+      on I2C bus busnum. Servos spread over drivers on several buses update
+      in parallel, one bus worker each. """
+  if driver_channel is None:
+    driver_channel = channel
+  if driver_channel < 0 or driver_channel > 15:
+    raise ValueError("A PCA9685 has channels 0-15:" + str(driver_channel))
+  channel_routes[channel] = (busnum, address, driver_channel)
+
+def get_channel_route(channel):
+  """ Returns (busnum, driver address, driver channel) of a servo channel. """
+  return channel_routes.get(channel, (-1, Servo.driver_address, channel))
+
+def parse_channel_route(value):
+  """ Parses a route from the config: <busnum>:<address>[:<driver channel>],
+      e.g. 3:0x41:0. """
+  fields = value.strip().split(":")
+  if len(fields) < 2 or len(fields) > 3:
+    raise ValueError("Servo route has to be <busnum>:<address>[:<driver channel>]:" + value)
+  route = (int(fields[0]), int(fields[1], 0))
+  if len(fields) == 3:
+    return route + (int(fields[2]),)
+  return route + (None,)
+
+def get_driver(address, busnum, freq):
+  """ Returns the PWM driver at address on I2C bus busnum (-1 for the
+      default bus). A driver is reset and set up only the first time it is
+      requested, since that glitches every channel already positioned. """
+  busnum = get_busnum(busnum)
+  key = (busnum, address)
+  registry_lock.acquire()
+  try:
+    if key not in drivers:
+      pwm = PWM(address, busnum=busnum)
+      pwm.setPWMFreq(freq)
+      drivers[key] = (pwm, freq)
+    (pwm, driver_freq) = drivers[key]
+    if driver_freq != freq:
+      raise ValueError("PWM driver 0x%02X is already running at %d Hz" % (address, driver_freq))
+    return pwm
+  finally:
+    registry_lock.release()
+
+def get_pulse_tables(freq, resolution):
+  """ Returns the (shared) angle to quantile and angle to register bytes
+      tables. """
+  key = (freq, resolution)
+  registry_lock.acquire()
+  try:
+    if key not in pulse_tables:
+      angle_to_quantile = get_pulse_lengths(freq, resolution)
+      pulse_tables[key] = (angle_to_quantile,
+                           [PWM.getPWMBytes(0, quantile) for quantile in angle_to_quantile])
+    return pulse_tables[key]
+  finally:
+    registry_lock.release()
+
 class Servo:
   """ Wrapper interface to a Servo."""
   driver_address = 0x40
@@ -31,26 +102,39 @@ class Servo:
   # expressed as the indices of these quantiles.
   driver_resolution = 4096
 
-  def __init__(self, driver_channel, init_pos=0, move_delay=0.01):
+  def __init__(self, driver_channel, init_pos=0, move_delay=0.01, driver_address=None, busnum=None,
+               priority=I2CBus.MOTION):
     """
         driver_channel: Provide the channel number (on the driver) of the Servo that this object represents.
+                        Unless driver_address or busnum are given, it is
+                        looked up in the channel routes (see set_channel_route).
         init_pos: A number between 0 and 180 that specifies the initial angle
         move_delay: parameter in the constructor
+        driver_address: I2C address of the driver. Defaults to Servo.driver_address.
+        busnum: I2C bus of the driver. -1 for the default bus.
+        priority: Priority of the writes of this Servo on the bus (see I2CBus).
     """
     self.move_delay = move_delay
     if (init_pos < 0 or init_pos > 180):
       raise ValueError("Initial position invalid:" + str(init_pos))
+    if driver_address is None and busnum is None:
+      (busnum, driver_address, driver_channel) = get_channel_route(driver_channel)
+    if driver_address is None:
+      driver_address = Servo.driver_address
+    if busnum is None:
+      busnum = -1
     self.driver_channel = driver_channel
-    self.pwm = PWM(Servo.driver_address)
-    self.pwm.setPWMFreq(Servo.pwm_freq)
-    self.angle_to_quantile = get_pulse_lengths(Servo.pwm_freq, Servo.driver_resolution)
+    self.priority = priority
+    self.pwm = get_driver(driver_address, busnum, Servo.pwm_freq)
+    # Pulse length and register values of the channel for each angle.
+    (self.angle_to_quantile, self.angle_to_bytes) = get_pulse_tables(Servo.pwm_freq, Servo.driver_resolution)
     self.set_angle(init_pos)
 
   def set_angle(self, angle):
     if (angle < 0 or angle > 180):
       raise ValueError("Destination position invalid:" + str(angle))
     self.curr_pos = angle
-    self.pwm.setPWM(self.driver_channel, 0, self.angle_to_quantile[angle])
+    self.pwm.setPWMMulti({self.driver_channel: self.angle_to_bytes[angle]}, self.priority)
 
   # Ensure that dest_angle is an int. Type check does not happen here.
   def move_to(self, dest_angle):
@@ -59,14 +143,94 @@ class Servo:
     direction = 1
     if (dest_angle < self.curr_pos):
       direction = -1
+    deadline = clock.now()
     for angle in range(self.curr_pos, dest_angle, direction):
       self.set_angle(angle)
-      time.sleep(self.move_delay)
+      deadline += self.move_delay
+      clock.sleep_until(deadline)
     self.set_angle(dest_angle)
 
   def get_current_pos(self):
     return self.curr_pos
 
+def set_angles(servo_angles, wait=True):
+  """ Sets the angles of several servos (a list of (Servo, angle)) at once.
+      The servos of each driver are updated with a burst of block writes
+      instead of a write per servo, at the highest priority among them.
+      Without wait, returns the BusFutures of the writes instead of waiting
+      for them. """
+  channel_bytes_for_driver = {}
+  priority_for_driver = {}
+  for (servo, angle) in servo_angles:
+    if (angle < 0 or angle > 180):
+      raise ValueError("Destination position invalid:" + str(angle))
+  for (servo, angle) in servo_angles:
+    servo.curr_pos = angle
+    channel_bytes_for_driver.setdefault(servo.pwm, {})[servo.driver_channel] = servo.angle_to_bytes[angle]
+    priority_for_driver[servo.pwm] = min(servo.priority, priority_for_driver.get(servo.pwm, servo.priority))
+  # Every driver is queued before waiting on any, so that the drivers on
+  # different buses are written in parallel.
+  futures = []
+  for (pwm, channel_bytes) in channel_bytes_for_driver.items():
+    futures.extend(pwm.setPWMMulti(channel_bytes, priority_for_driver[pwm], False))
+  if wait:
+    for future in futures:
+      future.result()
+  return futures
+
+def get_trajectory(start_angles, dest_angles, num_ticks):
+  """ Returns the angles of every servo at each of num_ticks equally spaced
+      ticks, moving all of them linearly from start_angles to dest_angles so
+      that they start and finish together. """
+  ticks = []
+  for tick in range(1, num_ticks + 1):
+    fraction = float(tick) / num_ticks
+    ticks.append([int(round(start + (dest - start) * fraction))
+                  for (start, dest) in zip(start_angles, dest_angles)])
+  return ticks
+
+def move_together(servo_angles, duration=None, max_rate=None, control_rate=None):
+  """ Moves several servos (a list of (Servo, dest_angle)) on one shared
+      timeline, updating every servo that changed with a single burst per
+      driver (see set_angles) at each tick.
+        duration: Secs the move takes.
+        max_rate: Else the fastest any servo moves in degrees/sec.
+        control_rate: Ticks per second. Defaults to the PWM frequency, as
+                      the servos do not see updates any faster.
+      Without duration and max_rate each servo keeps the speed of its
+      move_to (a degree per move_delay) and the slowest one sets the
+      duration. Returns the secs the move took. """
+  for (servo, dest_angle) in servo_angles:
+    if (dest_angle < 0 or dest_angle > 180):
+      raise ValueError("Destination position invalid:" + str(dest_angle))
+  start_angles = [servo.get_current_pos() for (servo, dest_angle) in servo_angles]
+  dest_angles = [int(dest_angle) for (servo, dest_angle) in servo_angles]
+  deltas = [abs(dest - start) for (start, dest) in zip(start_angles, dest_angles)]
+  if duration is None:
+    if max_rate is not None:
+      duration = float(max(deltas)) / max_rate
+    else:
+      duration = max([delta * servo.move_delay for (delta, (servo, dest_angle)) in zip(deltas, servo_angles)])
+  if control_rate is None:
+    control_rate = Servo.pwm_freq
+  num_ticks = max(1, int(math.ceil(duration * control_rate)))
+  start_time = clock.now()
+  curr_angles = start_angles
+  futures = []
+  for (tick, angles) in enumerate(get_trajectory(start_angles, dest_angles, num_ticks)):
+    changed = [(servo, angle) for ((servo, dest_angle), angle, curr_angle) in zip(servo_angles, angles, curr_angles)
+               if angle != curr_angle]
+    # A servo does not need the tick on time to the microsecond; no spinning.
+    clock.sleep_until(start_time + float(tick + 1) / control_rate)
+    if len(changed) > 0:
+      # Queued without waiting: if the bus falls behind, the writes of later
+      # ticks are merged into the queued ones.
+      futures.extend(set_angles(changed, False))
+    curr_angles = angles
+  for future in futures:
+    future.result()
+  return clock.now() - start_time
+
 if (__name__ == "__main__"):
   GPIO.setmode(GPIO.BCM)
   GPIO.setup(13, GPIO.OUT)
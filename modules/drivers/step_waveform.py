@@ -0,0 +1,276 @@
+from array import array
+from itertools import izip
+import clock
+import motion_profile
+import threading
+import time
+
+# A move is compiled into a Waveform: a list of timed edges, each of which
+# raises the pins in set_mask and lowers the pins in clear_mask (bit n is BCM
+# pin n). The whole batch is then handed to a WaveformExecutor, so the caller
+# does a constant amount of work per move whatever the number of steps.
+
+class Waveform:
+  """ Timed edge list for the step/dir pins of one or more steppers. Edge
+      times are in secs from the start of the waveform. """
+
+  def __init__(self):
+    self.times = array('d')
+    self.set_masks = array('L')
+    self.clear_masks = array('L')
+    self.duration = 0.0
+
+  def add_edge(self, t, set_mask, clear_mask):
+    self.times.append(t)
+    self.set_masks.append(set_mask)
+    self.clear_masks.append(clear_mask)
+
+  def add_pulses(self, step_masks, delays, pulse_width):
+    """ Appends one step pulse of width pulse_width per entry of step_masks
+        (skipping empty masks), each delays[i] secs after the previous one. """
+    t = self.duration
+    add_edge = self.add_edge
+    for (mask, delay) in izip(step_masks, delays):
+      if mask:
+        add_edge(t, mask, 0)
+        add_edge(t + pulse_width, 0, mask)
+      t += delay
+    self.duration = t
+
+  def __len__(self):
+    return len(self.times)
+
+  def count_steps(self, step_pin, num_edges=None, first_edge=0):
+    """ Returns the number of rising edges on step_pin in the first
+        num_edges edges (all of them by default), from edge first_edge on. """
+    if num_edges is None:
+      num_edges = len(self.times)
+    mask = 1 << step_pin
+    count = 0
+    for set_mask in self.set_masks[first_edge:num_edges]:
+      if set_mask & mask:
+        count += 1
+    return count
+
+def compile_steps(step_pin, step_delays, pulse_width):
+  """ Waveform for a single stepper taking one step per entry of
+      step_delays. """
+  waveform = Waveform()
+  waveform.add_pulses([1 << step_pin] * len(step_delays), step_delays, pulse_width)
+  return waveform
+
+# Compiled waveforms of cached step timing tables. Entries are keyed by the
+# identity of the table and hold a reference to it, so a key can not be
+# reused by another table while its entry is alive.
+compiled_steps_cache = motion_profile.LRUCache(64)
+
+def get_compiled_steps(step_pin, step_delays, pulse_width):
+  key = (step_pin, id(step_delays), pulse_width)
+  entry = compiled_steps_cache.get(key)
+  if entry is None or entry[0] is not step_delays:
+    entry = (step_delays, compile_steps(step_pin, step_delays, pulse_width))
+    compiled_steps_cache.put(key, entry)
+  return entry[1]
+
+def pins_to_mask(pins):
+  mask = 0
+  for pin in pins:
+    mask |= 1 << pin
+  return mask
+
+def mask_to_pins(mask):
+  pins = []
+  pin = 0
+  while mask:
+    if mask & 1:
+      pins.append(pin)
+    mask >>= 1
+    pin += 1
+  return tuple(pins)
+
+
+class WaveformExecutor:
+  """ Stop handling and counters shared by the waveform executors. Each one
+      adds execute(waveform), which plays the waveform and blocks until it
+      is done or stopped and returns the number of edges that were output.
+      An executor plays one waveform at a time; use one executor per thread
+      that moves steppers. """
+
+  def __init__(self):
+    self.stop_requested = False
+    self.edges_done = 0
+    self.missed_deadlines = 0
+
+  def request_stop(self):
+    """ Asks the waveform in progress (on another thread) to stop after the
+        current edge. A request made between waveforms stops the next one
+        right away unless it is cleared first. """
+    self.stop_requested = True
+
+  def clear_stop(self):
+    self.stop_requested = False
+
+  def get_edges_done(self):
+    """ Number of edges of the current (or last) waveform output so far. """
+    return self.edges_done
+
+  def get_missed_deadlines(self):
+    return self.missed_deadlines
+
+
+class PythonWaveformExecutor(WaveformExecutor):
+  """ Reference executor which outputs every edge from Python through the
+      gpio backend, scheduling each one against an absolute monotonic
+      deadline (see clock.sleep_until). A late edge re-anchors the schedule.
+      With the mmap backend each edge is a single register store. """
+
+  def __init__(self, spin_threshold=0.0015):
+    WaveformExecutor.__init__(self)
+    self.spin_threshold = spin_threshold
+
+  def execute(self, waveform):
+    # Imported here so that the other executors can be used off the Pi.
+    import gpio
+    now = clock.get_clock().now
+    sleep_until = clock.get_clock().sleep_until
+    spin_threshold = self.spin_threshold
+    set_mask = gpio.get_backend().set_mask
+    clear_mask = gpio.get_backend().clear_mask
+    self.edges_done = 0
+    missed = 0
+    start = now()
+    for (t, edge_set_mask, edge_clear_mask) in izip(waveform.times, waveform.set_masks, waveform.clear_masks):
+      if self.stop_requested:
+        break
+      deadline = start + t
+      curr_time = now()
+      if curr_time > deadline:
+        missed += 1
+        start += curr_time - deadline
+      else:
+        sleep_until(deadline, spin_threshold)
+      set_mask(edge_set_mask)
+      clear_mask(edge_clear_mask)
+      self.edges_done += 1
+    self.missed_deadlines = missed
+    self.stop_requested = False
+    return self.edges_done
+
+
+class SimulatedWaveformExecutor(WaveformExecutor):
+  """ Executor for tests. Nothing is output; the edges are applied to a
+      simulated pin state and virtual_time is advanced by the time they
+      take. If the process runs on a clock.VirtualClock, that clock is
+      advanced too; otherwise the executor optionally sleeps for
+      real_time_factor of the time. """
+
+  def __init__(self, real_time_factor=0.0):
+    WaveformExecutor.__init__(self)
+    self.real_time_factor = real_time_factor
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    self.pin_levels = 0
+    self.virtual_time = 0.0
+    self.rising_edges = {}
+    self.num_waveforms = 0
+    self.lock.release()
+
+  def execute(self, waveform):
+    self.edges_done = 0
+    self.lock.acquire()
+    try:
+      self.num_waveforms += 1
+      start = self.virtual_time
+      for (t, set_mask, clear_mask) in izip(waveform.times, waveform.set_masks, waveform.clear_masks):
+        if self.stop_requested:
+          break
+        rising = set_mask & ~self.pin_levels
+        for pin in mask_to_pins(rising):
+          self.rising_edges[pin] = self.rising_edges.get(pin, 0) + 1
+        self.pin_levels = (self.pin_levels | set_mask) & ~clear_mask
+        self.virtual_time = start + t
+        self.edges_done += 1
+      if self.edges_done == len(waveform):
+        self.virtual_time = start + waveform.duration
+      played_secs = self.virtual_time - start
+    finally:
+      self.stop_requested = False
+      self.lock.release()
+    process_clock = clock.get_clock()
+    if isinstance(process_clock, clock.VirtualClock):
+      process_clock.advance(played_secs)
+    elif self.real_time_factor > 0:
+      clock.sleep(self.real_time_factor * played_secs)
+    return self.edges_done
+
+  def get_steps(self, step_pin):
+    """ Number of rising edges seen on step_pin since the last reset. """
+    return self.rising_edges.get(step_pin, 0)
+
+  def get_pin_level(self, pin):
+    return (self.pin_levels >> pin) & 1
+
+
+class PigpioWaveformExecutor(WaveformExecutor):
+  """ Executor backed by the pigpio daemon, which plays the waveform from
+      DMA so the timing does not depend on Python at all. Needs pigpio
+      (sudo apt-get install pigpio python-pigpio; sudo pigpiod). Long
+      waveforms are split in chunks that are queued back to back. """
+
+  max_pulses_per_chunk = 4000
+
+  def __init__(self, host='localhost'):
+    WaveformExecutor.__init__(self)
+    import pigpio
+    self.pigpio = pigpio
+    self.pi = pigpio.pi(host)
+    if not self.pi.connected:
+      raise IOError("Cannot connect to the pigpio daemon on " + host)
+
+  def get_chunks(self, waveform):
+    pulse = self.pigpio.pulse
+    pulses = []
+    for i in xrange(len(waveform)):
+      if i + 1 < len(waveform):
+        next_time = waveform.times[i + 1]
+      else:
+        next_time = waveform.duration
+      delay_us = max(0, int(round((next_time - waveform.times[i]) * 1e6)))
+      pulses.append(pulse(waveform.set_masks[i], waveform.clear_masks[i], delay_us))
+      if len(pulses) == PigpioWaveformExecutor.max_pulses_per_chunk:
+        yield pulses
+        pulses = []
+    if pulses:
+      yield pulses
+
+  def execute(self, waveform):
+    """ A stop request is honoured between chunks so that edges_done stays
+        exact. """
+    pi = self.pi
+    self.edges_done = 0
+    previous_wave = None
+    previous_length = 0
+    for pulses in self.get_chunks(waveform):
+      if self.stop_requested:
+        break
+      pi.wave_add_generic(pulses)
+      wave = pi.wave_create()
+      # Starts as soon as the previous chunk is done.
+      pi.wave_send_using_mode(wave, self.pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+      if previous_wave is not None:
+        while pi.wave_tx_at() == previous_wave:
+          time.sleep(0.001)
+        pi.wave_delete(previous_wave)
+        self.edges_done += previous_length
+      previous_wave = wave
+      previous_length = len(pulses)
+    while pi.wave_tx_busy():
+      time.sleep(0.001)
+    if previous_wave is not None:
+      pi.wave_delete(previous_wave)
+      self.edges_done += previous_length
+    self.stop_requested = False
+    return self.edges_done
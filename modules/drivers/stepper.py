@@ -1,8 +1,8 @@
-import RPi.GPIO as GPIO
-import time
-
-def get_curr_time_in_secs():
-  return time.time()
+import bus_stats
+import clock
+import motion_profile
+import gpio as GPIO
+import step_waveform
 
 class StepperMotor:
   """ Wrapper interface to a stepper motor. """
@@ -11,12 +11,43 @@ class StepperMotor:
   min_delay_per_step = 0.001
   acceleration = 28.0 # revolutions/s^2
   initial_velocity = 0.6
+  # Used by deadline stepping. The drivers need a step pulse of at least 2us.
+  default_pulse_width = 0.00001
+  spin_threshold = 0.0015
 
-  def __init__(self, dir_pin, step_pin, enable_pin, speed=90):
+  def __init__(self, dir_pin, step_pin, enable_pin, speed=90,
+               deadline_stepping=False, pulse_width=default_pulse_width,
+               profile=motion_profile.TRAPEZOIDAL, acceleration=None, jerk=None,
+               executor=None):
+    """
+        deadline_stepping: Schedule every step edge against an absolute
+                           monotonic deadline instead of sleeping for a
+                           relative delay after each step.
+        pulse_width: Width (in secs) of the step pulse in deadline stepping.
+        profile: One of motion_profile.TRAPEZOIDAL or motion_profile.SCURVE.
+        acceleration: In revolutions/s^2. Defaults to StepperMotor.acceleration.
+        jerk: In revolutions/s^3. Only used (and required) by the S-curve profile.
+        executor: A step_waveform.WaveformExecutor. When set every move is
+                  compiled into a waveform and handed to it as one batch
+                  instead of being stepped from this thread.
+    """
     GPIO.setmode(GPIO.BCM)
     self.direction_pin = dir_pin
     self.step_pin = step_pin
     self.enable_pin = enable_pin
+    self.deadline_stepping = deadline_stepping
+    self.pulse_width = pulse_width
+    self.executor = executor
+    self.waveform_in_flight = None
+    self.missed_deadlines = 0
+    self.total_missed_deadlines = 0
+    # Steps taken so far in the current move. Read by other threads to track
+    # the position of a move in flight.
+    self.steps_taken = 0
+    self.stop_requested = False
+    # Whether the last rotate was stopped before taking all of its steps.
+    self.last_move_stopped = False
+    self.step_device = "gpio:" + str(step_pin)
     GPIO.setup(self.direction_pin, GPIO.OUT)
     GPIO.output(self.direction_pin, GPIO.LOW)
     GPIO.setup(self.step_pin, GPIO.OUT)
@@ -24,6 +55,7 @@ class StepperMotor:
     GPIO.setup(self.enable_pin, GPIO.OUT)
     self.disable()
     self.set_speed(speed)
+    self.set_motion_profile(profile, acceleration, jerk)
 
   def enable(self):
     GPIO.output(self.enable_pin, GPIO.LOW)
@@ -37,37 +69,177 @@ class StepperMotor:
     time_per_step = float(1.0)/steps_per_second
     return (time_per_step - StepperMotor.min_delay_per_step)
 
-  def rotate(self, dir_is_clockwise, num_rotations):
-    self.enable()
+  def set_direction(self, dir_is_clockwise):
     if dir_is_clockwise:
       GPIO.output(self.direction_pin, GPIO.HIGH)
     else:
       GPIO.output(self.direction_pin, GPIO.LOW)
 
+  def rotate(self, dir_is_clockwise, num_rotations):
+    self.enable()
+    self.set_direction(dir_is_clockwise)
+
     num_steps = int(num_rotations * StepperMotor.steps_per_rotation)
-    velocity = StepperMotor.initial_velocity
-    acc = StepperMotor.acceleration
-    prev_time = get_curr_time_in_secs()
-    half_way = num_steps / 2
-    deceleration_point = num_steps
-    for i in range(0, num_steps):
-      GPIO.output(self.step_pin, GPIO.HIGH)
-      time.sleep(0.001)
-      GPIO.output(self.step_pin, GPIO.LOW)
-      curr_time = get_curr_time_in_secs()
-      dt = curr_time - prev_time
-      prev_time = curr_time
-      velocity += acc * dt
-      step_delay = self.get_step_delay_from_speed(velocity)
-      time.sleep(step_delay)
-      # Once we've hit max velocity or accelerated upto halfway we
-      # set acceleration to 0.
-      if acc > 0 and (i >= half_way or velocity >= self.speed_rps):
-        acc = 0
-        deceleration_point = num_steps - i
-      if i >= deceleration_point:
-        acc = -StepperMotor.acceleration
-    return float(num_steps)/ StepperMotor.steps_per_rotation
+    # The whole ramp is precomputed (and usually cached), so the loop below
+    # only replays the delays.
+    step_delays = motion_profile.get_step_delays(num_steps, self.speed_rps,
+                                                 self.acceleration,
+                                                 StepperMotor.initial_velocity,
+                                                 StepperMotor.steps_per_rotation,
+                                                 self.profile, self.jerk)
+    self.steps_taken = 0
+    self.missed_deadlines = 0
+    self.run_steps(step_delays)
+    self.last_move_stopped = self.stop_requested
+    if self.stop_requested:
+      # Stopped early. Ramp back down from the current speed instead of
+      # stopping dead, which could lose steps.
+      self.clear_stop()
+      self.run_steps(motion_profile.ramp_down_delays(step_delays, self.steps_taken))
+    return float(self.steps_taken)/ StepperMotor.steps_per_rotation
+
+  def request_stop(self):
+    """ Asks a rotation in progress (on another thread) to ramp down and
+        stop early. """
+    self.stop_requested = True
+    if self.executor is not None:
+      self.executor.request_stop()
+
+  def clear_stop(self):
+    self.stop_requested = False
+    if self.executor is not None:
+      self.executor.clear_stop()
+
+  def get_steps_taken(self):
+    """ Steps taken so far in the current (or last) move. """
+    waveform = self.waveform_in_flight
+    if waveform is not None:
+      return self.steps_taken + waveform.count_steps(self.step_pin, self.executor.get_edges_done())
+    return self.steps_taken
+
+  def run_steps(self, step_delays):
+    if self.executor is not None:
+      self.run_waveform(step_delays)
+    elif self.deadline_stepping:
+      self.step_with_deadlines(step_delays)
+    else:
+      self.step_with_sleeps(step_delays)
+
+  def run_waveform(self, step_delays):
+    waveform = step_waveform.get_compiled_steps(self.step_pin, step_delays, self.pulse_width)
+    self.waveform_in_flight = waveform
+    try:
+      edges_done = self.executor.execute(waveform)
+    finally:
+      self.waveform_in_flight = None
+    self.steps_taken += waveform.count_steps(self.step_pin, edges_done)
+    # The executor times the edges, so there is no time to count here.
+    bus_stats.record(self.step_device, "waveform", edges_done)
+    # Make sure rotate ramps down if the executor was stopped part way.
+    if edges_done < len(waveform):
+      self.stop_requested = True
+    self.missed_deadlines += self.executor.get_missed_deadlines()
+    self.total_missed_deadlines += self.executor.get_missed_deadlines()
+
+  def step_with_sleeps(self, step_delays):
+    gpio_backend = GPIO.get_backend()
+    step_mask = 1 << self.step_pin
+    pulse_width = StepperMotor.min_delay_per_step
+    now = clock.get_clock().now
+    sleep = clock.get_clock().sleep
+    num_steps = 0
+    # The GPIO calls are only timed while tracing, to keep the step loop tight.
+    timed = bus_stats.trace is not None
+    gpio_secs = 0.0
+    for step_delay in step_delays:
+      if self.stop_requested:
+        break
+      if timed:
+        start = now()
+        gpio_backend.set_mask(step_mask)
+        gpio_secs += now() - start
+      else:
+        gpio_backend.set_mask(step_mask)
+      sleep(pulse_width)
+      if timed:
+        start = now()
+        gpio_backend.clear_mask(step_mask)
+        gpio_secs += now() - start
+      else:
+        gpio_backend.clear_mask(step_mask)
+      num_steps += 1
+      self.steps_taken += 1
+      if step_delay > pulse_width:
+        sleep(step_delay - pulse_width)
+    # Counted once per move, the loop is too tight for a record per edge.
+    bus_stats.record(self.step_device, "step", 2 * num_steps, secs=gpio_secs)
+
+  def step_with_deadlines(self, step_delays):
+    """ Starts step i at the absolute time start + sum(step_delays[:i]) so
+        that sleep overshoot does not add up over a long move. A step whose
+        deadline has already passed is counted as missed and the schedule is
+        re-anchored to it, so a late step never causes a burst of catch-up
+        steps faster than the profile allows. """
+    gpio_backend = GPIO.get_backend()
+    step_mask = 1 << self.step_pin
+    pulse_width = self.pulse_width
+    spin_threshold = StepperMotor.spin_threshold
+    missed = 0
+    num_steps = 0
+    timed = bus_stats.trace is not None
+    gpio_secs = 0.0
+    now = clock.get_clock().now
+    sleep_until = clock.get_clock().sleep_until
+    deadline = now()
+    for step_delay in step_delays:
+      if self.stop_requested:
+        break
+      if timed:
+        start = now()
+        gpio_backend.set_mask(step_mask)
+        gpio_secs += now() - start
+      else:
+        gpio_backend.set_mask(step_mask)
+      sleep_until(deadline + pulse_width, spin_threshold)
+      if timed:
+        start = now()
+        gpio_backend.clear_mask(step_mask)
+        gpio_secs += now() - start
+      else:
+        gpio_backend.clear_mask(step_mask)
+      num_steps += 1
+      self.steps_taken += 1
+      deadline += step_delay
+      curr_time = now()
+      if curr_time > deadline:
+        missed += 1
+        deadline = curr_time
+      else:
+        sleep_until(deadline, spin_threshold)
+    self.missed_deadlines += missed
+    self.total_missed_deadlines += missed
+    bus_stats.record(self.step_device, "step", 2 * num_steps, secs=gpio_secs)
+
+  def get_missed_deadlines(self):
+    """ Returns (deadlines missed in the last move, deadlines missed in total). """
+    return (self.missed_deadlines, self.total_missed_deadlines)
+
+  def set_motion_profile(self, profile, acceleration=None, jerk=None):
+    if profile == motion_profile.SCURVE and jerk is None:
+      raise ValueError("The S-curve profile needs a jerk limit")
+    if profile not in (motion_profile.TRAPEZOIDAL, motion_profile.SCURVE):
+      raise ValueError("Unknown motion profile:" + str(profile))
+    self.profile = profile
+    if acceleration is None:
+      acceleration = StepperMotor.acceleration
+    self.acceleration = float(acceleration)
+    self.jerk = None
+    if profile == motion_profile.SCURVE:
+      self.jerk = float(jerk)
+
+  def get_motion_profile(self):
+    """ Returns (profile, acceleration, jerk). """
+    return (self.profile, self.acceleration, self.jerk)
 
   def set_speed(self, speed):
     self.speed_rps = float(speed)/60
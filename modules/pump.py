@@ -1,5 +1,5 @@
-import RPi.GPIO as GPIO
-import time
+from drivers import gpio as GPIO
+from drivers import clock
 
 class Pump:
   """ Interface to a Pump."""
@@ -43,7 +43,7 @@ class Pump:
   def run_pump_for_msec(self, msec):
     secs = float(msec)/1000;
     self.open()
-    time.sleep(secs)
+    clock.sleep(secs)
     self.close()
 
   def prime(self):
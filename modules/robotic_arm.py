@@ -1,8 +1,9 @@
 from drivers.servo_driver import Servo
+import drivers.servo_driver as servo_driver
 import submodules.stepper_axis as stepper_axis
 
 from math import atan, degrees
-import time
+from drivers import clock
 
 class RoboticArm:
   # Dimensions of the Arm
@@ -37,6 +38,9 @@ class RoboticArm:
                       
   # Dimensions of the Rail
   max_rail_translation_mm = 520
+
+  # Speed (degrees/s) of the servos that move the claw in X and Z.
+  claw_xz_rate_deg_s = 30.0
   
   def __init__(self, rail_dir_pin, rail_step_pin, rail_enable_pin,
                base_servo_channel,
@@ -101,7 +105,7 @@ class RoboticArm:
         waits for a few seconds before straightening it up. """
     self.tipping_servo.move_to(180)
     # Wait a few seconds for the contents to drain out.
-    time.sleep(5)
+    clock.sleep(5)
     self.straighten_tipping_servo()
 
   def straighten_tipping_servo(self):
@@ -111,23 +115,11 @@ class RoboticArm:
   # Adjusts the three servos Vertical, Horizontal and Level servos to get the
   # required Z and X from to_pos.
   def execute_move_claw_xz(self, to_pos):
-    from_pos = (self.vertical_servo.get_current_pos(),
-                self.horizontal_servo.get_current_pos(),
-                self.level_servo.get_current_pos())
-    pos_delta = (to_pos[2] - from_pos[0],
-                 to_pos[3] - from_pos[1],
-                 to_pos[4] - from_pos[2])
-    max_delta = max(abs(pos_delta[0]), abs(pos_delta[1]), abs(pos_delta[2]))
-    for i in range(1, int(max_delta + 1)):
-      # Update each servo proportionally
-      update = [(float(i)/max_delta) * x for x in pos_delta]
-      new_pos = [int(update[j] + from_pos[j]) for j in range(0, len(from_pos))]
-      self.vertical_servo.move_to(new_pos[0])
-      self.horizontal_servo.move_to(new_pos[1])
-      self.level_servo.move_to(new_pos[2])
-    self.vertical_servo.move_to(to_pos[0])
-    self.horizontal_servo.move_to(to_pos[1])
-    self.level_servo.move_to(to_pos[2])
+    # The three servos move proportionally and arrive together.
+    servo_driver.move_together([(self.vertical_servo, to_pos[2]),
+                                (self.horizontal_servo, to_pos[3]),
+                                (self.level_servo, to_pos[4])],
+                               max_rate=RoboticArm.claw_xz_rate_deg_s)
     
   def move_to_cup(self, is_small_cup, cup_num):
     if is_small_cup:
@@ -1,4 +1,13 @@
+from drivers import clock
+from drivers import motion_profile
+from drivers import stepper
+import submodules.circular_path as circular_path
+import submodules.coordinated_motion as coordinated_motion
+import submodules.linear_stroke_planner as linear_stroke_planner
+import submodules.motion_planner as motion_planner
+import submodules.position_store as position_store
 import submodules.stepper_axis as stepper_axis
+import submodules.trajectory_validator as trajectory_validator
 import math
 import random
 import time
@@ -9,9 +18,6 @@ class PlatformPosition:
   LID = 3
   IN_BETWEEN = 4
 
-def get_curr_time_in_secs():
-  return time.mktime(time.localtime())
-
 class Stirrer:
   # Dimensions of the Rails
   max_x_rail_translation_mm = 345.0
@@ -37,13 +43,67 @@ class Stirrer:
 
   stirrer_width_mm = 60.0
 
+  # Speeds (rpm) and S-curve limits (revolutions/s^2 and revolutions/s^3) of
+  # the rail steppers. The jerk limited ramps allow higher limits than the
+  # trapezoidal ramp without stalling the loaded Z rail.
+  xy_rail_speed = 180
+  xy_rail_acceleration = 40.0
+  xy_rail_jerk = 400.0
+  z_rail_speed = 260
+  z_rail_acceleration = 40.0
+  z_rail_jerk = 400.0
+
+  # Limits along the path for coordinated (all axes together) moves. Each
+  # rail is additionally kept within the limits of its own stepper.
+  max_gantry_velocity_mm_s = 150.0
+  max_gantry_acceleration_mm_s2 = 900.0
+  # Allowed deviation from the corners of a stir path (see MotionPlanner).
+  junction_deviation_mm = 0.5
+
+  # Speeds (rpm) the rails are driven against their hard stops at when
+  # homing. The Z lead screw moves only 1/z_rotations_per_mm mm per
+  # revolution, so it needs a higher speed to rise in seconds (about 5 mm/s,
+  # still far slower than the X and Y belts at 60 rpm).
+  xy_homing_speed = 60
+  z_homing_speed = 240
+
   stirring_height = [3.0, 10.0, 20.0, 35.0, 60.0]
+  # Distances from the center of the utensil of the strokes of the original
+  # stir_linear. stir_linear now plans its strokes (see
+  # get_linear_stroke_order) from candidates linear_stroke_spacing_mm apart.
+  linear_stroke_offsets = [0 , 60, -60, -20, 20, 80, -80, -40, 40]
+  linear_stroke_spacing_mm = 5
+  # Maximum distance between a circular stroke and the chords it is run as.
+  circular_chord_tolerance_mm = 0.1
+  # How close to stir_for_seconds a stir session is planned to end.
+  stir_end_tolerance_secs = 0.05
+  # Circular strokes are at stir_radius_index / max_stir_radius_index of the
+  # radius of the utensil.
+  max_stir_radius_index = 5
+  # Radius indices swept by stir_circular when no radius index is given.
+  circular_sweep_radius_indices = [5, 4, 3, 2, 1, 2, 3 ,4]
+  # stir_spiral winds in from the outer to the inner radius index (and back
+  # out) over spiral_turns turns, i.e. covering the rings of stir_circular,
+  # at a constant speed along the path.
+  spiral_inner_radius_index = 1
+  spiral_outer_radius_index = 5
+  spiral_turns = 4
+  spiral_speed_mm_s = 120.0
   stir_start_gap = 5.0 # Distance from utensil wall where the stirrer starts a stroke.
   stir_stop_gap = 45.0 # Distance from utensil wall where the stirrer stops during a stroke.
 
   # Diameters of the three different all-clad utensils
   utensil_diameter_mm = [200.0, 215.0, 150.0]
 
+  # Waypoints of every stroke, keyed by (utensil_index, pattern, height_index,
+  # radius_index, direction). See get_stroke_plan.
+  LINEAR = 'linear'
+  CIRCULAR = 'circular'
+  SPIRAL = 'spiral'
+  LINEAR_ORDER = 'linear-order'
+  ZIGZAG_ORDER = 'zigzag-order'
+  stroke_plan_cache = motion_profile.LRUCache(512)
+
   platform_pos_for_cup = [( 310,  45), # SmallCup1
                           (  35,  52), # SmallCup2
                           ( 171,   0), # LargeCup1
@@ -52,21 +112,93 @@ class Stirrer:
   def __init__(self,
                x_rail_dir_pin, x_rail_step_pin, x_rail_enable_pin,
                y_rail_dir_pin, y_rail_step_pin, y_rail_enable_pin,
-               z_rail_dir_pin, z_rail_step_pin, z_rail_enable_pin):
+               z_rail_dir_pin, z_rail_step_pin, z_rail_enable_pin,
+               waveform_executor_class=None, position_file=None, position_max_age_secs=None):
+    """ waveform_executor_class: Optional step_waveform.WaveformExecutor
+        subclass. When set, each rail and the gantry get an instance and all
+        moves are handed to it as batched waveforms.
+        position_file: Optional file the rail positions are persisted in.
+        When set, the positions are restored from it at startup, or the rails
+        are homed if it is missing or stale, and shutdown does not have to
+        drive the platform back to base.
+        position_max_age_secs: See PositionStore. """
+    self.position_store = None
+    if position_file is not None:
+      self.position_store = position_store.PositionStore(position_file, position_max_age_secs)
+    executors = [None, None, None, None]
+    if waveform_executor_class is not None:
+      executors = [waveform_executor_class() for i in range(0, 4)]
     # TODO : Fill in values to the constructor below.
     self.x_rail = stepper_axis.StepperAxis(x_rail_dir_pin, x_rail_step_pin, x_rail_enable_pin,
-            Stirrer.max_x_rail_translation_mm, inc_clockwise=False, speed=150)
+            Stirrer.max_x_rail_translation_mm, inc_clockwise=False, speed=Stirrer.xy_rail_speed,
+            deadline_stepping=True, profile=motion_profile.SCURVE,
+            acceleration=Stirrer.xy_rail_acceleration, jerk=Stirrer.xy_rail_jerk,
+            executor=executors[0], position_store=self.position_store)
     self.y_rail = stepper_axis.StepperAxis(y_rail_dir_pin, y_rail_step_pin, y_rail_enable_pin,
-            Stirrer.max_y_rail_translation_mm, speed=150)
+            Stirrer.max_y_rail_translation_mm, speed=Stirrer.xy_rail_speed,
+            deadline_stepping=True, profile=motion_profile.SCURVE,
+            acceleration=Stirrer.xy_rail_acceleration, jerk=Stirrer.xy_rail_jerk,
+            executor=executors[1], position_store=self.position_store)
     self.z_rail = stepper_axis.StepperAxis(z_rail_dir_pin, z_rail_step_pin, z_rail_enable_pin,
             max_translation_mm=Stirrer.max_z_rail_translation_mm,
-            inc_clockwise=True, speed=220, rotations_per_mm=Stirrer.z_rotations_per_mm)
+            inc_clockwise=True, speed=Stirrer.z_rail_speed, rotations_per_mm=Stirrer.z_rotations_per_mm,
+            profile=motion_profile.SCURVE,
+            acceleration=Stirrer.z_rail_acceleration, jerk=Stirrer.z_rail_jerk,
+            executor=executors[2], position_store=self.position_store)
+    self.gantry = coordinated_motion.CoordinatedMotion([self.x_rail, self.y_rail, self.z_rail],
+                                                       Stirrer.max_gantry_velocity_mm_s,
+                                                       Stirrer.max_gantry_acceleration_mm_s2,
+                                                       executor=executors[3])
+    self.planner = motion_planner.MotionPlanner(self.gantry, Stirrer.junction_deviation_mm)
     self.platform_position = PlatformPosition.BASE
+    if self.position_store is not None:
+      self.restore_or_home()
 
   def disable(self):
     self.x_rail.disable()
     self.y_rail.disable()
     self.z_rail.disable()
+    self.save_position()
+
+  def get_rails_by_name(self):
+    return {"x": self.x_rail, "y": self.y_rail, "z": self.z_rail}
+
+  def save_position(self):
+    if self.position_store is not None:
+      rails = self.get_rails_by_name()
+      self.position_store.save(dict([(name, rail.get_curr_pos_mm()) for (name, rail) in rails.items()]))
+
+  def restore_or_home(self):
+    """ Restores the rail positions from the snapshot if it is valid and
+        homes all the rails otherwise. Returns True if the snapshot was used. """
+    rails = self.get_rails_by_name()
+    positions = self.position_store.load(dict([(name, rail.max_translation_mm) for (name, rail) in rails.items()]))
+    if positions is None:
+      self.home()
+      return False
+    for (name, rail) in rails.items():
+      rail.set_curr_pos_mm(positions[name])
+    self.platform_position = self.get_platform_position_at(positions["x"], positions["y"])
+    return True
+
+  def home(self):
+    """ Homes Z, then X and Y at the same time. The stirrer may be down in
+        the utensil (e.g. after a crash mid stir), so it is lifted clear
+        before the platform moves. """
+    self.z_rail.home_async(Stirrer.z_homing_speed).result()
+    futures = [rail.home_async(Stirrer.xy_homing_speed) for rail in (self.x_rail, self.y_rail)]
+    for future in futures:
+      future.result()
+    self.platform_position = PlatformPosition.BASE
+    self.disable()
+
+  def get_platform_position_at(self, x, y):
+    for (position, (pos_x, pos_y)) in [(PlatformPosition.BASE, (Stirrer.x_home_pos, Stirrer.y_home_pos)),
+                                       (PlatformPosition.UTENSIL, (Stirrer.x_utensil_pos, Stirrer.y_utensil_pos)),
+                                       (PlatformPosition.LID, (Stirrer.x_lid_utensil_pos, Stirrer.y_lid_utensil_pos))]:
+      if abs(x - pos_x) <= 2 and abs(y - pos_y) <= 2:
+        return position
+    return PlatformPosition.IN_BETWEEN
 
   def move_to2(self, dest_pos):
     start_pos = (self.x_rail.get_curr_pos_mm(), self.y_rail.get_curr_pos_mm(), self.z_rail.get_curr_pos_mm())
@@ -91,10 +223,112 @@ class Stirrer:
     self.x_rail.move_to(dest_pos[0])
     self.y_rail.move_to(dest_pos[1])
 
+  def move_linear(self, dest_pos):
+    """ Moves all three rails together along a straight line to dest_pos. """
+    self.gantry.move_to(dest_pos)
+
+  def move_along(self, waypoints):
+    """ Moves through all the waypoints as one continuous motion. """
+    self.planner.run_polyline(waypoints)
+
   def execute_stir_stroke(self, start_pos, end_pos):
-    self.move_to((start_pos[0], start_pos[1], start_pos[2]))
-    self.stirrer_down()
-    self.move_to((end_pos[0], end_pos[1], end_pos[2]))
+    self.move_along(self.get_stir_stroke_waypoints(start_pos, end_pos))
+
+  def get_stir_stroke_waypoints(self, start_pos, end_pos):
+    return [(start_pos[0], start_pos[1], start_pos[2]),
+            (start_pos[0], start_pos[1], Stirrer.z_down_pos),
+            (end_pos[0], end_pos[1], end_pos[2])]
+
+  def get_curr_pos(self):
+    return (self.x_rail.get_curr_pos_mm(), self.y_rail.get_curr_pos_mm(), self.z_rail.get_curr_pos_mm())
+
+  def plan_stroke(self, waypoints, start_pos):
+    """ Returns (planned segments, secs) of a move from start_pos through
+        waypoints. """
+    segments = self.planner.plan(waypoints, start_pos)
+    return (segments, self.planner.get_duration(segments))
+
+  def plan_shortened_stroke(self, waypoints, start_pos, max_secs):
+    """ Returns (planned segments, secs) of the longest part of the move from
+        start_pos through waypoints that takes at most max_secs. The move is
+        cut part way along a segment, found by bisection to within
+        stir_end_tolerance_secs (or half a step). """
+    waypoints = [tuple(waypoint) for waypoint in waypoints]
+    # Number of whole waypoints that fit.
+    (lo, hi) = (0, len(waypoints))
+    while lo < hi:
+      mid = (lo + hi + 1) // 2
+      if self.plan_stroke(waypoints[:mid], start_pos)[1] <= max_secs:
+        lo = mid
+      else:
+        hi = mid - 1
+    best = self.plan_stroke(waypoints[:lo], start_pos)
+    if lo == len(waypoints):
+      return best
+    prefix = waypoints[:lo]
+    seg_start = waypoints[lo - 1] if lo > 0 else tuple(start_pos)
+    seg_end = waypoints[lo]
+    (lo_fraction, hi_fraction) = (0.0, 1.0)
+    for i in range(0, 20):
+      if max_secs - best[1] <= Stirrer.stir_end_tolerance_secs:
+        break
+      fraction = 0.5 * (lo_fraction + hi_fraction)
+      cut = tuple([a + fraction * (b - a) for (a, b) in zip(seg_start, seg_end)])
+      planned = self.plan_stroke(prefix + [cut], start_pos)
+      if planned[1] <= max_secs:
+        (lo_fraction, best) = (fraction, planned)
+      else:
+        hi_fraction = fraction
+    return best
+
+  def budget_strokes(self, strokes, stir_for_seconds, start_pos):
+    """ Plans a stir session ahead of time.
+        strokes: Waypoint lists of one cycle of strokes. The cycle is repeated
+                 for as many whole strokes as fit in stir_for_seconds, and the
+                 last stroke is shortened to use up what is left.
+        Returns (list of planned segments for each move, planned secs). """
+    schedule = []
+    planned_secs = 0.0
+    # Every stroke starts where the one before it ended, so after the first
+    # one the duration of each stroke of the cycle is always the same.
+    plans = {}
+    pos = tuple(start_pos)
+    i = 0
+    while True:
+      key = i % len(strokes) if i > 0 else -1
+      waypoints = strokes[i % len(strokes)]
+      if key not in plans:
+        plans[key] = self.plan_stroke(waypoints, pos)
+      (segments, secs) = plans[key]
+      if i >= len(strokes) and planned_secs == 0.0:
+        break # Nothing in the cycle moves the stirrer.
+      if planned_secs + secs > stir_for_seconds:
+        (segments, secs) = self.plan_shortened_stroke(waypoints, pos, stir_for_seconds - planned_secs)
+        if len(segments) > 0:
+          schedule.append(segments)
+          planned_secs += secs
+        break
+      if len(segments) > 0:
+        schedule.append(segments)
+        planned_secs += secs
+      if len(waypoints) > 0:
+        pos = tuple(waypoints[-1])
+      i += 1
+    return (schedule, planned_secs)
+
+  def run_stroke_budget(self, strokes, stir_for_seconds, utensil_index):
+    """ Runs the strokes (see budget_strokes) so that the session ends on
+        time. Returns (planned secs, actual secs). """
+    for waypoints in strokes:
+      self.check_trajectory(waypoints, utensil_index)
+    (schedule, planned_secs) = self.budget_strokes(strokes, stir_for_seconds, self.get_curr_pos())
+    start_time = clock.now()
+    for segments in schedule:
+      self.planner.run(segments)
+    actual_secs = clock.now() - start_time
+    print ("Stirred for %.2f secs: planned %.2f secs of %d strokes for %.2f requested" %
+           (actual_secs, planned_secs, len(schedule), stir_for_seconds))
+    return (planned_secs, actual_secs)
 
   def get_cord_length_mm(self, dist_from_center, utensil_index):
     if utensil_index >= 3:
@@ -125,36 +359,59 @@ class Stirrer:
       raise ValueError("Stirrer cannot be positioned at this angle:" + str(angle))
     return (dx, dy)
 
-  def position_along_radius_at_angle(self, utensil_radius, angle):
+  def get_pos_along_radius_at_angle(self, utensil_radius, angle):
     z_pos = self.z_rail.get_curr_pos_mm()
     stirrer_x_center = Stirrer.x_utensil_pos + Stirrer.stirrer_x_offset
     stirrer_y_center = Stirrer.y_utensil_pos + Stirrer.stirrer_y_offset
     (dx, dy) = self.get_pos_for_angle(angle, utensil_radius)
-    dest = (stirrer_x_center + dx, stirrer_y_center + dy, z_pos)
-    self.move_to(dest)
+    return (stirrer_x_center + dx, stirrer_y_center + dy, z_pos)
+
+  def position_along_radius_at_angle(self, utensil_radius, angle):
+    self.move_linear(self.get_pos_along_radius_at_angle(utensil_radius, angle))
+
+  def get_circular_stroke_waypoints(self, stroke_radius, rotate_clockwise, z_pos):
+    """ Returns an (n, 3) array of the waypoints of a circular stroke. See
+        circular_path. """
+    stirrer_x_center = Stirrer.x_utensil_pos + Stirrer.stirrer_x_offset
+    stirrer_y_center = Stirrer.y_utensil_pos + Stirrer.stirrer_y_offset
+    return circular_path.get_circular_waypoints(stirrer_x_center, stirrer_y_center, z_pos, stroke_radius,
+                                                Stirrer.stirrer_width_mm, rotate_clockwise,
+                                                Stirrer.circular_chord_tolerance_mm)
+
+  def get_circular_stroke_radius(self, utensil_index, stir_radius_index):
+    if stir_radius_index < 1 or stir_radius_index > Stirrer.max_stir_radius_index:
+      raise ValueError("Invalid stir radius index:" + str(stir_radius_index) + ". Has to be between 1 and " +
+                       str(Stirrer.max_stir_radius_index))
+    utensil_radius = Stirrer.utensil_diameter_mm[utensil_index]/2
+    return (float(stir_radius_index)/Stirrer.max_stir_radius_index)* utensil_radius
 
   def one_circular_stir_stroke(self, stroke_radius, rotate_clockwise):
+    self.execute_circular_stroke(self.get_circular_stroke_waypoints(stroke_radius, rotate_clockwise,
+                                                                    self.z_rail.get_curr_pos_mm()))
+
+  def execute_circular_stroke(self, waypoints):
+    if len(waypoints) == 0:
+      return
     old_x_speed = self.x_rail.get_speed()
     old_y_speed = self.y_rail.get_speed()
-    twopiby360 = (2 * math.pi) / 360
-    start = 0
-    end = 360
-    increment = 1
-    if not rotate_clockwise:
-      start = 360
-      end = 0
-      increment = -1
-    for i in range(start, end, increment):
-      try:
-        self.position_along_radius_at_angle(stroke_radius, i * twopiby360)
-        self.x_rail.set_speed(270)
-        self.y_rail.set_speed(270)
-      except ValueError:
-        continue
+    # Get to the start of the circle at the normal speed and run the rest of
+    # it as a single continuous motion.
+    self.move_linear(waypoints[0])
+    self.x_rail.set_speed(270)
+    self.y_rail.set_speed(270)
+    self.move_along(waypoints[1:])
     self.x_rail.set_speed(old_x_speed)
     self.y_rail.set_speed(old_y_speed)
 
   def one_linear_stir_stroke(self, stirrer_dist_from_center, utensil_index, top_to_bottom, stir_height_index):
+    waypoints = self.get_stroke_plan(utensil_index, Stirrer.LINEAR, stir_height_index,
+                                     stirrer_dist_from_center, top_to_bottom)
+    if len(waypoints) > 0:
+      self.execute_stir_stroke(waypoints[0], waypoints[-1])
+
+  def get_linear_stroke_waypoints(self, stirrer_dist_from_center, utensil_index, top_to_bottom, stir_height_index):
+    """ Returns (start, end) of a linear stroke, or () if the stroke would
+        take the stirrer out of the utensil. """
     #print "Stroke:" + str(dist_from_center)+ ", " + str(top_to_bottom)
     stirrer_width_half = (Stirrer.stirrer_width_mm/ 2)
     utensil_radius = Stirrer.utensil_diameter_mm[utensil_index]/2
@@ -164,8 +421,12 @@ class Stirrer:
       edge_dist_from_center = stirrer_dist_from_center - stirrer_width_half
     # This stroke will keep the edge out of bounds. Return without doing anything.
     if abs(edge_dist_from_center) >= utensil_radius:
-      return
+      return ()
     cord_length = self.get_cord_length_mm(edge_dist_from_center, utensil_index)
+    # Too short for the gaps at either end. The stroke would run backwards
+    # and out of the utensil.
+    if cord_length <= Stirrer.stir_start_gap + Stirrer.stir_stop_gap:
+      return ()
 
     # Coordinates for the center of the platform for which the stirrer is at the
     # center of the utensil
@@ -188,7 +449,176 @@ class Stirrer:
       this_stroke_length = (float(utensil_radius - abs(edge_dist_from_center))/utensil_radius)* full_stroke_length
       this_stroke_up_pos = Stirrer.z_down_pos - this_stroke_length
 
-    self.execute_stir_stroke((x_delta, start_y, this_stroke_up_pos), (x_delta, end_y, Stirrer.z_down_pos))
+    return ((x_delta, start_y, this_stroke_up_pos), (x_delta, end_y, Stirrer.z_down_pos))
+
+  def get_circular_stroke_z_pos(self, stir_height_index):
+    return Stirrer.z_down_pos - Stirrer.stirring_height[stir_height_index]
+
+  def compute_stroke_plan(self, utensil_index, pattern, stir_height_index, radius_index, direction):
+    """ Every stroke is checked as a whole (see check_trajectory) before it is
+        cached, so that an invalid one fails before the stirrer moves. """
+    if pattern == Stirrer.LINEAR:
+      waypoints = self.get_linear_stroke_waypoints(radius_index, utensil_index, direction, stir_height_index)
+    elif pattern == Stirrer.CIRCULAR:
+      waypoints = self.get_circular_stroke_waypoints(self.get_circular_stroke_radius(utensil_index, radius_index),
+                                                     direction, self.get_circular_stroke_z_pos(stir_height_index))
+    elif pattern == Stirrer.SPIRAL:
+      waypoints = self.get_spiral_stroke_waypoints(utensil_index, stir_height_index, direction)
+    elif pattern == Stirrer.LINEAR_ORDER:
+      return self.plan_linear_strokes(utensil_index, stir_height_index)
+    elif pattern == Stirrer.ZIGZAG_ORDER:
+      return self.plan_zigzag_strokes(utensil_index, stir_height_index)
+    else:
+      raise ValueError("Unknown stir pattern:" + str(pattern))
+    self.check_trajectory(waypoints, utensil_index)
+    return waypoints
+
+  def get_spiral_stroke_waypoints(self, utensil_index, stir_height_index, rotate_clockwise):
+    stirrer_x_center = Stirrer.x_utensil_pos + Stirrer.stirrer_x_offset
+    stirrer_y_center = Stirrer.y_utensil_pos + Stirrer.stirrer_y_offset
+    return circular_path.get_spiral_waypoints(stirrer_x_center, stirrer_y_center,
+                                              self.get_circular_stroke_z_pos(stir_height_index),
+                                              Stirrer.utensil_diameter_mm[utensil_index]/2,
+                                              self.get_circular_stroke_radius(utensil_index, Stirrer.spiral_inner_radius_index),
+                                              self.get_circular_stroke_radius(utensil_index, Stirrer.spiral_outer_radius_index),
+                                              Stirrer.spiral_turns, Stirrer.stirrer_width_mm, rotate_clockwise,
+                                              Stirrer.circular_chord_tolerance_mm)
+
+  def get_linear_stroke(self, stirrer_dist_from_center, utensil_index, top_to_bottom, stir_height_index):
+    """ Returns the LinearStroke at stirrer_dist_from_center or None if it
+        does not fit in the utensil. """
+    waypoints = self.get_stroke_plan(utensil_index, Stirrer.LINEAR, stir_height_index,
+                                     stirrer_dist_from_center, top_to_bottom)
+    if len(waypoints) == 0:
+      return None
+    return linear_stroke_planner.LinearStroke(stirrer_dist_from_center, top_to_bottom,
+                                              waypoints[0], waypoints[-1])
+
+  def get_linear_stroke_planner(self, utensil_index, get_move_time=None):
+    stirrer_x_center = Stirrer.x_utensil_pos + Stirrer.stirrer_x_offset
+    stirrer_y_center = Stirrer.y_utensil_pos + Stirrer.stirrer_y_offset
+    grid = linear_stroke_planner.CoverageGrid(stirrer_x_center, stirrer_y_center,
+                                              Stirrer.utensil_diameter_mm[utensil_index]/2)
+    if get_move_time is None:
+      get_move_time = self.gantry.estimate_move_time
+    return linear_stroke_planner.LinearStrokePlanner(grid, Stirrer.stirrer_width_mm, get_move_time)
+
+  def get_linear_stroke_sets(self, utensil_index, stir_height_index):
+    """ Candidate stroke sets: evenly spaced strokes run left to right (so
+        that each stroke starts where the previous one ended) and the
+        original stroke list. """
+    utensil_radius = int(Stirrer.utensil_diameter_mm[utensil_index]/2)
+    stroke_sets = []
+    step = Stirrer.linear_stroke_spacing_mm
+    for spacing in range(int(Stirrer.stirrer_width_mm/2), int(Stirrer.stirrer_width_mm) + step, step):
+      for phase in range(0, spacing, step):
+        strokes = []
+        for offset in range(-utensil_radius + phase, utensil_radius + 1, spacing):
+          stroke = self.get_linear_stroke(offset, utensil_index, len(strokes) % 2 == 0, stir_height_index)
+          if stroke is not None:
+            strokes.append(stroke)
+        stroke_sets.append(strokes)
+    strokes = []
+    top_to_bottom = True
+    for offset in Stirrer.linear_stroke_offsets:
+      stroke = self.get_linear_stroke(offset, utensil_index, top_to_bottom, stir_height_index)
+      if stroke is not None:
+        strokes.append(stroke)
+      top_to_bottom = not top_to_bottom
+    stroke_sets.append(strokes)
+    return stroke_sets
+
+  def plan_linear_strokes(self, utensil_index, stir_height_index):
+    """ Picks the linear strokes with the best coverage per second among
+        get_linear_stroke_sets. """
+    stroke_sets = self.get_linear_stroke_sets(utensil_index, stir_height_index)
+    return tuple(self.get_linear_stroke_planner(utensil_index).plan(stroke_sets))
+
+  def plan_zigzag_strokes(self, utensil_index, stir_height_index):
+    """ Same as plan_linear_strokes for strokes that start at the bottom of
+        the utensil, scored with the moves stir_zigzag makes between them. """
+    stroke_sets = []
+    for strokes in self.get_linear_stroke_sets(utensil_index, stir_height_index):
+      stroke_sets.append([linear_stroke_planner.LinearStroke(stroke.offset_mm, stroke.top_to_bottom,
+                                                             (stroke.start_pos[0], stroke.start_pos[1], Stirrer.z_down_pos),
+                                                             stroke.end_pos)
+                          for stroke in strokes])
+    planner = self.get_linear_stroke_planner(utensil_index, self.gantry.estimate_move_time)
+    return tuple(planner.plan(stroke_sets))
+
+  def check_trajectory(self, waypoints, utensil_index=None):
+    """ Raises ValueError if any of the (x, y, z) waypoints is out of reach
+        of the rails or, given utensil_index, would put the stirrer outside
+        the utensil. """
+    trajectory_validator.check_rail_bounds(waypoints, [Stirrer.max_x_rail_translation_mm,
+                                                       Stirrer.max_y_rail_translation_mm,
+                                                       Stirrer.max_z_rail_translation_mm])
+    if utensil_index is not None:
+      trajectory_validator.check_in_utensil(waypoints, Stirrer.x_utensil_pos + Stirrer.stirrer_x_offset,
+                                            Stirrer.y_utensil_pos + Stirrer.stirrer_y_offset,
+                                            Stirrer.utensil_diameter_mm[utensil_index]/2,
+                                            Stirrer.stirrer_width_mm)
+
+  def check_stir(self, utensil_index, stir_type, num_secs, stir_height_index, stir_radius_index=None):
+    """ Raises ValueError if a stir cannot be run in the utensil. Computes
+        (and checks) the stroke plans it needs without moving anything. """
+    if num_secs < 0:
+      raise ValueError("Invalid stir duration:" + str(num_secs))
+    if stir_height_index < 0 or stir_height_index >= len(Stirrer.stirring_height):
+      raise ValueError("Invalid stir height index:" + str(stir_height_index))
+    if stir_type == "linear":
+      strokes = self.get_linear_stroke_order(utensil_index, stir_height_index)
+    elif stir_type == "zigzag":
+      strokes = self.get_zigzag_stroke_order(utensil_index, stir_height_index)
+    elif stir_type == "circular":
+      if stir_radius_index is None or stir_radius_index < 0:
+        stir_radius_indices = Stirrer.circular_sweep_radius_indices
+      else:
+        stir_radius_indices = [stir_radius_index]
+      for radius_index in stir_radius_indices:
+        for direction in (True, False):
+          self.get_stroke_plan(utensil_index, Stirrer.CIRCULAR, stir_height_index, radius_index, direction)
+    elif stir_type == "spiral":
+      self.get_stroke_plan(utensil_index, Stirrer.SPIRAL, stir_height_index, None, True)
+    else:
+      raise ValueError("Unrecognised stir type:" + str(stir_type))
+
+  def get_linear_stroke_order(self, utensil_index, stir_height_index):
+    """ Returns the (cached) ordered LinearStrokes stir_linear cycles
+        through in the utensil. """
+    return self.get_stroke_plan(utensil_index, Stirrer.LINEAR_ORDER, stir_height_index, None, None)
+
+  def get_zigzag_stroke_order(self, utensil_index, stir_height_index):
+    """ Returns the (cached) ordered LinearStrokes stir_zigzag cycles
+        through in the utensil. """
+    return self.get_stroke_plan(utensil_index, Stirrer.ZIGZAG_ORDER, stir_height_index, None, None)
+
+  def get_stroke_plan(self, utensil_index, pattern, stir_height_index, radius_index, direction):
+    """ Returns the (cached) waypoints of one stroke.
+        pattern: Stirrer.LINEAR, Stirrer.CIRCULAR, Stirrer.SPIRAL,
+                 Stirrer.LINEAR_ORDER (see get_linear_stroke_order) or
+                 Stirrer.ZIGZAG_ORDER (see get_zigzag_stroke_order).
+        radius_index: Distance of the stroke from the center of the utensil
+                      for linear strokes, stir radius index for circular ones
+                      and None for spirals.
+        direction: top_to_bottom for linear strokes, rotate_clockwise for
+                   circular ones and spirals. """
+    key = (utensil_index, pattern, stir_height_index, radius_index, direction)
+    return Stirrer.stroke_plan_cache.get_or_compute(key,
+        lambda: self.compute_stroke_plan(utensil_index, pattern, stir_height_index, radius_index, direction))
+
+  def warm_stroke_plans(self, utensil_index):
+    """ Computes the plans of every stroke stir_linear and stir_circular can
+        run in the utensil, so that none is computed while stirring. """
+    for stir_height_index in range(0, len(Stirrer.stirring_height)):
+      for direction in (True, False):
+        for offset in Stirrer.linear_stroke_offsets:
+          self.get_stroke_plan(utensil_index, Stirrer.LINEAR, stir_height_index, offset, direction)
+        for radius_index in range(1, Stirrer.max_stir_radius_index + 1):
+          self.get_stroke_plan(utensil_index, Stirrer.CIRCULAR, stir_height_index, radius_index, direction)
+      self.get_stroke_plan(utensil_index, Stirrer.SPIRAL, stir_height_index, None, True)
+      self.get_linear_stroke_order(utensil_index, stir_height_index)
+      self.get_zigzag_stroke_order(utensil_index, stir_height_index)
 
   ################  Public methods. #################
 
@@ -244,53 +674,92 @@ class Stirrer:
   # Y axis is the bottom rail and increases from ATX to front.
   def stir_linear(self, utensil_index, stir_for_seconds, stir_height_index):
     self.position_platform_at_utensil()
-    utensil_radius = Stirrer.utensil_diameter_mm[utensil_index]/2
-    stirrer_width_half = (Stirrer.stirrer_width_mm/ 2)
-    top_to_bottom = True
-    start_time = get_curr_time_in_secs()
-    distances = [0 , 60, -60, -20, 20, 80, -80, -40, 40]
-    index = 0
-    while True:
-      current = get_curr_time_in_secs()
-      if (current  - start_time) > stir_for_seconds:
-        break
-      dist_from_center = distances[index]
-      # print "Stirring at distance " + str(dist_from_center)
-      index += 1
-      index %= len(distances)
-      self.one_linear_stir_stroke(dist_from_center, utensil_index, top_to_bottom, stir_height_index)
-      top_to_bottom = not top_to_bottom
+    strokes = self.get_linear_stroke_order(utensil_index, stir_height_index)
+    if len(strokes) == 0:
+      return
+    self.run_stroke_budget([self.get_stir_stroke_waypoints(stroke.start_pos, stroke.end_pos)
+                            for stroke in strokes], stir_for_seconds, utensil_index)
     # self.stirrer_up()
     # self.position_platform_at_base()
 
+  def stir_zigzag(self, utensil_index, stir_for_seconds, stir_height_index):
+    """ Runs linear strokes back and forth at the bottom of the utensil.
+        Unlike stir_linear, the stirrer is not lifted and lowered again for
+        every stroke (Z is by far the slowest rail). It moves straight from
+        the end of a stroke to the start of the next: both were checked to
+        fit in the utensil (see compute_stroke_plan) and the positions the
+        stirrer fits at form a convex set, so the move stays inside. """
+    self.position_platform_at_utensil()
+    strokes = self.get_zigzag_stroke_order(utensil_index, stir_height_index)
+    if len(strokes) == 0:
+      return
+    # Lower the stirrer at the start of the first stroke.
+    self.move_linear((strokes[0].start_pos[0], strokes[0].start_pos[1], Stirrer.z_up_pos))
+    self.z_rail.move_to(Stirrer.z_down_pos)
+    # Each stroke followed by the move to the start of the next one.
+    cycle = []
+    for (i, stroke) in enumerate(strokes):
+      next_stroke = strokes[(i + 1) % len(strokes)]
+      cycle.append([stroke.end_pos, next_stroke.start_pos])
+    self.run_stroke_budget(cycle, stir_for_seconds, utensil_index)
+
   def stir_circular(self, utensil_index, stir_for_seconds, stir_height_index, stir_radius_index):
     self.position_platform_at_utensil()
     # self.stirrer_mid()
     utensil_radius = Stirrer.utensil_diameter_mm[utensil_index]/2
-    this_stroke_down_pos = Stirrer.z_down_pos - Stirrer.stirring_height[stir_height_index]
+    this_stroke_down_pos = self.get_circular_stroke_z_pos(stir_height_index)
     self.position_along_radius_at_angle(utensil_radius, 0)
     self.z_rail.move_to(this_stroke_down_pos)
     if stir_radius_index < 0:
-      stir_radius_indices = [5, 4, 3, 2, 1, 2, 3 ,4]
+      stir_radius_indices = Stirrer.circular_sweep_radius_indices
     else:
       stir_radius_indices = [stir_radius_index]
-    start_time = get_curr_time_in_secs()
+    # Alternates direction; an odd number of radii takes two rounds to get
+    # back to the first stroke.
+    strokes = []
     rotate_clockwise = True
-    while True:
-      current = get_curr_time_in_secs()
-      if (current  - start_time) > stir_for_seconds:
-        break
+    for i in range(0, 2 if len(stir_radius_indices) % 2 == 1 else 1):
       for curr_stir_radius_index in stir_radius_indices:
-        if curr_stir_radius_index > 5:
-          # Repurpose index as an actual offset value.
-          this_stroke_radius = utensil_radius + curr_stir_radius_index
-        else:
-          this_stroke_radius = (float(curr_stir_radius_index)/5)* utensil_radius
-        self.one_circular_stir_stroke(this_stroke_radius, rotate_clockwise)
+        strokes.append(self.get_stroke_plan(utensil_index, Stirrer.CIRCULAR, stir_height_index,
+                                            curr_stir_radius_index, rotate_clockwise))
         rotate_clockwise = not rotate_clockwise
+    old_x_speed = self.x_rail.get_speed()
+    old_y_speed = self.y_rail.get_speed()
+    # Moves between the circles run at the speed of the circles so that the
+    # whole session is one budget.
+    self.x_rail.set_speed(270)
+    self.y_rail.set_speed(270)
+    try:
+      self.run_stroke_budget(strokes, stir_for_seconds, utensil_index)
+    finally:
+      self.x_rail.set_speed(old_x_speed)
+      self.y_rail.set_speed(old_y_speed)
     # self.stirrer_up()
     # self.position_platform_at_base()
 
+  def stir_spiral(self, utensil_index, stir_for_seconds, stir_height_index):
+    """ Stirs along a spiral that winds in and back out without stopping,
+        instead of the concentric rings of stir_circular. The spiral is
+        repeated until stir_for_seconds have passed. """
+    self.position_platform_at_utensil()
+    waypoints = self.get_stroke_plan(utensil_index, Stirrer.SPIRAL, stir_height_index, None, True)
+    # Lower the stirrer at the start of the spiral.
+    self.move_linear((waypoints[0][0], waypoints[0][1], Stirrer.z_up_pos))
+    self.z_rail.move_to(waypoints[0][2])
+    old_velocity = self.gantry.max_velocity_mm_s
+    old_x_speed = self.x_rail.get_speed()
+    old_y_speed = self.y_rail.get_speed()
+    # Rails fast enough for the path speed to be the only limit.
+    self.gantry.max_velocity_mm_s = Stirrer.spiral_speed_mm_s
+    self.x_rail.set_speed(270)
+    self.y_rail.set_speed(270)
+    try:
+      self.run_stroke_budget([waypoints[1:]], stir_for_seconds, utensil_index)
+    finally:
+      self.gantry.max_velocity_mm_s = old_velocity
+      self.x_rail.set_speed(old_x_speed)
+      self.y_rail.set_speed(old_y_speed)
+
   def position_platform_for_cup(self, cup_num):
     self.stirrer_up()
     if cup_num < 1 or cup_num > 4:
@@ -301,7 +770,12 @@ class Stirrer:
     self.platform_position = PlatformPosition.IN_BETWEEN
 
   def shutdown(self):
-    self.position_platform_at_base()
+    if self.position_store is None:
+      self.position_platform_at_base()
+    else:
+      # The next start picks up from the snapshot.
+      self.stirrer_up()
+      self.disable()
 
 if (__name__ == "__main__"):
   stirrer = Stirrer(7, 8, 19,  # X Dir, Step, Enable
@@ -1,6 +1,7 @@
 from drivers.servo_driver import Servo
+from drivers import i2c_bus
 import submodules.pid_controller as pid_controller
-import RPi.GPIO as GPIO
+from drivers import gpio as GPIO
 import time
 
 # Ensure that you have installed the TMP006 library from AdaFruit
@@ -28,13 +29,16 @@ class StoveController:
                        Servo is connected to.
         init_pos: A number between 0 and 180 that specifies the initial angle
     """
-    self.servo = Servo(servo_channel, StoveController.low_pos)
+    # The knob goes ahead of other servo moves on the bus.
+    self.servo = Servo(servo_channel, StoveController.low_pos, priority=i2c_bus.I2CBus.ACTUATION)
     self.switch_bcm_pin = switch_bcm_pin
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(self.switch_bcm_pin, GPIO.OUT)
     self.off()
     self.temp_sensor = TMP006.TMP006(address=0x41)
-    self.temp_sensor.begin()
+    # The sensor shares the bus with the servo driver.
+    self.bus = i2c_bus.get_bus()
+    self.bus.call(self.temp_sensor.begin, i2c_bus.I2CBus.SAFETY)
     self.temp_pid_controller = pid_controller.PIDController(StoveController.kP,
                                                             StoveController.kI,
                                                             StoveController.kD,
@@ -78,7 +82,7 @@ class StoveController:
     self.temp_pid_controller.set_new_setpoint(temperature)
 
   def get_temperature_C(self):
-    temp = self.temp_sensor.readObjTempC()
+    temp = self.bus.call(self.temp_sensor.readObjTempC, i2c_bus.I2CBus.SAFETY)
     print "Current Temp: " + str(temp) + "*C"
     return temp
 
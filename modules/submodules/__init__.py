@@ -1,3 +1,9 @@
 __all__ = ['stepper_axis',
+           'circular_path',
+           'coordinated_motion',
+           'linear_stroke_planner',
+           'motion_planner',
+           'position_store',
+           'trajectory_validator',
            'pid_controller',
            'savitzky_golay_filter']
@@ -0,0 +1,108 @@
+import math
+# sudo apt-get install python-numpy
+import numpy as np
+
+# Geometry of circular stir strokes. The stirrer (stirrer_width wide) is
+# placed on a circle of radius stroke_radius around the center of the utensil
+# with its edge nearest to the center on the circle, offset by half its width
+# towards the center along X. Its far edge, a full width further along X, has
+# to stay within stroke_radius of the center:
+#     (r * |cos(a)| - 1.5 * w)^2 + (r * sin(a))^2 <= r^2
+# which simplifies to |cos(a)| >= 0.75 * w / r. So the reachable angles are the
+# two arcs around 0 and pi of half width acos(0.75 * w / r), and none at all
+# when r < 0.75 * w.
+
+def get_reachable_half_angle(stroke_radius, stirrer_width):
+  """ Returns the half width (in radians) of the reachable arcs around 0 and
+      pi, or None if no angle is reachable. """
+  if stroke_radius <= 0:
+    return None
+  min_cos = 0.75 * stirrer_width / stroke_radius
+  if min_cos > 1.0:
+    return None
+  # Keeps the end points reachable despite rounding.
+  return math.acos(min(1.0, min_cos + 1e-12))
+
+def get_reachable_intervals(stroke_radius, stirrer_width, clockwise):
+  """ Returns the reachable (start angle, end angle) intervals in the order a
+      stroke starting at angle 0 (2 * pi when not clockwise) visits them. """
+  half_angle = get_reachable_half_angle(stroke_radius, stirrer_width)
+  if half_angle is None:
+    return []
+  intervals = [(0.0, half_angle),
+               (math.pi - half_angle, math.pi + half_angle),
+               (2 * math.pi - half_angle, 2 * math.pi)]
+  if not clockwise:
+    intervals = [(end, start) for (start, end) in reversed(intervals)]
+  return intervals
+
+def get_angle_step(stroke_radius, chord_tolerance):
+  """ Largest angle between waypoints for which the chord between them stays
+      within chord_tolerance of the arc. """
+  if chord_tolerance >= stroke_radius:
+    return math.pi / 2
+  return 2 * math.acos(1.0 - float(chord_tolerance) / stroke_radius)
+
+def get_circular_waypoints(center_x, center_y, z_pos, stroke_radius, stirrer_width, clockwise,
+                           chord_tolerance):
+  """ Returns an (n, 3) array with the waypoints of a circular stroke
+      around (center_x, center_y) at height z_pos. The stroke skips the
+      unreachable angles; waypoints are spaced so that no chord deviates from
+      its arc by more than chord_tolerance. """
+  intervals = get_reachable_intervals(stroke_radius, stirrer_width, clockwise)
+  if len(intervals) == 0:
+    return np.zeros((0, 3))
+  max_step = get_angle_step(stroke_radius, chord_tolerance)
+  angles = []
+  for (start, end) in intervals:
+    num_points = int(math.ceil(abs(end - start) / max_step)) + 1
+    angles.append(np.linspace(start, end, num_points))
+  angles = np.concatenate(angles)
+  cos_angles = np.cos(angles)
+  # Offset by half the stirrer width towards the center.
+  dx = stroke_radius * cos_angles - np.where(cos_angles > 0, 0.5, -0.5) * stirrer_width
+  dy = stroke_radius * np.sin(angles)
+  waypoints = np.empty((len(angles), 3))
+  waypoints[:, 0] = center_x + dx
+  waypoints[:, 1] = center_y + dy
+  waypoints[:, 2] = z_pos
+  return waypoints
+
+def get_max_center_radius(angles, utensil_radius, stirrer_width):
+  """ Largest distance from the center of the utensil at which the stirrer
+      (stirrer_width wide along X) fits at each of angles:
+        (rho * |cos(a)| + w / 2)^2 + (rho * sin(a))^2 <= R^2 """
+  w_cos = stirrer_width * np.abs(np.cos(angles))
+  discriminant = w_cos * w_cos - stirrer_width * stirrer_width + 4 * utensil_radius * utensil_radius
+  return np.maximum(0.0, 0.5 * (np.sqrt(np.maximum(discriminant, 0.0)) - w_cos))
+
+def get_spiral_waypoints(center_x, center_y, z_pos, utensil_radius, inner_radius, outer_radius,
+                         num_turns, stirrer_width, clockwise, chord_tolerance):
+  """ Returns an (n, 3) array with the waypoints of a spiral that winds in
+      from outer_radius to inner_radius over num_turns turns and back out
+      over as many, ending where it started. The radius is clipped wherever
+      the stirrer would not fit in the utensil. The waypoints are equally
+      spaced along the path, so that a constant speed along the path is
+      reached everywhere except at the (few) clipped corners. """
+  num_turns = max(1, int(num_turns))
+  # Densely sampled spiral, then resampled at equal arc length.
+  samples_per_turn = 720
+  num_samples = 2 * num_turns * samples_per_turn + 1
+  t = np.linspace(0.0, 2.0, num_samples) # 0 -> 1 winds in, 1 -> 2 winds out.
+  angles = 2 * math.pi * num_turns * t
+  if not clockwise:
+    angles = -angles
+  radii = outer_radius - (outer_radius - inner_radius) * (1.0 - np.abs(1.0 - t))
+  radii = np.minimum(radii, get_max_center_radius(angles, utensil_radius, stirrer_width))
+  xs = radii * np.cos(angles)
+  ys = radii * np.sin(angles)
+  arc_lengths = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xs), np.diff(ys)))))
+  # Chord of an arc of the tightest radius with a sagitta of chord_tolerance.
+  spacing = 2 * math.sqrt(2 * max(inner_radius, chord_tolerance) * chord_tolerance)
+  num_points = int(math.ceil(arc_lengths[-1] / spacing)) + 1
+  path_positions = np.linspace(0.0, arc_lengths[-1], num_points)
+  waypoints = np.empty((num_points, 3))
+  waypoints[:, 0] = center_x + np.interp(path_positions, arc_lengths, xs)
+  waypoints[:, 1] = center_y + np.interp(path_positions, arc_lengths, ys)
+  waypoints[:, 2] = z_pos
+  return waypoints
@@ -0,0 +1,209 @@
+from ..drivers import clock
+from ..drivers import gpio as GPIO
+from ..drivers import motion_profile
+from ..drivers import step_waveform
+from ..drivers import stepper
+from itertools import izip
+import math
+
+class CoordinatedMotion:
+  """ Moves several StepperAxis objects together along a straight line so
+      that all of them start and arrive at the same time. The axis with the
+      most steps paces the move (one step per tick) and every other axis is
+      interleaved using a Bresenham/DDA error term.
+  """
+
+  # Step patterns only depend on the number of steps per axis, so repeated
+  # strokes reuse them just like the step timing tables.
+  step_pattern_cache = motion_profile.LRUCache(64)
+
+  def __init__(self, axes, max_velocity_mm_s, max_acceleration_mm_s2,
+               pulse_width=stepper.StepperMotor.default_pulse_width, executor=None):
+    """
+        axes: List of StepperAxis objects moved together.
+        max_velocity_mm_s: Limit on the speed along the path.
+        max_acceleration_mm_s2: Limit on the acceleration along the path.
+        Each axis is also kept within the speed and acceleration of its own
+        stepper.
+        executor: Optional step_waveform.WaveformExecutor that moves are
+                  handed to as a single waveform.
+    """
+    self.axes = axes
+    self.max_velocity_mm_s = float(max_velocity_mm_s)
+    self.max_acceleration_mm_s2 = float(max_acceleration_mm_s2)
+    self.pulse_width = pulse_width
+    self.executor = executor
+    self.missed_deadlines = 0
+    self.total_missed_deadlines = 0
+
+  def get_path_limits(self, deltas_mm, length_mm):
+    """ Returns (max velocity, acceleration, initial velocity, jerk) along a
+        path of length_mm made up of deltas_mm such that none of the axes
+        exceeds its own limits. jerk is None unless one of the moving axes
+        uses the S-curve profile, in which case the path uses it too. """
+    velocity = self.max_velocity_mm_s
+    acceleration = self.max_acceleration_mm_s2
+    initial_velocity = velocity
+    jerk = None
+    for axis, delta_mm in zip(self.axes, deltas_mm):
+      if delta_mm == 0:
+        continue
+      # Path speed at which this axis moves at speed 1 mm/s.
+      scale = length_mm / abs(delta_mm)
+      velocity = min(velocity, axis.get_max_velocity_mm_s() * scale)
+      acceleration = min(acceleration, axis.get_max_acceleration_mm_s2() * scale)
+      initial_velocity = min(initial_velocity, axis.get_initial_velocity_mm_s() * scale)
+      axis_jerk = axis.get_max_jerk_mm_s3()
+      if axis_jerk is not None:
+        jerk = min(jerk, axis_jerk * scale) if jerk is not None else axis_jerk * scale
+    return (velocity, acceleration, initial_velocity, jerk)
+
+  def estimate_move_time(self, start_positions_mm, dest_positions_mm):
+    """ Estimated duration of a straight move between two positions, using
+        the trapezoidal ramp at the path limits (the S-curve takes a little
+        longer). """
+    deltas_mm = [float(dest - start) for (start, dest) in zip(start_positions_mm, dest_positions_mm)]
+    length_mm = math.sqrt(sum([d * d for d in deltas_mm]))
+    if length_mm == 0:
+      return 0.0
+    (velocity, acceleration, initial_velocity, jerk) = self.get_path_limits(deltas_mm, length_mm)
+    return motion_profile.get_trapezoidal_move_time(length_mm, velocity, acceleration, initial_velocity)
+
+  def get_step_pattern(self, steps, step_pins):
+    """ Returns a tuple with one entry per tick holding the step pins to
+        pulse on that tick. """
+    key = (tuple(steps), tuple(step_pins))
+    return CoordinatedMotion.step_pattern_cache.get_or_compute(key,
+        lambda: compute_step_pattern(steps, step_pins))
+
+  def get_step_masks(self, steps, step_pins):
+    """ Same as get_step_pattern with each tick as a pin mask. """
+    key = ('masks', tuple(steps), tuple(step_pins))
+    return CoordinatedMotion.step_pattern_cache.get_or_compute(key,
+        lambda: tuple([step_waveform.pins_to_mask(tick_pins)
+                       for tick_pins in self.get_step_pattern(steps, step_pins)]))
+
+  def get_direction_masks(self, moves):
+    """ Returns (set mask, clear mask) for the direction pins of moves. """
+    set_mask = 0
+    clear_mask = 0
+    for (axis, (num_steps, increasing)) in zip(self.axes, moves):
+      if num_steps == 0:
+        continue
+      if axis.is_direction_clockwise(increasing):
+        set_mask |= 1 << axis.get_direction_pin()
+      else:
+        clear_mask |= 1 << axis.get_direction_pin()
+    return (set_mask, clear_mask)
+
+  def add_to_waveform(self, waveform, moves, tick_delays):
+    """ Appends a move to waveform: the direction edges, a settling time of
+        one pulse width and the step pulses. """
+    (set_mask, clear_mask) = self.get_direction_masks(moves)
+    waveform.add_edge(waveform.duration, set_mask, clear_mask)
+    waveform.duration += self.pulse_width
+    steps = [num_steps for (num_steps, increasing) in moves]
+    step_pins = [axis.get_step_pin() for axis in self.axes]
+    waveform.add_pulses(self.get_step_masks(steps, step_pins), tick_delays, self.pulse_width)
+
+  def execute(self, waveform, moves_list, first_edges):
+    """ Enables the axes that take part in any of moves_list, plays the
+        waveform on the executor and records the steps each axis took.
+        first_edges[i] is the index of the first edge of moves_list[i] in
+        the waveform. A stopped waveform only records the steps played. """
+    for moves in moves_list:
+      for (axis, (num_steps, increasing)) in zip(self.axes, moves):
+        if num_steps > 0:
+          axis.enable()
+    edges_done = self.executor.execute(waveform)
+    self.missed_deadlines = self.executor.get_missed_deadlines()
+    self.total_missed_deadlines += self.missed_deadlines
+    last_edges = list(first_edges[1:]) + [len(waveform)]
+    for (moves, first_edge, last_edge) in zip(moves_list, first_edges, last_edges):
+      for (axis, (num_steps, increasing)) in zip(self.axes, moves):
+        axis.record_steps(waveform.count_steps(axis.get_step_pin(), min(edges_done, last_edge), first_edge),
+                          increasing)
+
+  def move_to(self, dest_positions_mm):
+    if len(dest_positions_mm) != len(self.axes):
+      raise ValueError("Expected " + str(len(self.axes)) + " positions:" + str(dest_positions_mm))
+    # Validates every target before any axis moves.
+    moves = [axis.get_steps_to(pos) for (axis, pos) in zip(self.axes, dest_positions_mm)]
+    steps = [num_steps for (num_steps, increasing) in moves]
+    num_ticks = max(steps)
+    if num_ticks == 0:
+      return
+    deltas_mm = [(float(num_steps) / axis.get_steps_per_mm()) for (axis, num_steps) in zip(self.axes, steps)]
+    length_mm = math.sqrt(sum([d * d for d in deltas_mm]))
+    (velocity, acceleration, initial_velocity, jerk) = self.get_path_limits(deltas_mm, length_mm)
+    profile = motion_profile.TRAPEZOIDAL
+    if jerk is not None:
+      profile = motion_profile.SCURVE
+    tick_delays = motion_profile.get_step_delays(num_ticks, velocity, acceleration,
+                                                 initial_velocity, num_ticks / length_mm,
+                                                 profile, jerk)
+    if self.executor is not None:
+      waveform = step_waveform.Waveform()
+      self.add_to_waveform(waveform, moves, tick_delays)
+      self.execute(waveform, [moves], [0])
+      return
+    pattern = self.get_step_masks(steps, [axis.get_step_pin() for axis in self.axes])
+    for (axis, (num_steps, increasing)) in zip(self.axes, moves):
+      if num_steps > 0:
+        axis.prepare_to_step(increasing)
+    self.run(pattern, tick_delays)
+    for (axis, (num_steps, increasing)) in zip(self.axes, moves):
+      axis.record_steps(num_steps, increasing)
+
+  def run(self, pattern, tick_delays, deadline=None):
+    """ Pulses the pin mask of each tick (see get_step_masks) against
+        absolute deadlines, all the pins of a tick at once. See
+        StepperMotor.step_with_deadlines. deadline is the time of the first
+        tick (now by default) and the time the next tick would be due is
+        returned, so that several runs can be chained without a pause. """
+    pulse_width = self.pulse_width
+    spin_threshold = stepper.StepperMotor.spin_threshold
+    now = clock.get_clock().now
+    sleep_until = clock.get_clock().sleep_until
+    gpio_backend = GPIO.get_backend()
+    missed = 0
+    if deadline is None:
+      self.missed_deadlines = 0
+      deadline = now()
+    else:
+      sleep_until(deadline, spin_threshold)
+    for (tick_mask, tick_delay) in izip(pattern, tick_delays):
+      if tick_mask:
+        gpio_backend.set_mask(tick_mask)
+        sleep_until(deadline + pulse_width, spin_threshold)
+        gpio_backend.clear_mask(tick_mask)
+      deadline += tick_delay
+      curr_time = now()
+      if curr_time > deadline:
+        missed += 1
+        deadline = curr_time
+      else:
+        sleep_until(deadline, spin_threshold)
+    self.missed_deadlines += missed
+    self.total_missed_deadlines += missed
+    return deadline
+
+  def get_missed_deadlines(self):
+    """ Returns (deadlines missed in the last move, deadlines missed in total). """
+    return (self.missed_deadlines, self.total_missed_deadlines)
+
+def compute_step_pattern(steps, step_pins):
+  num_ticks = max(steps)
+  num_axes = len(steps)
+  # Starting halfway spreads each axis' steps evenly across the move.
+  errors = [num_ticks // 2] * num_axes
+  pattern = []
+  for tick in xrange(num_ticks):
+    tick_pins = []
+    for i in range(num_axes):
+      errors[i] += steps[i]
+      if errors[i] >= num_ticks:
+        errors[i] -= num_ticks
+        tick_pins.append(step_pins[i])
+    pattern.append(tuple(tick_pins))
+  return tuple(pattern)
@@ -0,0 +1,125 @@
+# sudo apt-get install python-numpy
+import numpy as np
+
+class LinearStroke:
+  """ A candidate linear stroke. start_pos and end_pos are the (x, y, z)
+      rail positions of the stroke as run by Stirrer.execute_stir_stroke. """
+
+  def __init__(self, offset_mm, top_to_bottom, start_pos, end_pos):
+    self.offset_mm = offset_mm
+    self.top_to_bottom = top_to_bottom
+    self.start_pos = start_pos
+    self.end_pos = end_pos
+
+
+class CoverageGrid:
+  """ The floor of the utensil as a grid of cell_mm square cells. """
+
+  def __init__(self, center_x, center_y, utensil_radius, cell_mm=2.0):
+    self.center_x = center_x
+    self.center_y = center_y
+    self.cell_mm = cell_mm
+    offsets = np.arange(-utensil_radius + cell_mm / 2, utensil_radius, cell_mm)
+    (self.xs, self.ys) = np.meshgrid(center_x + offsets, center_y + offsets)
+    self.inside = np.hypot(self.xs - center_x, self.ys - center_y) <= utensil_radius
+    self.xs = self.xs[self.inside]
+    self.ys = self.ys[self.inside]
+    self.cell_area = cell_mm * cell_mm
+    self.area = self.cell_area * len(self.xs)
+
+  def get_footprint(self, stroke, stirrer_width):
+    """ Cells swept by the stirrer over a stroke. """
+    x = stroke.start_pos[0]
+    (y0, y1) = sorted((stroke.start_pos[1], stroke.end_pos[1]))
+    return ((np.abs(self.xs - x) <= stirrer_width / 2.0) &
+            (self.ys >= y0) & (self.ys <= y1))
+
+
+class LinearStrokePlanner:
+  """ Scores sets of linear strokes by the area of the utensil they cover
+      per second of a pass, counting the travel between strokes (and back
+      to the first one), and picks the best set among those that cover at
+      least target_coverage of what the most covering set does.
+  """
+
+  def __init__(self, grid, stirrer_width, get_move_time, target_coverage=0.95):
+    """
+        grid: CoverageGrid of the utensil.
+        get_move_time: Callable returning the duration (in secs) of a move
+                       between two (x, y, z) positions.
+    """
+    self.grid = grid
+    self.stirrer_width = stirrer_width
+    self.get_move_time = get_move_time
+    self.target_coverage = target_coverage
+
+  def get_stroke_time(self, stroke):
+    (x, y, z) = stroke.start_pos
+    down_pos = (x, y, stroke.end_pos[2])
+    return self.get_move_time(stroke.start_pos, down_pos) + self.get_move_time(down_pos, stroke.end_pos)
+
+  def plan(self, stroke_sets):
+    """ stroke_sets: Lists of LinearStrokes, each in the order it is run.
+        Returns the best of them. """
+    stroke_sets = [strokes for strokes in stroke_sets if len(strokes) > 0]
+    if len(stroke_sets) == 0:
+      return []
+    scores = [self.get_coverage_rate(strokes) for strokes in stroke_sets]
+    target = self.target_coverage * max([coverage for (coverage, secs, rate) in scores])
+    eligible = [i for i in range(0, len(scores)) if scores[i][0] >= target]
+    best = max(eligible, key=lambda i: scores[i][2])
+    return stroke_sets[best]
+
+  def get_coverage_rate(self, strokes):
+    """ Returns (fraction of the floor covered, secs, mm^2 covered per sec)
+        for one pass over strokes, including the travel between them and
+        back to the first one. """
+    covered = np.zeros(len(self.grid.xs), dtype=bool)
+    secs = 0.0
+    for (i, stroke) in enumerate(strokes):
+      covered |= self.grid.get_footprint(stroke, self.stirrer_width)
+      secs += self.get_stroke_time(stroke)
+      secs += self.get_move_time(stroke.end_pos, strokes[(i + 1) % len(strokes)].start_pos)
+    area = covered.sum() * self.grid.cell_area
+    return (area / self.grid.area, secs, area / secs if secs > 0 else 0.0)
+
+if (__name__ == "__main__"):
+  # python -m modules.submodules.linear_stroke_planner from the top directory.
+  import os
+  import tempfile
+  import time
+  from ..drivers import gpio
+  from ..drivers import step_waveform
+  from .. import stirrer
+  (gpio_fd, gpio_path) = tempfile.mkstemp()
+  os.close(gpio_fd)
+  try:
+    gpio.set_backend(gpio.FileGPIOBackend(gpio_path))
+    s = stirrer.Stirrer(7, 8, 19, 11, 25, 20, 9, 10, 21,
+                        waveform_executor_class=step_waveform.SimulatedWaveformExecutor)
+    for utensil_index in range(0, len(stirrer.Stirrer.utensil_diameter_mm)):
+      planner = s.get_linear_stroke_planner(utensil_index)
+      legacy = []
+      top_to_bottom = True
+      for offset in stirrer.Stirrer.linear_stroke_offsets:
+        stroke = s.get_linear_stroke(offset, utensil_index, top_to_bottom, 2)
+        if stroke is not None:
+          legacy.append(stroke)
+        top_to_bottom = not top_to_bottom
+      start = time.time()
+      planned = s.get_linear_stroke_order(utensil_index, 2)
+      plan_secs = time.time() - start
+      for (name, strokes) in [("legacy", legacy), ("planned", planned)]:
+        (fraction, secs, rate) = planner.get_coverage_rate(strokes)
+        print ("Utensil %d %-8s %2d strokes: %5.1f%% covered in %5.2f secs, %6.0f mm^2/s" %
+               (utensil_index, name, len(strokes), 100 * fraction, secs, rate))
+      print "Planned in " + str(plan_secs) + " secs: " + str([stroke.offset_mm for stroke in planned])
+      zigzag = s.get_zigzag_stroke_order(utensil_index, 2)
+      (fraction, secs, rate) = planner.get_coverage_rate(planned)
+      (zigzag_fraction, zigzag_secs, zigzag_rate) = planner.get_coverage_rate(zigzag)
+      print ("Utensil %d zigzag   %2d strokes: %5.1f%% covered in %5.2f secs, %6.0f mm^2/s" %
+             (utensil_index, len(zigzag), 100 * zigzag_fraction, zigzag_secs, zigzag_rate))
+      print ("Strokes per minute: linear %5.1f, zigzag %5.1f" %
+             (60 * len(planned) / secs, 60 * len(zigzag) / zigzag_secs))
+  finally:
+    os.remove(gpio_path)
@@ -0,0 +1,144 @@
+from ..drivers import motion_profile
+from ..drivers import step_waveform
+import math
+import trajectory_validator
+
+class PlannedSegment:
+  """ One straight segment of a planned polyline. Velocities are along the
+      path in mm/s. """
+
+  def __init__(self, moves, length_mm, unit_vector, max_velocity, acceleration,
+               min_velocity):
+    self.moves = moves # (num_steps, increasing) for each axis
+    self.num_ticks = max([num_steps for (num_steps, increasing) in moves])
+    self.length_mm = length_mm
+    self.unit_vector = unit_vector
+    self.max_velocity = max_velocity
+    self.acceleration = acceleration
+    self.min_velocity = min_velocity
+    self.entry_velocity = min_velocity
+    self.exit_velocity = min_velocity
+
+  def get_tick_delays(self):
+    return motion_profile.get_step_delays(self.num_ticks, self.max_velocity, self.acceleration,
+                                          self.entry_velocity, self.num_ticks / self.length_mm,
+                                          motion_profile.TRAPEZOIDAL, None, self.exit_velocity)
+
+  def get_duration(self):
+    return sum(self.get_tick_delays())
+
+
+class MotionPlanner:
+  """ Runs a whole polyline of waypoints as one continuous coordinated
+      motion. Instead of stopping at every waypoint, the gantry passes
+      through each junction at the highest velocity that keeps the
+      deviation from the corner within junction_deviation_mm (the same
+      cornering model as grbl), and a lookahead pass makes sure it can
+      always slow down in time for the sharper junctions further along.
+      Segments use trapezoidal ramps since the S-curve tables only support
+      moves that start and end at the same velocity.
+  """
+
+  def __init__(self, gantry, junction_deviation_mm=0.05):
+    """
+        gantry: CoordinatedMotion whose axes and path limits are used.
+        junction_deviation_mm: Allowed deviation from the corner at a
+                               junction. Larger values corner faster.
+    """
+    self.gantry = gantry
+    self.junction_deviation_mm = junction_deviation_mm
+
+  def get_junction_velocity(self, prev_segment, next_segment):
+    cos_theta = -sum([a * b for (a, b) in zip(prev_segment.unit_vector, next_segment.unit_vector)])
+    if cos_theta > 0.999999:
+      return 0.0 # Full reversal.
+    acceleration = min(prev_segment.acceleration, next_segment.acceleration)
+    if cos_theta < -0.999999:
+      return float('inf') # Straight through.
+    sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+    return math.sqrt(acceleration * self.junction_deviation_mm * sin_theta_d2 / (1.0 - sin_theta_d2))
+
+  def plan(self, waypoints, start_positions_mm=None):
+    """ Returns the list of PlannedSegments (with entry and exit velocities
+        set) to move from the current position (or start_positions_mm, to plan
+        a later move ahead of time) through every waypoint. Each waypoint
+        holds one position per axis of the gantry. Every waypoint is
+        validated before anything is returned. """
+    axes = self.gantry.axes
+    steps_per_mm = [axis.get_steps_per_mm() for axis in axes]
+    trajectory_validator.check_rail_bounds(waypoints, [axis.max_translation_mm for axis in axes])
+    # Work in absolute steps so that rounding does not add up over the path.
+    if start_positions_mm is None:
+      start_positions_mm = [axis.get_curr_pos_mm() for axis in axes]
+    curr_steps = [int(round(pos * spm)) for (pos, spm) in zip(start_positions_mm, steps_per_mm)]
+    segments = []
+    for waypoint in waypoints:
+      target_steps = [int(round(pos * spm)) for (pos, spm) in zip(waypoint, steps_per_mm)]
+      step_deltas = [t - c for (t, c) in zip(target_steps, curr_steps)]
+      if max([abs(d) for d in step_deltas]) == 0:
+        continue
+      curr_steps = target_steps
+      deltas_mm = [float(d) / spm for (d, spm) in zip(step_deltas, steps_per_mm)]
+      length_mm = math.sqrt(sum([d * d for d in deltas_mm]))
+      (max_velocity, acceleration, min_velocity, jerk) = self.gantry.get_path_limits(deltas_mm, length_mm)
+      segments.append(PlannedSegment([(abs(d), d > 0) for d in step_deltas], length_mm,
+                                     [d / length_mm for d in deltas_mm],
+                                     max_velocity, acceleration, min_velocity))
+    if len(segments) == 0:
+      return segments
+    # Highest velocity allowed at each junction by the corner alone.
+    for i in range(1, len(segments)):
+      prev_segment = segments[i - 1]
+      next_segment = segments[i]
+      junction_velocity = min(self.get_junction_velocity(prev_segment, next_segment),
+                              prev_segment.max_velocity, next_segment.max_velocity)
+      junction_velocity = max(junction_velocity, prev_segment.min_velocity, next_segment.min_velocity)
+      prev_segment.exit_velocity = min(junction_velocity, prev_segment.max_velocity)
+      next_segment.entry_velocity = min(junction_velocity, next_segment.max_velocity)
+    # Backward pass: every segment has to be able to slow down to the entry
+    # velocity of the next one.
+    for i in reversed(range(0, len(segments))):
+      segment = segments[i]
+      if i + 1 < len(segments):
+        segment.exit_velocity = min(segment.exit_velocity, segments[i + 1].entry_velocity)
+      reachable = math.sqrt(segment.exit_velocity ** 2 + 2 * segment.acceleration * segment.length_mm)
+      segment.entry_velocity = max(segment.min_velocity, min(segment.entry_velocity, reachable))
+    # Forward pass: and be able to speed up to it.
+    for i in range(0, len(segments)):
+      segment = segments[i]
+      if i > 0:
+        segment.entry_velocity = min(segment.entry_velocity, segments[i - 1].exit_velocity)
+      reachable = math.sqrt(segment.entry_velocity ** 2 + 2 * segment.acceleration * segment.length_mm)
+      segment.exit_velocity = max(segment.min_velocity, min(segment.exit_velocity, reachable))
+    return segments
+
+  def get_duration(self, segments):
+    return sum([segment.get_duration() for segment in segments])
+
+  def run(self, segments):
+    """ Executes planned segments back to back without pausing at the
+        junctions. """
+    axes = self.gantry.axes
+    if self.gantry.executor is not None:
+      # The whole polyline becomes a single waveform.
+      waveform = step_waveform.Waveform()
+      first_edges = []
+      for segment in segments:
+        first_edges.append(len(waveform))
+        self.gantry.add_to_waveform(waveform, segment.moves, segment.get_tick_delays())
+      self.gantry.execute(waveform, [segment.moves for segment in segments], first_edges)
+      return
+    step_pins = [axis.get_step_pin() for axis in axes]
+    deadline = None
+    for segment in segments:
+      for (axis, (num_steps, increasing)) in zip(axes, segment.moves):
+        if num_steps > 0:
+          axis.prepare_to_step(increasing)
+      pattern = self.gantry.get_step_masks([num_steps for (num_steps, increasing) in segment.moves],
+                                           step_pins)
+      deadline = self.gantry.run(pattern, segment.get_tick_delays(), deadline)
+      for (axis, (num_steps, increasing)) in zip(axes, segment.moves):
+        axis.record_steps(num_steps, increasing)
+
+  def run_polyline(self, waypoints):
+    self.run(self.plan(waypoints))
@@ -1,10 +1,7 @@
+from ..drivers import clock
 import savitzky_golay_filter
 import random
 import threading
-import time
-
-def get_curr_time_in_secs():
-  return time.mktime(time.localtime())
 
 class PIDController(threading.Thread):
   """ Implementation of a PID Controller to control the value of a
@@ -51,9 +48,9 @@ class PIDController(threading.Thread):
     self.is_enabled = False
     self.savitzky_golay_filter.start()
     # Randomize the start of the filter and the current thread.
-    time.sleep(random.randint(0, self.sampling_interval_s/2))
+    clock.sleep(random.randint(0, self.sampling_interval_s/2))
+    deadline = clock.now()
     while True:
-      start_time = get_curr_time_in_secs()
       self.lock.acquire()
       # print self.is_enabled
       if self.is_enabled:
@@ -64,10 +61,13 @@ class PIDController(threading.Thread):
         self.lock.release()
         return # Stopping condition. Exits thread
       self.lock.release()
-      new_time = get_curr_time_in_secs()
-      if (new_time - start_time) < self.sampling_interval_s:
-        time_to_sleep = start_time + self.sampling_interval_s - new_time
-        time.sleep(time_to_sleep)
+      # Samples on a fixed schedule; a late sample re-anchors it.
+      deadline += self.sampling_interval_s
+      curr_time = clock.now()
+      if curr_time > deadline:
+        deadline = curr_time
+      else:
+        clock.sleep_until(deadline)
 
   def stop(self):
     self.lock.acquire()
@@ -113,11 +113,11 @@ class MockStove:
   def __init__(self, start_temp):
     self.deg_per_sec = 0.5
     self.curr_temp = start_temp
-    self.last_update_time = get_curr_time_in_secs()
+    self.last_update_time = clock.now()
     self.dest_temp = start_temp
 
   def get_temp(self):
-    time_curr = get_curr_time_in_secs()
+    time_curr = clock.now()
     if self.curr_temp == self.dest_temp:
       self.last_update_time = time_curr
       return self.curr_temp
@@ -137,6 +137,17 @@ class MockStove:
     # print "Set temp to: " + str(temp)
 
 if (__name__ == "__main__"):
+  # python -m modules.submodules.pid_controller from the top directory. Runs
+  # on a virtual clock, advanced by its own thread: the minute below takes a
+  # fraction of a second.
+  virtual_clock = clock.VirtualClock(auto_advance=False)
+  clock.set_clock(virtual_clock)
+  done = threading.Event()
+  def tick():
+    while not done.is_set():
+      virtual_clock.run(0.5, 0.5)
+  ticker = threading.Thread(target=tick)
+  ticker.start()
   mock_stove = MockStove(30)
   pid = PIDController(0.8, 0.5, 0, # P, I, D
                       34,      # setpoint
@@ -145,12 +156,15 @@ if (__name__ == "__main__"):
                       mock_stove.set_temp)
   pid.start()
   pid.set_new_setpoint(34)
-  time.sleep(30)
+  clock.sleep(30)
   pid.pause()
-  time.sleep(10)
+  clock.sleep(10)
   pid.resume()
-  time.sleep(10)
+  clock.sleep(10)
   pid.set_new_setpoint(37)
-  time.sleep(10)
+  clock.sleep(10)
   pid.stop()
   pid.join()
+  done.set()
+  ticker.join()
+  print "Temperature after " + str(clock.now()) + " virtual secs: " + str(mock_stove.curr_temp)
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+
+class PositionStore:
+  """ Persists the positions of a set of axes across restarts.
+
+      A snapshot is only trusted if it was written while the axes were at
+      rest (on disable or shutdown). The first motion after that marks the
+      snapshot as dirty, so a crash part way through a move is detected at the
+      next start and the axes are homed instead. Every write goes to a
+      temporary file which is then renamed over the snapshot, so a power loss
+      leaves either the old or the new snapshot but never a torn one.
+  """
+
+  version = 1
+
+  def __init__(self, path, max_age_secs=None):
+    """
+        path: File the snapshot is kept in.
+        max_age_secs: Optional age after which a snapshot is considered stale
+                      (e.g. the rails may have been moved by hand).
+    """
+    self.path = path
+    self.max_age_secs = max_age_secs
+    self.lock = threading.Lock()
+    self.positions = None
+    self.is_clean = False
+
+  def write(self, positions, clean):
+    snapshot = {"version": PositionStore.version,
+                "saved_at": time.time(),
+                "clean": clean,
+                "positions": positions}
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(snapshot, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_path, self.path)
+
+  def save(self, positions):
+    """ Records positions (a dict of axis name to mm) as a clean snapshot. """
+    self.lock.acquire()
+    try:
+      self.write(positions, True)
+      self.positions = dict(positions)
+      self.is_clean = True
+    finally:
+      self.lock.release()
+
+  def mark_moving(self):
+    """ Called before the axes move. Only the first call after a save writes
+        to disk. """
+    self.lock.acquire()
+    try:
+      if self.is_clean:
+        self.write(self.positions, False)
+        self.is_clean = False
+    finally:
+      self.lock.release()
+
+  def load(self, limits):
+    """ Returns the positions of the last clean snapshot if it is valid for
+        limits (a dict of axis name to max translation in mm), else None. The
+        reason a snapshot was rejected is printed. """
+    try:
+      with open(self.path) as f:
+        snapshot = json.load(f)
+    except IOError:
+      print "No position snapshot at " + self.path
+      return None
+    except ValueError, e:
+      print "Corrupt position snapshot " + self.path + ":" + str(e)
+      return None
+    try:
+      if snapshot["version"] != PositionStore.version:
+        print "Position snapshot has version " + str(snapshot["version"])
+        return None
+      if not snapshot["clean"]:
+        print "Position snapshot was taken before an interrupted move"
+        return None
+      age = time.time() - snapshot["saved_at"]
+      if self.max_age_secs is not None and (age > self.max_age_secs or age < 0):
+        print "Position snapshot is " + str(int(age)) + " secs old"
+        return None
+      positions = {}
+      for (name, max_translation_mm) in limits.items():
+        pos = float(snapshot["positions"][name])
+        if pos < 0 or pos > max_translation_mm:
+          print "Position snapshot has " + name + " out of range:" + str(pos)
+          return None
+        positions[name] = pos
+    except (KeyError, TypeError, ValueError), e:
+      print "Invalid position snapshot " + self.path + ":" + str(e)
+      return None
+    self.lock.acquire()
+    self.positions = positions
+    self.is_clean = True
+    self.lock.release()
+    return positions
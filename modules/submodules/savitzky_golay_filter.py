@@ -1,9 +1,6 @@
+from ..drivers import clock
 from collections import deque
 import threading
-import time
-
-def get_curr_time_in_secs():
-    return time.mktime(time.localtime())
   
 class SavitzkyGolayFilter(threading.Thread):
   """ Savitzky Golay filter which smoothens by fitting a quadratic over 5
@@ -46,8 +43,8 @@ class SavitzkyGolayFilter(threading.Thread):
     
   def run(self):
     """ Adds a point every sampling_interval secs. """
+    deadline = clock.now()
     while True:
-      start_time = get_curr_time_in_secs()
       self.lock.acquire()
       if self.is_enabled:
         point = self.get_next_point()
@@ -59,10 +56,13 @@ class SavitzkyGolayFilter(threading.Thread):
         self.lock.release()
         return # Stopping condition. Exits thread
       self.lock.release()
-      new_time = get_curr_time_in_secs()
-      if (new_time - start_time) < self.sampling_interval:
-        time_to_sleep = start_time + self.sampling_interval - new_time
-        time.sleep(time_to_sleep)
+      # Samples on a fixed schedule; a late sample re-anchors it.
+      deadline += self.sampling_interval
+      curr_time = clock.now()
+      if curr_time > deadline:
+        deadline = curr_time
+      else:
+        clock.sleep_until(deadline)
 
   def stop(self):
     self.lock.acquire()
@@ -140,8 +140,10 @@ class SavitzkyGolayFilter(threading.Thread):
     return smoothed_value
 
 
+demo_start_time = clock.now()
+
 def get_pt():
-  time_start = (get_curr_time_in_secs() - 1441473133)/2
+  time_start = (clock.now() - demo_start_time)/2
   return 4 + time_start * time_start
 
 if (__name__ == "__main__"):
@@ -149,14 +151,14 @@ if (__name__ == "__main__"):
   filter.start()
   for i in range(0, 10):
     print "" + str(i) + " " + str(filter.get_current_smoothed_derivative()) +  " k "
-    time.sleep(2)
+    clock.sleep(2)
   filter.pause()
   for i in range(0, 5):
     print "" + str(i) + " " + str(filter.get_current_smoothed_point()) +  " k "
-    time.sleep(2)
+    clock.sleep(2)
   filter.resume()
   for i in range(0, 10):
     print "" + str(i) + " " + str(filter.get_current_smoothed_point()) +  " k "
-    time.sleep(2)
+    clock.sleep(2)
   filter.stop()
   filter.join()
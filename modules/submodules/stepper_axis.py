@@ -1,17 +1,106 @@
+from ..drivers import motion_profile
 from ..drivers import stepper
+import Queue
+import threading
+
+class MoveFuture:
+  """ Handle to a move queued with StepperAxis.move_to_async. """
+
+  def __init__(self, axis, new_pos_mm, homing_speed=None):
+    self.axis = axis
+    self.new_pos_mm = new_pos_mm
+    self.homing_speed = homing_speed # Set for homing moves. See home_async.
+    self.finished = threading.Event()
+    self.is_cancelled = False
+    self.error = None
+
+  def cancel(self):
+    """ Cancels the move. A queued move is dropped and a move in flight ramps
+        down and stops where it is. Returns False if the move had already
+        finished. """
+    return self.axis.cancel_move(self)
+
+  def cancelled(self):
+    return self.is_cancelled
+
+  def done(self):
+    return self.finished.is_set()
+
+  def wait(self, timeout=None):
+    """ Blocks until the move is done. Returns False on timeout. """
+    return self.finished.wait(timeout)
+
+  def result(self, timeout=None):
+    """ Waits for the move and returns the position of the axis after it.
+        Re-raises any error raised by the move. """
+    if not self.wait(timeout):
+      raise RuntimeError("Timed out waiting for move to " + str(self.new_pos_mm))
+    if self.error is not None:
+      raise self.error
+    return self.axis.get_curr_pos_mm()
+
+  def set_done(self, error=None):
+    self.error = error
+    self.finished.set()
+
+
+class AxisMotionQueue(threading.Thread):
+  """ Runs the moves queued on a StepperAxis one after the other. """
+
+  def __init__(self, axis):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.axis = axis
+    self.moves = Queue.Queue()
+
+  def put(self, future):
+    self.moves.put(future)
+
+  def stop(self):
+    self.moves.put(None)
+
+  def run(self):
+    while True:
+      future = self.moves.get()
+      if future is None:
+        return # Stopping condition. Exits thread
+      self.axis.run_queued_move(future)
+
 
 class StepperAxis:
 
   """ Represents an axis controlled by a stepper motor """
+  # Homing drives the rail past 0 by up to this much, into the hard stop.
+  max_homing_overtravel_mm = 5.0
+
   def __init__(self, dir_pin, step_pin, enable_pin, max_translation_mm, speed=60,
-               inc_clockwise=True, rotations_per_mm = (float(8)/256.5)):
-    self.stepper = stepper.StepperMotor(dir_pin, step_pin, enable_pin, speed)
+               inc_clockwise=True, rotations_per_mm = (float(8)/256.5),
+               deadline_stepping=False, profile=motion_profile.TRAPEZOIDAL,
+               acceleration=None, jerk=None, executor=None, position_store=None):
+    """ acceleration and jerk are in revolutions/s^2 and revolutions/s^3 of
+        the stepper. See StepperMotor.set_motion_profile. executor is an
+        optional step_waveform.WaveformExecutor used only by this axis.
+        position_store is an optional PositionStore which is told before the
+        axis moves. """
+    self.stepper = stepper.StepperMotor(dir_pin, step_pin, enable_pin, speed,
+                                        deadline_stepping=deadline_stepping,
+                                        profile=profile, acceleration=acceleration,
+                                        jerk=jerk, executor=executor)
     self.inc_clockwise = inc_clockwise
     self.curr_pos_mm = 0
     self.max_translation_mm = max_translation_mm
     self.rotations_per_mm = rotations_per_mm  # 35mm per rotation.
+    # Guards curr_pos_mm and the state of the move in flight.
+    self.lock = threading.Lock()
+    self.in_flight_increasing = None
+    self.in_flight_future = None
+    self.last_future = None
+    self.motion_queue = None
+    self.position_store = position_store
 
   def enable(self):
+    if self.position_store is not None:
+      self.position_store.mark_moving()
     self.stepper.enable()
 
   def disable(self):
@@ -23,6 +112,12 @@ class StepperAxis:
   def set_speed(self, speed):
     self.stepper.set_speed(speed)
 
+  def set_motion_profile(self, profile, acceleration=None, jerk=None):
+    self.stepper.set_motion_profile(profile, acceleration, jerk)
+
+  def get_motion_profile(self):
+    return self.stepper.get_motion_profile()
+
   # Private methods
   def increment_pos_by_mm(self, distance_in_mm):
     if distance_in_mm < 0:
@@ -46,17 +141,242 @@ class StepperAxis:
 
   # End private methods
 
-  def move_to(self, new_pos_mm):
+  def check_pos_mm(self, new_pos_mm):
     if new_pos_mm > self.max_translation_mm or new_pos_mm < 0:
         raise ValueError("Invalid value:" + str(new_pos_mm) + " for new_pos_mm. Has to be within " +
                        " range(0," +str(self.max_translation_mm) + ")")
-    if new_pos_mm > self.curr_pos_mm:
-      self.curr_pos_mm += self.increment_pos_by_mm(new_pos_mm - self.curr_pos_mm)
-    else:
-      self.curr_pos_mm -= self.decrement_pos_by_mm(self.curr_pos_mm - new_pos_mm)
+
+  def execute_move(self, new_pos_mm):
+    self.check_pos_mm(new_pos_mm)
+    if self.position_store is not None:
+      self.position_store.mark_moving()
+    self.lock.acquire()
+    increasing = new_pos_mm > self.curr_pos_mm
+    distance_mm = abs(new_pos_mm - self.curr_pos_mm)
+    self.stepper.steps_taken = 0
+    # A stop requested after the last move had finished checking for one
+    # would otherwise stop this move at its first step. A cancel of the
+    # queued move running this is kept.
+    self.stepper.clear_stop()
+    if self.in_flight_future is not None and self.in_flight_future.is_cancelled:
+      self.stepper.request_stop()
+    self.in_flight_increasing = increasing
+    self.lock.release()
+    try:
+      if increasing:
+        moved_mm = self.increment_pos_by_mm(distance_mm)
+      else:
+        moved_mm = self.decrement_pos_by_mm(distance_mm)
+    except:
+      # Keep whatever distance was covered before the failure.
+      moved_mm = float(self.stepper.get_steps_taken()) / self.get_steps_per_mm()
+      raise
+    finally:
+      self.lock.acquire()
+      if increasing:
+        self.curr_pos_mm += moved_mm
+      else:
+        self.curr_pos_mm -= moved_mm
+      self.in_flight_increasing = None
+      self.lock.release()
+
+  def move_to(self, new_pos_mm):
+    # Let queued moves finish first so that they do not interleave.
+    self.wait_for_moves()
+    self.execute_move(new_pos_mm)
+
+  def set_curr_pos_mm(self, pos_mm):
+    """ Sets the position of the axis without moving it, e.g. from a
+        persisted snapshot. """
+    self.check_pos_mm(pos_mm)
+    self.lock.acquire()
+    self.curr_pos_mm = pos_mm
+    self.lock.release()
 
   def get_curr_pos_mm(self):
-    return self.curr_pos_mm
+    """ Returns the position of the axis. While a move is in flight this
+        includes the steps taken so far. """
+    self.lock.acquire()
+    try:
+      if self.in_flight_increasing is None:
+        return self.curr_pos_mm
+      moved_mm = float(self.stepper.get_steps_taken()) / self.get_steps_per_mm()
+      if self.in_flight_increasing:
+        return self.curr_pos_mm + moved_mm
+      return self.curr_pos_mm - moved_mm
+    finally:
+      self.lock.release()
+
+  # Asynchronous moves. Moves are run in order by a per axis background
+  # thread, leaving the caller free to do other work in the meantime.
+  def move_to_async(self, new_pos_mm):
+    """ Queues a move to new_pos_mm and returns a MoveFuture for it. The
+        target is validated right away. """
+    self.check_pos_mm(new_pos_mm)
+    future = MoveFuture(self, new_pos_mm)
+    self.lock.acquire()
+    if self.motion_queue is None:
+      self.motion_queue = AxisMotionQueue(self)
+      self.motion_queue.start()
+    self.last_future = future
+    self.motion_queue.put(future)
+    self.lock.release()
+    return future
+
+  def home_async(self, speed, overtravel_mm=5.0):
+    """ Queues a homing move and returns its MoveFuture. The rails have no
+        endstops, so the axis is driven towards 0 for its full travel plus
+        overtravel_mm at the given (low) speed. It ends against the hard stop
+        at 0 whatever its starting position, skipping the steps left over.
+        overtravel_mm is capped at max_homing_overtravel_mm, as the
+        overtravel is driven into the hard stop. """
+    if overtravel_mm < 0 or overtravel_mm > StepperAxis.max_homing_overtravel_mm:
+      raise ValueError("Invalid homing overtravel:" + str(overtravel_mm) + ". Has to be within range(0," +
+                       str(StepperAxis.max_homing_overtravel_mm) + ")")
+    future = MoveFuture(self, 0, homing_speed=speed)
+    future.overtravel_mm = overtravel_mm
+    self.lock.acquire()
+    if self.motion_queue is None:
+      self.motion_queue = AxisMotionQueue(self)
+      self.motion_queue.start()
+    self.last_future = future
+    self.motion_queue.put(future)
+    self.lock.release()
+    return future
+
+  def execute_homing_move(self, speed, overtravel_mm):
+    saved_speed = self.get_speed()
+    self.set_speed(speed)
+    self.lock.acquire()
+    # Assume the worst case; check_pos_mm is bypassed as the start is
+    # outside of the range of the axis.
+    self.curr_pos_mm = self.max_translation_mm + overtravel_mm
+    self.lock.release()
+    try:
+      self.execute_move(0)
+    finally:
+      self.set_speed(saved_speed)
+    if self.stepper.last_move_stopped:
+      # Stopped part way: where the axis is relative to the hard stop is
+      # not known, so it is not taken as 0.
+      raise RuntimeError("Homing was stopped before reaching the hard stop. The position is unknown.")
+    self.set_curr_pos_mm(0)
+
+  def run_queued_move(self, future):
+    self.lock.acquire()
+    if future.is_cancelled:
+      self.lock.release()
+      future.set_done()
+      return
+    self.in_flight_future = future
+    self.lock.release()
+    error = None
+    try:
+      if future.homing_speed is not None:
+        self.execute_homing_move(future.homing_speed, future.overtravel_mm)
+      else:
+        self.execute_move(future.new_pos_mm)
+    except Exception, e:
+      error = e
+    self.lock.acquire()
+    self.in_flight_future = None
+    self.lock.release()
+    future.set_done(error)
+
+  def cancel_move(self, future):
+    self.lock.acquire()
+    try:
+      if future.done():
+        return False
+      future.is_cancelled = True
+      if future is self.in_flight_future:
+        self.stepper.request_stop()
+      return True
+    finally:
+      self.lock.release()
+
+  def cancel_all_moves(self):
+    """ Cancels every queued move and stops the one in flight. """
+    self.lock.acquire()
+    pending = []
+    if self.motion_queue is not None:
+      pending = list(self.motion_queue.moves.queue)
+    in_flight = self.in_flight_future
+    self.lock.release()
+    for future in pending:
+      if future is not None:
+        future.cancel()
+    if in_flight is not None:
+      in_flight.cancel()
+
+  def wait_for_moves(self, timeout=None):
+    """ Blocks until every queued move is done. Returns False on timeout. """
+    future = self.last_future
+    if future is None:
+      return True
+    return future.wait(timeout)
+
+  def is_moving(self):
+    future = self.last_future
+    return future is not None and not future.done()
+
+  def stop_motion_queue(self):
+    self.lock.acquire()
+    motion_queue = self.motion_queue
+    self.motion_queue = None
+    self.lock.release()
+    if motion_queue is not None:
+      motion_queue.stop()
+      motion_queue.join()
+
+  def get_missed_deadlines(self):
+    return self.stepper.get_missed_deadlines()
+
+  # Used to step several axes together (see coordinated_motion).
+  def get_steps_per_mm(self):
+    return self.rotations_per_mm * stepper.StepperMotor.steps_per_rotation
+
+  def get_steps_to(self, new_pos_mm):
+    """ Returns (num_steps, increasing) to move from the current position to
+        new_pos_mm. """
+    self.check_pos_mm(new_pos_mm)
+    delta_mm = new_pos_mm - self.curr_pos_mm
+    return (int(abs(delta_mm) * self.get_steps_per_mm()), delta_mm > 0)
+
+  def prepare_to_step(self, increasing):
+    self.enable()
+    self.stepper.set_direction(self.is_direction_clockwise(increasing))
+
+  def is_direction_clockwise(self, increasing):
+    return increasing == self.inc_clockwise
+
+  def get_direction_pin(self):
+    return self.stepper.direction_pin
+
+  def record_steps(self, num_steps, increasing):
+    distance_mm = float(num_steps) / self.get_steps_per_mm()
+    if increasing:
+      self.curr_pos_mm += distance_mm
+    else:
+      self.curr_pos_mm -= distance_mm
+
+  def get_step_pin(self):
+    return self.stepper.step_pin
+
+  def get_max_velocity_mm_s(self):
+    return self.stepper.speed_rps / self.rotations_per_mm
+
+  def get_max_acceleration_mm_s2(self):
+    return self.stepper.acceleration / self.rotations_per_mm
+
+  def get_max_jerk_mm_s3(self):
+    """ Returns None unless the axis uses the S-curve profile. """
+    if self.stepper.jerk is None:
+      return None
+    return self.stepper.jerk / self.rotations_per_mm
+
+  def get_initial_velocity_mm_s(self):
+    return stepper.StepperMotor.initial_velocity / self.rotations_per_mm
 
 if (__name__ == "__main__"):
   y_stepper = StepperAxis(11, 25, 20, 6000, speed=150)
@@ -0,0 +1,52 @@
+# sudo apt-get install python-numpy
+import numpy as np
+
+# Checks a whole trajectory before anything moves, so that an invalid plan
+# fails before the first step instead of part way through a move. The
+# gantry moves along straight lines between waypoints. Both the box of rail
+# positions and the set of positions at which the stirrer fits in the
+# utensil are convex, so checking the waypoints also checks every position
+# in between.
+
+def as_positions(waypoints, num_axes):
+  return np.asarray(waypoints, dtype=float).reshape(-1, num_axes)
+
+def check_rail_bounds(waypoints, max_positions_mm):
+  """ Raises ValueError naming the first waypoint that is not within
+      [0, max_positions_mm] on every axis. """
+  positions = as_positions(waypoints, len(max_positions_mm))
+  invalid = ~((positions >= 0) & (positions <= np.asarray(max_positions_mm, dtype=float)))
+  if invalid.any():
+    (index, axis) = np.argwhere(invalid)[0]
+    raise ValueError("Waypoint " + str(index) + " " + str(tuple(positions[index])) + " is out of range on axis " +
+                     str(axis) + ". Has to be within range(0," + str(max_positions_mm[axis]) + ")")
+
+def get_outside_utensil(waypoints, center_x, center_y, utensil_radius, stirrer_width, tolerance_mm=1e-6):
+  """ Returns a boolean array that is True for each (x, y, ...) waypoint at
+      which an end of the stirrer (stirrer_width wide along X, centered on
+      the waypoint) is outside the utensil. """
+  positions = np.asarray(waypoints, dtype=float)
+  positions = positions.reshape(-1, positions.shape[-1] if positions.ndim > 1 else 3)
+  dx = np.abs(positions[:, 0] - center_x) + stirrer_width / 2.0
+  dy = positions[:, 1] - center_y
+  limit = utensil_radius + tolerance_mm
+  return dx * dx + dy * dy > limit * limit
+
+def check_in_utensil(waypoints, center_x, center_y, utensil_radius, stirrer_width):
+  """ Raises ValueError naming the first waypoint at which the stirrer would
+      be outside the utensil. """
+  outside = get_outside_utensil(waypoints, center_x, center_y, utensil_radius, stirrer_width)
+  if outside.any():
+    index = np.flatnonzero(outside)[0]
+    raise ValueError("Waypoint " + str(index) + " " + str(tuple(np.asarray(waypoints[index], dtype=float))) +
+                     " takes the stirrer outside the utensil")
+
+if (__name__ == "__main__"):
+  import time
+  waypoints = np.random.uniform(0, 90, (10000, 3))
+  num_runs = 100
+  start = time.time()
+  for i in range(0, num_runs):
+    check_rail_bounds(waypoints, [345.0, 290.0, 99.0])
+    get_outside_utensil(waypoints, 45, 45, 100, 60)
+  print "Checked " + str(len(waypoints)) + " waypoints in " + str((time.time() - start) * 1e6 / num_runs) + " usecs"
@@ -3,14 +3,11 @@ import datetime
 import os
 import string
 import thread
-import time
 
 from controller.sous_chef import SousChef
 from data_structures import Recipe
 from data_structures import Step
-
-def get_curr_time_in_secs():
-  return time.mktime(time.localtime())
+from modules.drivers import clock
 
 class MakeRecipeCommand(cmd.Cmd):
   def __init__(self, prompt, utensil_size,
@@ -44,11 +41,11 @@ class MakeRecipeCommand(cmd.Cmd):
     self._hist    = []      ## No history yet
     self._locals  = {}      ## Initialize execution namespace for user
     self._globals = {}
-    self.start_time = get_curr_time_in_secs()
-    self.previous_time = get_curr_time_in_secs()
+    self.start_time = clock.now()
+    self.previous_time = self.start_time
 
   def add_time_step_to_recipe(self):
-    curr_time = get_curr_time_in_secs()
+    curr_time = clock.now()
     time_delta = curr_time - self.previous_time
     self.previous_time = curr_time
     self.recipe.add_step(Step("delay", [time_delta]))
@@ -136,6 +133,12 @@ class MakeRecipeCommand(cmd.Cmd):
       elif stir_type == "linear":
         self.recipe.add_step(Step("stir",[stir_type, num_secs, stir_height_index]))
         self.sous_chef.stir_linear(num_secs, stir_height_index)
+      elif stir_type == "spiral":
+        self.recipe.add_step(Step("stir",[stir_type, num_secs, stir_height_index]))
+        self.sous_chef.stir_spiral(num_secs, stir_height_index)
+      elif stir_type == "zigzag":
+        self.recipe.add_step(Step("stir",[stir_type, num_secs, stir_height_index]))
+        self.sous_chef.stir_zigzag(num_secs, stir_height_index)
       else:
         raise ValueError(stir_type + " is invalid as stir_type")
     except Exception, e:
@@ -146,7 +149,10 @@ class MakeRecipeCommand(cmd.Cmd):
     contents in the utensil for num_secs seconds. Ensure that this move
     can be executed. e.g. cup dispenser is out of the way, lid is open,
     pumps are off. Can stir low or high.
-    Usage: stir circular 60 [1-5] [1-5]"""
+    Usage: stir circular 60 [1-5] [1-5]
+           stir linear 60 [1-5]
+           stir spiral 60 [1-5]
+           stir zigzag 60 [1-5]"""
 
   def do_temp(self, line):
     try:
@@ -201,7 +207,7 @@ class MakeRecipeCommand(cmd.Cmd):
     self.add_time_step_to_recipe()
     self.recipe.add_step(Step("done",[]))
     self.sous_chef.shutdown()
-    curr_time = get_curr_time_in_secs()
+    curr_time = clock.now()
     time_delta = curr_time - self.start_time
     self.recipe.set_total_time(time_delta)
     return True
@@ -321,6 +327,11 @@ class SousChefMain(cmd.Cmd):
       f.close()
       print "This recipe will take " + str(datetime.timedelta(seconds=recipe.get_total_time())) + " secs"
       sous_chef = SousChef(utensil_index=recipe.utensil_size)
+      # Checks every stir of the recipe up front so that an invalid one fails
+      # before anything moves.
+      for step in recipe.steps:
+        if step.name == "stir":
+          sous_chef.check_stir(*step.step_args)
       for step in recipe.steps:
         if step.name == "lid":
           if step.step_args[0] == 'open':
@@ -338,6 +349,10 @@ class SousChefMain(cmd.Cmd):
             sous_chef.stir_circular(step.step_args[1], step.step_args[2], step.step_args[3])
           elif step.step_args[0] == "linear":
             sous_chef.stir_linear(step.step_args[1], step.step_args[2])
+          elif step.step_args[0] == "spiral":
+            sous_chef.stir_spiral(step.step_args[1], step.step_args[2])
+          elif step.step_args[0] == "zigzag":
+            sous_chef.stir_zigzag(step.step_args[1], step.step_args[2])
           else:
             raise ValueError("Invalid stir type" + step.step_args[0])
         elif step.name == "temp":
@@ -347,7 +362,7 @@ class SousChefMain(cmd.Cmd):
         elif step.name == "addcup":
           sous_chef.add_cup(step.step_args[0])
         elif step.name == "delay":
-          time.sleep(step.step_args[0])
+          clock.sleep(step.step_args[0])
         elif step.name == "done":
           sous_chef.shutdown()
         else: